@@ -40,4 +40,7 @@ GRANT INSERT,SELECT,UPDATE,DELETE ON TABLE USUARIO TO diego;
 
 GRANT INSERT,SELECT,UPDATE,DELETE ON TABLE ESTUDIO TO diego;
 
-GRANT INSERT,SELECT,UPDATE,DELETE ON TABLE PELICULA TO diego;
\ No newline at end of file
+GRANT INSERT,SELECT,UPDATE,DELETE ON TABLE PELICULA TO diego;
+
+-- Los índices y los cambios posteriores del esquema están en migraciones/.
+-- Aplicarlos después de crear las tablas con: python migrar.py
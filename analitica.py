@@ -0,0 +1,180 @@
+"""
+Informes del catálogo sobre las vistas materializadas de migraciones/005_analitica.sql.
+
+Los informes leen solo las vistas, que tienen una fila por estudio, país, género o
+año, así que no recorren PELICULA. Las vistas se refrescan con
+REFRESH MATERIALIZED VIEW CONCURRENTLY, que no bloquea las lecturas mientras tanto,
+y cada informe indica cuándo se refrescó por última vez la vista que lee.
+
+    python analitica.py refrescar [--cada SEGUNDOS] [--vista mv_genero ...]
+    python analitica.py informe estudios|paises|generos|anos [--limite N]
+"""
+import argparse
+import json
+import time
+
+import psycopg2
+import psycopg2.extensions
+
+from conexiones import fijar_aislamiento, leer_config
+
+
+# Vistas en orden de refresco: MV_PAIS se calcula a partir de MV_ESTUDIO
+VISTAS = ('mv_estudio', 'mv_pais', 'mv_genero', 'mv_ano')
+
+# Cerrojo consultivo para que no haya dos refrescos a la vez
+CERROJO_REFRESCO = 5017001
+
+SQL_INFORMES = {
+    'estudios': """
+        SELECT id_Estudio, nombreE, paisOrigen, num_peliculas, valor_catalogo, precio_medio, duracion_media
+        FROM MV_ESTUDIO
+        WHERE %(pais)s::varchar IS NULL OR paisOrigen = %(pais)s
+        ORDER BY valor_catalogo DESC, id_Estudio
+        LIMIT %(limite)s
+    """,
+    'paises': """
+        SELECT paisOrigen, num_estudios, num_peliculas, valor_catalogo
+        FROM MV_PAIS
+        ORDER BY valor_catalogo DESC, paisOrigen
+        LIMIT %(limite)s
+    """,
+    'generos': """
+        SELECT genero, num_peliculas, precio_medio, precio_min, precio_max, duracion_media,
+               num_valoraciones, valoracion_media
+        FROM MV_GENERO
+        ORDER BY genero
+        LIMIT %(limite)s
+    """,
+    'anos': """
+        SELECT ano, num_peliculas, duracion_media, precio_medio
+        FROM MV_ANO
+        WHERE (%(desde)s::int IS NULL OR ano >= %(desde)s) AND (%(hasta)s::int IS NULL OR ano <= %(hasta)s)
+        ORDER BY ano
+        LIMIT %(limite)s
+    """,
+}
+
+# Vista de la que lee cada informe
+VISTA_INFORME = {'estudios': 'mv_estudio', 'paises': 'mv_pais', 'generos': 'mv_genero', 'anos': 'mv_ano'}
+
+
+## ------------------------------------------------------------
+def refrescar(conn, vistas=None, concurrente=True):
+    """
+    Refresca las vistas materializadas, cada una en su transacción, y anota la fecha
+    y la duración en ANALITICA_REFRESCO.
+    :param conn: la conexión abierta a la base de datos (del propietario de las vistas)
+    :param vistas: nombres de las vistas (None: todas, en el orden de VISTAS)
+    :param concurrente: refrescar sin bloquear las lecturas (más lento que sin CONCURRENTLY)
+    :return: diccionario vista -> segundos, o None si ya había otro refresco en curso
+    :raises ValueError: si alguna vista no existe
+    """
+    vistas = list(VISTAS) if vistas is None else [v.lower() for v in vistas]
+    desconocidas = set(vistas) - set(VISTAS)
+    if desconocidas:
+        raise ValueError(f"Vistas desconocidas: {', '.join(sorted(desconocidas))}.")
+    vistas.sort(key=VISTAS.index)
+
+    fijar_aislamiento(conn, psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED)
+    tiempos = {}
+    with conn.cursor() as cursor:
+        try:
+            cursor.execute("SELECT pg_try_advisory_lock(%s)", (CERROJO_REFRESCO, ))
+            if not cursor.fetchone()[0]:
+                conn.rollback()
+                return None
+            conn.commit()
+            try:
+                for vista in vistas:
+                    inicio = time.perf_counter()
+                    cursor.execute(f"REFRESH MATERIALIZED VIEW {'CONCURRENTLY ' if concurrente else ''}{vista}")
+                    tiempos[vista] = time.perf_counter() - inicio
+                    cursor.execute("""
+                        INSERT INTO ANALITICA_REFRESCO (vista, fecha, segundos) VALUES (%s, now(), %s)
+                        ON CONFLICT (vista) DO UPDATE SET fecha = EXCLUDED.fecha, segundos = EXCLUDED.segundos
+                    """, (vista, tiempos[vista]))
+                    conn.commit()
+            finally:
+                conn.rollback()
+                cursor.execute("SELECT pg_advisory_unlock(%s)", (CERROJO_REFRESCO, ))
+                conn.commit()
+        except psycopg2.Error:
+            conn.rollback()
+            raise
+    return tiempos
+
+
+def informe(conn, tipo, limite=None, pais=None, desde=None, hasta=None, control_tx=True):
+    """
+    Devuelve un informe del catálogo leyendo su vista materializada.
+    :param conn: la conexión abierta a la base de datos
+    :param tipo: 'estudios', 'paises', 'generos' o 'anos'
+    :param limite: número máximo de filas (None: todas)
+    :param pais: en 'estudios', solo los estudios de este país
+    :param desde: en 'anos', desde este año
+    :param hasta: en 'anos', hasta este año
+    :param control_tx: indica si se debe realizar commit/rollback o no
+    :return: tupla (lista de diccionarios, fecha del último refresco de la vista o None)
+    :raises ValueError: si el tipo de informe no existe
+    """
+    # Importado aquí para no cargar psycopg2.extras (y logging) al arrancar app.py
+    import psycopg2.extras
+    if tipo not in SQL_INFORMES:
+        raise ValueError(f"Informe desconocido: {tipo}.")
+    fijar_aislamiento(conn, psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED)
+    with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+        try:
+            cursor.execute(SQL_INFORMES[tipo], {'limite': limite, 'pais': pais, 'desde': desde, 'hasta': hasta})
+            filas = [dict(fila) for fila in cursor.fetchall()]
+            cursor.execute("SELECT fecha FROM ANALITICA_REFRESCO WHERE vista = %s", (VISTA_INFORME[tipo], ))
+            fila = cursor.fetchone()
+            if control_tx:
+                conn.commit()
+        except psycopg2.Error:
+            if control_tx:
+                conn.rollback()
+            raise
+    return filas, None if fila is None else fila['fecha']
+
+
+## ------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description="Informes del catálogo sobre vistas materializadas.")
+    subparsers = parser.add_subparsers(dest='comando', required=True)
+    p_refrescar = subparsers.add_parser('refrescar', help="Refresca las vistas materializadas")
+    p_refrescar.add_argument('--vista', action='append', choices=VISTAS, help="Vista a refrescar; se puede repetir")
+    p_refrescar.add_argument('--cada', type=float, default=None, help="Repetir cada tantos segundos")
+    p_refrescar.add_argument('--bloqueante', action='store_true', help="Refrescar sin CONCURRENTLY")
+    p_informe = subparsers.add_parser('informe', help="Muestra un informe en JSON")
+    p_informe.add_argument('tipo', choices=sorted(SQL_INFORMES))
+    p_informe.add_argument('--limite', type=int, default=None)
+    p_informe.add_argument('--pais', default=None)
+    p_informe.add_argument('--desde', type=int, default=None)
+    p_informe.add_argument('--hasta', type=int, default=None)
+    args = parser.parse_args()
+
+    params, _ = leer_config()
+    conn = psycopg2.connect(**params)
+    try:
+        if args.comando == 'informe':
+            filas, fecha = informe(conn, args.tipo, args.limite, args.pais, args.desde, args.hasta)
+            print(json.dumps({'actualizado': fecha, 'filas': filas}, indent=2, ensure_ascii=False, default=str))
+            return
+        while True:
+            tiempos = refrescar(conn, args.vista, concurrente=not args.bloqueante)
+            if tiempos is None:
+                print("Ya hay otro refresco en curso.")
+            else:
+                print(', '.join(f"{vista} {segundos:.2f} s" for vista, segundos in tiempos.items()))
+            if args.cada is None:
+                break
+            time.sleep(args.cada)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
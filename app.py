@@ -1,23 +1,288 @@
 import psycopg2
 import psycopg2.extensions
-import psycopg2.extras
 import psycopg2.errorcodes
+import argparse
+import csv
+import io
+import itertools
+import json
+import os
+import random
 import sys
+import time
 
+from contextlib import contextmanager, nullcontext
 from datetime import datetime
-from numpy.compat import long
+from decimal import Decimal
+
+import analitica
+from cache import CacheLRU
+from conexiones import ERRORES_REINTENTABLES, EnrutadorLecturas, fijar_aislamiento, leer_config, leyendo_de_replica
+from conexiones import reintentar as _reintentar
+from metricas import ConexionMedida, operacion, servir_http
+from sentencias import RegistroSentencias
+
+# psycopg2.extras (que carga logging) se importa dentro de las funciones que usan sus
+# cursores, para que las órdenes que no usan la base de datos arranquen antes
+
+
+# Caché de películas por id_Pelicula, delante de obtener_pelicula.
+# Se configura con BDA_CACHE_TAMANO (0 la desactiva) y BDA_CACHE_TTL (segundos).
+cache_peliculas = CacheLRU(tamano=int(os.environ.get('BDA_CACHE_TAMANO', 10000)),
+                           ttl=float(os.environ.get('BDA_CACHE_TTL', 60)))
+
+# Cola de escritura diferida de valoraciones y rebajas (cola_escritura.py).
+# Se activa con BDA_COLA_ESCRITURA=1; connect_db la crea y disconnect_db la vacía.
+cola_escritura = None
+
+# Enrutador de las lecturas del menú a las réplicas (conexiones.EnrutadorLecturas).
+# Se crea en connect_db si hay réplicas configuradas; lsn_escrito es la posición del
+# WAL tras la última escritura de esta sesión, que deben tener aplicada las réplicas
+# para que se lea lo escrito.
+lecturas = None
+lsn_escrito = None
+
+# Reintentos por defecto de las actualizaciones optimistas cuando otro usuario
+# modificó la película entre la lectura y la escritura
+REINTENTOS_OPTIMISTAS = int(os.environ.get('BDA_REINTENTOS_OPTIMISTAS', 3))
+
+
+class ConflictoVersion(Exception):
+    """
+    La película cambió desde que se leyó: su versión ya no es la esperada.
+    """
+
+    def __init__(self, id_pelicula, esperada, actual):
+        super().__init__(f"La película {id_pelicula} fue modificada por otro usuario "
+                         f"(versión {esperada}, ahora {actual}).")
+        self.id_pelicula = id_pelicula
+        self.esperada = esperada
+        self.actual = actual
+
+
+## ------------------------------------------------------------
+## Sentencias SQL de las operaciones. Están a nivel de módulo para poder
+## revisar sus planes de ejecución (comprobar_indices.py).
+## ------------------------------------------------------------
+SQL_INSERTAR_ESTUDIO = "INSERT INTO ESTUDIO (id_Estudio, nombreE, paisOrigen) " \
+                       "VALUES (%(p)s, %(n)s, %(a)s);"
+
+SQL_INSERTAR_USUARIO = "INSERT INTO USUARIO (DNI, nombre, apellido, telefono) " \
+                       "VALUES (%(p)s, %(n)s, %(a)s, %(t)s);"
+
+SQL_INSERTAR_PELICULA = "INSERT INTO PELICULA (id_Us, id_Est, id_Pelicula, precio, titulo, duracion_Minutos, año, genero) " \
+                        "VALUES (%(u)s, %(e)s, %(p)s, %(pr)s, %(t)s, %(d)s, %(a)s, %(g)s);"
+
+SQL_OBTENER_PELICULA = """
+        SELECT c.id_Pelicula, c.id_Us, c.id_Est, c.precio, c.titulo, c.duracion_Minutos, c.año, c.genero,
+               COALESCE(r.media, c.valoracion) AS valoracion, COALESCE(r.num, 0) AS num_valoraciones,
+               c.version
+        FROM PELICULA c
+        LEFT JOIN VALORACION_RESUMEN r ON r.id_Pelicula = c.id_Pelicula
+        WHERE c.id_pelicula = %(c)s
+    """
+
+# Los valores a None dejan la columna como está, para poder cambiar solo alguna
+SQL_MODIFICAR_PELICULA = """
+            UPDATE PELICULA
+            SET titulo = COALESCE(%(m)s, titulo),
+                año = COALESCE(%(a)s, año),
+                precio = COALESCE(%(p)s, precio)
+            WHERE id_Pelicula = %(c)s
+        """
+
+# Actualizaciones optimistas: solo se aplican si la película sigue en la versión leída
+SQL_MODIFICAR_PELICULA_VERSION = """
+            UPDATE PELICULA
+            SET titulo = COALESCE(%(m)s, titulo),
+                año = COALESCE(%(a)s, año),
+                precio = COALESCE(%(p)s, precio)
+            WHERE id_Pelicula = %(c)s AND version = %(v)s
+        """
+
+SQL_VERSION_PELICULA = "SELECT version FROM PELICULA WHERE id_Pelicula = %(c)s"
+
+SQL_BORRAR_PELICULA = "DELETE FROM PELICULA WHERE id_Pelicula = %s"
+
+SQL_REBAJAR_PRECIO = """
+        UPDATE PELICULA
+        SET precio = precio - precio * %(d)s / 100
+        WHERE id_Pelicula = %(m)s
+    """
+
+SQL_REBAJAR_PRECIO_VERSION = """
+        UPDATE PELICULA
+        SET precio = precio - precio * %(d)s / 100
+        WHERE id_Pelicula = %(m)s AND version = %(v)s
+    """
+
+# Valoraciones: la fila de VALORACION_RESUMEN de la película se crea si no existe y se
+# bloquea antes de tocar VALORACION, así las valoraciones de una misma película se
+# aplican de una en una y el resumen no pierde ninguna.
+SQL_CREAR_RESUMEN = """
+        INSERT INTO VALORACION_RESUMEN (id_Pelicula)
+        SELECT id_Pelicula FROM PELICULA WHERE id_Pelicula = %(p)s
+        ON CONFLICT (id_Pelicula) DO NOTHING
+    """
+
+SQL_BLOQUEAR_RESUMEN = """
+        SELECT num FROM VALORACION_RESUMEN WHERE id_Pelicula = %(p)s FOR UPDATE
+    """
+
+SQL_VALORACION_ANTERIOR = """
+        SELECT valoracion FROM VALORACION WHERE id_Pelicula = %(p)s AND id_Us = %(u)s
+    """
+
+SQL_GUARDAR_VALORACION = """
+        INSERT INTO VALORACION (id_Pelicula, id_Us, valoracion)
+        VALUES (%(p)s, %(u)s, %(v)s)
+        ON CONFLICT (id_Pelicula, id_Us) DO UPDATE
+        SET valoracion = EXCLUDED.valoracion, fecha = now()
+    """
+
+SQL_SUMAR_RESUMEN = """
+        UPDATE VALORACION_RESUMEN
+        SET num = num + 1,
+            suma = suma + %(v)s,
+            media = ROUND((suma + %(v)s)::numeric / (num + 1), 2),
+            histograma[%(v)s] = histograma[%(v)s] + 1
+        WHERE id_Pelicula = %(p)s
+    """
+
+SQL_CAMBIAR_RESUMEN = """
+        UPDATE VALORACION_RESUMEN
+        SET suma = suma + %(v)s - %(a)s,
+            media = ROUND((suma + %(v)s - %(a)s)::numeric / num, 2),
+            histograma[%(v)s] = histograma[%(v)s] + 1,
+            histograma[%(a)s] = histograma[%(a)s] - 1
+        WHERE id_Pelicula = %(p)s
+    """
+
+SQL_MEJOR_VALORADAS = """
+        SELECT r.id_Pelicula, c.titulo, r.media, r.num, r.histograma
+        FROM VALORACION_RESUMEN r
+        INNER JOIN PELICULA c ON c.id_Pelicula = r.id_Pelicula
+        WHERE r.media IS NOT NULL AND r.num >= %(minimo)s
+        ORDER BY r.media DESC, r.num DESC, r.id_Pelicula
+        LIMIT %(n)s
+    """
+
+# Sentencias que se preparan una vez por conexión y se ejecutan por nombre.
+# BDA_PREPARAR=0 las desactiva (por ejemplo detrás de un pgbouncer en modo transacción).
+sentencias = RegistroSentencias(activo=os.environ.get('BDA_PREPARAR', '1') != '0')
+sentencias.registrar('bda_insertar_estudio', SQL_INSERTAR_ESTUDIO)
+sentencias.registrar('bda_insertar_usuario', SQL_INSERTAR_USUARIO)
+sentencias.registrar('bda_insertar_pelicula', SQL_INSERTAR_PELICULA)
+sentencias.registrar('bda_obtener_pelicula', SQL_OBTENER_PELICULA)
+sentencias.registrar('bda_modificar_pelicula', SQL_MODIFICAR_PELICULA)
+sentencias.registrar('bda_modificar_pelicula_version', SQL_MODIFICAR_PELICULA_VERSION)
+sentencias.registrar('bda_version_pelicula', SQL_VERSION_PELICULA)
+sentencias.registrar('bda_borrar_pelicula', SQL_BORRAR_PELICULA)
+sentencias.registrar('bda_rebajar_precio', SQL_REBAJAR_PRECIO)
+sentencias.registrar('bda_rebajar_precio_version', SQL_REBAJAR_PRECIO_VERSION)
+sentencias.registrar('bda_crear_resumen', SQL_CREAR_RESUMEN)
+sentencias.registrar('bda_bloquear_resumen', SQL_BLOQUEAR_RESUMEN)
+sentencias.registrar('bda_valoracion_anterior', SQL_VALORACION_ANTERIOR)
+sentencias.registrar('bda_guardar_valoracion', SQL_GUARDAR_VALORACION)
+sentencias.registrar('bda_sumar_resumen', SQL_SUMAR_RESUMEN)
+sentencias.registrar('bda_cambiar_resumen', SQL_CAMBIAR_RESUMEN)
+sentencias.registrar('bda_mejor_valoradas', SQL_MEJOR_VALORADAS)
+
+# Plantillas de rebajar_precios: {filtro} es la condición de _filtro_peliculas
+SQL_REBAJAR_PRECIOS = """
+        UPDATE PELICULA
+        SET precio = precio - precio * %(d)s / 100
+        WHERE {filtro}
+        RETURNING id_Pelicula
+    """
+
+SQL_LOTE_PRECIOS = """
+        SELECT id_Pelicula
+        FROM PELICULA
+        WHERE {filtro} {desde_id}
+        ORDER BY id_Pelicula
+        LIMIT %(lote)s
+    """
+
+SQL_REBAJAR_LOTE = """
+        UPDATE PELICULA
+        SET precio = precio - precio * %(d)s / 100
+        WHERE id_Pelicula = ANY(%(lote_ids)s) AND {filtro}
+        RETURNING id_Pelicula
+    """
+
+# Alta de una película junto con su usuario y su estudio en una sola sentencia.
+# Los CTE insertan el usuario y el estudio si no existen (y si se dan sus datos);
+# las claves externas de PELICULA se comprueban al final de la sentencia, cuando ya
+# están insertados.
+SQL_ALTA_PELICULA = """
+        WITH usuario AS (
+            INSERT INTO USUARIO (DNI, nombre, apellido, telefono)
+            SELECT %(u)s::varchar, %(un)s::varchar, %(ua)s::varchar, %(ut)s::varchar
+            WHERE %(un)s::varchar IS NOT NULL
+            ON CONFLICT (DNI) DO NOTHING
+            RETURNING DNI
+        ), estudio AS (
+            INSERT INTO ESTUDIO (id_Estudio, nombreE, paisOrigen)
+            SELECT %(e)s::bigint, %(en)s::varchar, %(ep)s::varchar
+            WHERE %(en)s::varchar IS NOT NULL
+            ON CONFLICT (id_Estudio) DO NOTHING
+            RETURNING id_Estudio
+        )
+        INSERT INTO PELICULA (id_Us, id_Est, id_Pelicula, precio, titulo, duracion_Minutos, año, genero)
+        VALUES (%(u)s, %(e)s, %(p)s, %(pr)s, %(t)s, %(d)s, %(a)s, %(g)s)
+        RETURNING (SELECT count(*) FROM usuario) > 0, (SELECT count(*) FROM estudio) > 0
+    """
+sentencias.registrar('bda_alta_pelicula', SQL_ALTA_PELICULA)
+
+# Versión por lotes para execute_values: %s es la lista VALUES con una fila de
+# PLANTILLA_ALTA por película, y {conflicto} decide qué pasa con las películas que
+# ya existen
+SQL_ALTA_PELICULAS = """
+        WITH datos (id_Us, id_Est, id_Pelicula, precio, titulo, duracion_Minutos, año, genero,
+                    nombre, apellido, telefono, nombreE, paisOrigen) AS (
+            VALUES %s
+        ), usuario AS (
+            INSERT INTO USUARIO (DNI, nombre, apellido, telefono)
+            SELECT DISTINCT ON (id_Us) id_Us, nombre, apellido, telefono
+            FROM datos
+            WHERE nombre IS NOT NULL
+            ORDER BY id_Us
+            ON CONFLICT (DNI) DO NOTHING
+            RETURNING DNI
+        ), estudio AS (
+            INSERT INTO ESTUDIO (id_Estudio, nombreE, paisOrigen)
+            SELECT DISTINCT ON (id_Est) id_Est, nombreE, paisOrigen
+            FROM datos
+            WHERE nombreE IS NOT NULL
+            ORDER BY id_Est
+            ON CONFLICT (id_Estudio) DO NOTHING
+            RETURNING id_Estudio
+        ), pelicula AS (
+            INSERT INTO PELICULA (id_Us, id_Est, id_Pelicula, precio, titulo, duracion_Minutos, año, genero)
+            SELECT id_Us, id_Est, id_Pelicula, precio, titulo, duracion_Minutos, año, genero
+            FROM datos
+            ORDER BY id_Pelicula
+            {conflicto}
+            RETURNING id_Pelicula
+        )
+        SELECT (SELECT count(*) FROM pelicula), (SELECT count(*) FROM usuario), (SELECT count(*) FROM estudio)
+    """
+
+PLANTILLA_ALTA = "(%s::varchar, %s::bigint, %s::bigint, %s::numeric, %s::varchar, %s::int, %s::timestamp, " \
+                 "%s::varchar, %s::varchar, %s::varchar, %s::varchar, %s::varchar, %s::varchar)"
 
 
 ## ------------------------------------------------------------
 def connect_db():
     try:
-        conn = psycopg2.connect(
-            host="localhost",
-            database="diegodb",
-            user="diego",
-            password="clave"
-        )
+        params, _ = leer_config()
+        if os.environ.get('BDA_METRICAS', '1') != '0':
+            params['connection_factory'] = ConexionMedida
+        conn = psycopg2.connect(**params)
         conn.autocommit = False
+        iniciar_cola_escritura()
+        iniciar_lecturas()
         return conn
     except psycopg2.Error as e:
         print(f"No se pudo conectar: {e}. Cerrando...")
@@ -27,10 +292,86 @@ def connect_db():
 
 ## ------------------------------------------------------------
 def disconnect_db(conn):
+    cerrar_cola_escritura()
+    cerrar_lecturas()
     conn.commit()
     conn.close()
 
 
+def iniciar_cola_escritura():
+    """
+    Crea la cola de escritura diferida si BDA_COLA_ESCRITURA está activa.
+    :return: la cola, o None si no se usa
+    """
+    global cola_escritura
+    if cola_escritura is None and os.environ.get('BDA_COLA_ESCRITURA', '0') != '0':
+        from cola_escritura import ColaEscritura
+        # Las operaciones se pasan desde aquí para que la cola use la caché y las
+        # sentencias de este módulo aunque se ejecute como __main__
+        cola_escritura = ColaEscritura.desde_config(escribir_precio=_aplicar_rebaja,
+                                                    escribir_valoracion=_aplicar_valoracion,
+                                                    invalidar=cache_peliculas.invalidar)
+    return cola_escritura
+
+
+def cerrar_cola_escritura():
+    """
+    Escribe lo pendiente en la cola de escritura diferida y la cierra.
+    """
+    global cola_escritura
+    if cola_escritura is None:
+        return
+    try:
+        cola_escritura.cerrar()
+    except psycopg2.Error as e:
+        print(f"No se pudieron guardar las escrituras pendientes: {e}")
+    cola_escritura = None
+
+
+def iniciar_lecturas():
+    """
+    Crea el enrutador de lecturas si hay réplicas configuradas (BDA_REPLICAS o [replicas]).
+    :return: el enrutador, o None si no hay réplicas
+    """
+    global lecturas
+    if lecturas is None:
+        extra = {'connection_factory': ConexionMedida} if os.environ.get('BDA_METRICAS', '1') != '0' else {}
+        lecturas = EnrutadorLecturas.desde_config(**extra)
+    return lecturas
+
+
+def cerrar_lecturas():
+    global lecturas, lsn_escrito
+    if lecturas is not None:
+        lecturas.cerrar()
+        lecturas = None
+    lsn_escrito = None
+
+
+@contextmanager
+def conexion_lectura(conn):
+    """
+    Conexión para una operación de solo lectura: de una réplica que ya tenga aplicadas
+    las escrituras de esta sesión, o conn si no hay réplicas o ninguna sirve.
+    :param conn: la conexión a la principal
+    """
+    if lecturas is None:
+        yield conn
+        return
+    with lecturas.lectura(lambda: nullcontext(conn), lsn=lsn_escrito) as conn_lectura:
+        yield conn_lectura
+
+
+def anotar_escritura(conn):
+    """
+    Anota la posición del WAL tras una escritura, para que las lecturas siguientes
+    vayan a una réplica solo si ya la ha aplicado.
+    :param conn: la conexión a la principal, sin transacción en curso
+    """
+    global lsn_escrito
+    if lecturas is not None:
+        lsn_escrito = lecturas.posicion_escritura(conn)
+
 
 ## ------------------------------------------------------------
 def es_dni_valido(dni):
@@ -55,21 +396,740 @@ def es_dni_valido(dni):
 
     # Comparar la letra de control
     return letra == letra_esperada
-def insert_estudio(conn):
+
+
+def dnis_validos(dnis):
     """
-    Pide los datos de un usuario y lo inserta en la tabla 'USUARIO'
+    Versión vectorizada de es_dni_valido para validar muchos DNI de una vez
+    (cargas masivas). Da el mismo resultado que es_dni_valido para cada elemento;
+    los elementos que no son cadenas se consideran no válidos.
+    :param dnis: lista o array de NumPy con los DNI
+    :return: tupla (array booleano con True en los DNI válidos,
+             array con la letra de control esperada de cada DNI, o '' si no se puede calcular)
+    """
+    # NumPy solo hace falta en las cargas masivas; importarlo al principio retrasaría
+    # el arranque de todas las demás órdenes
+    import numpy as np
+
+    arr = np.asarray(dnis)
+    if arr.dtype.kind != 'U':
+        arr = np.array([d if isinstance(d, str) else '' for d in arr.ravel()], dtype=str)
+    arr = arr.ravel()
+    n = arr.size
+    letras = np.array([ord(c) for c in 'TRWAGMYFPDXBNJZSQVHLCKE'], dtype=np.uint32)
+
+    # Códigos Unicode de los 9 caracteres de los DNI de longitud 9; el resto queda a cero
+    de9 = np.char.str_len(arr) == 9 if n else np.zeros(0, dtype=bool)
+    codigos = np.zeros((n, 9), dtype=np.uint32)
+    codigos[de9] = arr[de9].astype('<U9').view(np.uint32).reshape(-1, 9)
+
+    digitos = codigos[:, :8].astype(np.int64) - ord('0')
+    con_digitos = de9 & ((digitos >= 0) & (digitos <= 9)).all(axis=1)
+    numero = (np.where(con_digitos[:, None], digitos, 0) * 10 ** np.arange(7, -1, -1, dtype=np.int64)).sum(axis=1)
+    esperada = letras[numero % 23]
+
+    letra = codigos[:, 8]
+    letra = np.where((letra >= ord('a')) & (letra <= ord('z')), letra - 32, letra)  # upper() de ASCII
+    validos = con_digitos & (letra == esperada)
+    letras_esperadas = np.where(con_digitos, esperada, 0).astype(np.uint32).view('<U1')
+
+    # Los DNI con caracteres no ASCII (dígitos Unicode, letras cuyo upper() es ASCII...)
+    # se validan uno a uno para conservar exactamente la semántica de es_dni_valido
+    for i in np.flatnonzero(de9 & (codigos > 127).any(axis=1)):
+        dni = str(arr[i])
+        try:
+            validos[i] = es_dni_valido(dni)
+            if dni[:8].isdigit():
+                letras_esperadas[i] = 'TRWAGMYFPDXBNJZSQVHLCKE'[int(dni[:8]) % 23]
+        except ValueError:
+            validos[i] = False
+    return validos, letras_esperadas
+
+
+## ------------------------------------------------------------
+## Acceso a datos: funciones sin interacción con el usuario.
+## Reciben los datos ya validados, lanzan psycopg2.Error si falla la operación
+## y, si control_tx es True, hacen commit o rollback ellas mismas.
+## Las que modifican una película la invalidan en cache_peliculas tras el commit;
+## con control_tx=False debe hacerlo el llamador cuando confirme.
+## ------------------------------------------------------------
+def crear_estudio(conn, id_estudio, nombre, pais, control_tx=True):
+    """
+    Inserta un estudio en la tabla 'ESTUDIO'.
     :param conn: la conexión abierta a la base de datos
+    :param control_tx: indica si se debe realizar commit/rollback o no
     :return: nada
     """
-    conn.isolation_level = psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED
+    fijar_aislamiento(conn, psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED)
+    with conn.cursor() as cursor:
+        try:
+            sentencias.ejecutar(cursor, 'bda_insertar_estudio', {'p': id_estudio, 'n': nombre, 'a': pais})
+            if control_tx:
+                conn.commit()
+        except psycopg2.Error:
+            if control_tx:
+                conn.rollback()
+            raise
 
+
+def crear_usuario(conn, dni, nombre, apellido, telefono, control_tx=True):
+    """
+    Inserta un usuario en la tabla 'USUARIO'.
+    :param conn: la conexión abierta a la base de datos
+    :param control_tx: indica si se debe realizar commit/rollback o no
+    :return: nada
+    """
+    fijar_aislamiento(conn, psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED)
+    with conn.cursor() as cursor:
+        try:
+            sentencias.ejecutar(cursor, 'bda_insertar_usuario', {'p': dni, 'n': nombre, 'a': apellido, 't': telefono})
+            if control_tx:
+                conn.commit()
+        except psycopg2.Error:
+            if control_tx:
+                conn.rollback()
+            raise
+
+
+def crear_pelicula(conn, id_us, id_est, id_pelicula, precio, titulo, duracion_minutos, ano, genero,
+                   control_tx=True):
+    """
+    Inserta una película en la tabla 'PELICULA'.
+    :param conn: la conexión abierta a la base de datos
+    :param control_tx: indica si se debe realizar commit/rollback o no
+    :return: nada
+    """
+    fijar_aislamiento(conn, psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED)
+    with conn.cursor() as cursor:
+        try:
+            sentencias.ejecutar(cursor, 'bda_insertar_pelicula', {'u': id_us, 'e': id_est, 'p': id_pelicula, 'pr': precio, 't': titulo,
+                                 'd': duracion_minutos, 'a': ano, 'g': genero})
+            if control_tx:
+                conn.commit()
+        except psycopg2.Error:
+            if control_tx:
+                conn.rollback()
+            raise
+
+
+def _fila_alta(pelicula, usuario, estudio):
+    """
+    Une los datos de una película con los de su usuario y su estudio (o None) en una
+    fila de PLANTILLA_ALTA.
+    :raises ValueError: si el usuario o el estudio no son los de la película
+    """
+    if usuario is not None and usuario[0] != pelicula[0]:
+        raise ValueError(f"El usuario {usuario[0]} no es el de la película {pelicula[2]} ({pelicula[0]}).")
+    if estudio is not None and estudio[0] != pelicula[1]:
+        raise ValueError(f"El estudio {estudio[0]} no es el de la película {pelicula[2]} ({pelicula[1]}).")
+    return (tuple(pelicula) + (tuple(usuario[1:]) if usuario is not None else (None, None, None))
+            + (tuple(estudio[1:]) if estudio is not None else (None, None)))
+
+
+def alta_pelicula(conn, pelicula, usuario=None, estudio=None, control_tx=True):
+    """
+    Inserta una película y, si no existen, su usuario y su estudio, en una sola sentencia.
+    Si el usuario o el estudio ya existen se dejan como están.
+    :param conn: la conexión abierta a la base de datos
+    :param pelicula: tupla en el orden de COLUMNAS_CARGA['pelicula'] (como validar_pelicula)
+    :param usuario: tupla en el orden de COLUMNAS_CARGA['usuario'], o None si ya debe existir
+    :param estudio: tupla en el orden de COLUMNAS_CARGA['estudio'], o None si ya debe existir
+    :param control_tx: indica si se debe realizar commit/rollback o no
+    :return: tupla (se creó el usuario, se creó el estudio)
+    :raises ValueError: si el usuario o el estudio no son los de la película
+    """
+    u, e, p, pr, t, d, a, g, un, ua, ut, en, ep = _fila_alta(pelicula, usuario, estudio)
+    fijar_aislamiento(conn, psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED)
+    with conn.cursor() as cursor:
+        try:
+            sentencias.ejecutar(cursor, 'bda_alta_pelicula', {
+                'u': u, 'e': e, 'p': p, 'pr': pr, 't': t, 'd': d, 'a': a, 'g': g,
+                'un': un, 'ua': ua, 'ut': None if ut is None else str(ut), 'en': en, 'ep': ep})
+            usuario_nuevo, estudio_nuevo = cursor.fetchone()
+            if control_tx:
+                conn.commit()
+        except psycopg2.Error:
+            if control_tx:
+                conn.rollback()
+            raise
+    return usuario_nuevo, estudio_nuevo
+
+
+def alta_peliculas(conn, altas, omitir_existentes=False, tam_pagina=1000, control_tx=True):
+    """
+    Inserta muchas películas con sus usuarios y estudios, como alta_pelicula, con
+    execute_values: una sentencia por cada tam_pagina películas, todas en la misma
+    transacción. Los usuarios y los estudios se insertan en orden de clave para que
+    dos lotes que comparten alguno no se bloqueen mutuamente.
+    :param conn: la conexión abierta a la base de datos
+    :param altas: secuencia de tuplas (pelicula, usuario o None, estudio o None)
+    :param omitir_existentes: no insertar las películas cuyo id ya existe, en vez de fallar
+    :param tam_pagina: películas por sentencia
+    :param control_tx: indica si se debe realizar commit/rollback o no; con True la
+                       transacción se repite si hay un interbloqueo
+    :return: diccionario con las películas, usuarios y estudios insertados
+    :raises ValueError: si el usuario o el estudio de alguna no son los de la película
+    """
+    import psycopg2.extras
+    filas = [_fila_alta(*alta) for alta in altas]
+    sql = SQL_ALTA_PELICULAS.format(
+        conflicto="ON CONFLICT (id_Pelicula) DO NOTHING" if omitir_existentes else "")
+
+    def insertar(cursor):
+        totales = {'peliculas': 0, 'usuarios': 0, 'estudios': 0}
+        if not filas:
+            return totales
+        for peliculas, usuarios, estudios in psycopg2.extras.execute_values(
+                cursor, sql, filas, template=PLANTILLA_ALTA, page_size=tam_pagina, fetch=True):
+            totales['peliculas'] += peliculas
+            totales['usuarios'] += usuarios
+            totales['estudios'] += estudios
+        return totales
+
+    fijar_aislamiento(conn, psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED)
+    if control_tx:
+        return _reintentar(conn, insertar)
+    with conn.cursor() as cursor:
+        return insertar(cursor)
+
+
+def obtener_pelicula(conn, id_pelicula, control_tx=True, cache=True):
+    """
+    Devuelve los datos de una película, pasando por cache_peliculas.
+    Si control_tx es False la lectura forma parte de una transacción del llamador
+    y se hace siempre contra la base de datos. Tampoco se usa la caché si conn es de
+    una réplica: lo leído puede ir por detrás de lo escrito y, una vez en la caché,
+    se serviría también a quien pide leer lo que escribió (X-BDA-LSN).
+    :param conn: la conexión abierta a la base de datos
+    :param id_pelicula: el id de la película
+    :param control_tx: indica si se debe realizar commit/rollback o no
+    :param cache: False para leer siempre de la base de datos, p. ej. la versión que se
+                  enviará en una actualización optimista; la caché puede ir por detrás de
+                  lo que escriben otros procesos
+    :return: diccionario con las columnas de la película, o None si no existe
+    """
+    if not control_tx or not cache or leyendo_de_replica():
+        return _leer_pelicula(conn, id_pelicula, control_tx)
+    pelicula = cache_peliculas.leer(id_pelicula, lambda: _leer_pelicula(conn, id_pelicula, control_tx))
+    return None if pelicula is None else dict(pelicula)
+
+
+def _leer_pelicula(conn, id_pelicula, control_tx):
+    import psycopg2.extras
+    fijar_aislamiento(conn, psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED)
+    with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+        try:
+            sentencias.ejecutar(cursor, 'bda_obtener_pelicula', {'c': id_pelicula})
+            row = cursor.fetchone()
+            if control_tx:
+                conn.commit()
+        except psycopg2.Error:
+            if control_tx:
+                conn.rollback()
+            raise
+    return None if row is None else dict(row)
+
+
+def _version_actual(cursor, id_pelicula):
+    """
+    :return: la versión actual de la película, o None si no existe
+    """
+    sentencias.ejecutar(cursor, 'bda_version_pelicula', {'c': id_pelicula})
+    row = cursor.fetchone()
+    return None if row is None else row[0]
+
+
+def modificar_pelicula(conn, id_pelicula, titulo, ano, precio, version=None, control_tx=True):
+    """
+    Actualiza el título, el año y el precio de una película; los que sean None no se
+    cambian. Si se indica la versión leída, la actualización solo se aplica si la
+    película no ha cambiado desde entonces.
+    :param conn: la conexión abierta a la base de datos
+    :param version: versión de la película leída antes (None: actualizar sin comprobar)
+    :param control_tx: indica si se debe realizar commit/rollback o no
+    :return: True si la película existe, False si no
+    :raises ConflictoVersion: si la película está en otra versión
+    """
+    fijar_aislamiento(conn, psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED)
+    params = {'c': id_pelicula, 'm': titulo, 'a': ano, 'p': precio, 'v': version}
+    actual = None
+    with conn.cursor() as cursor:
+        try:
+            if version is None:
+                sentencias.ejecutar(cursor, 'bda_modificar_pelicula', params)
+            else:
+                sentencias.ejecutar(cursor, 'bda_modificar_pelicula_version', params)
+            modificada = cursor.rowcount > 0
+            if not modificada and version is not None:
+                actual = _version_actual(cursor, id_pelicula)
+            if control_tx:
+                conn.commit()
+                cache_peliculas.invalidar(id_pelicula)
+        except psycopg2.Error:
+            if control_tx:
+                conn.rollback()
+            raise
+    if actual is not None:
+        # La copia de la caché puede ser la que tenía la versión vieja
+        cache_peliculas.invalidar(id_pelicula)
+        raise ConflictoVersion(id_pelicula, version, actual)
+    return modificada
+
+
+def modificar_pelicula_optimista(conn, id_pelicula, cambiar, reintentos=None, espera=0.05):
+    """
+    Lee la película y la actualiza en dos transacciones cortas, sin bloquearla entre
+    medias. Si otro usuario la modificó entre la lectura y la escritura, vuelve a leerla
+    y a aplicar cambiar() sobre los datos nuevos, con una espera creciente.
+    :param conn: la conexión abierta a la base de datos
+    :param cambiar: función que recibe el diccionario de la película y devuelve la
+                    tupla (titulo, ano, precio) con los nuevos valores
+    :param reintentos: número máximo de repeticiones (None: REINTENTOS_OPTIMISTAS)
+    :param espera: espera inicial en segundos; se duplica en cada reintento
+    :return: True si la película existe, False si no
+    :raises ConflictoVersion: si sigue habiendo conflicto tras los reintentos
+    """
+    reintentos = REINTENTOS_OPTIMISTAS if reintentos is None else reintentos
+    intento = 0
     while True:
+        pelicula = _leer_pelicula(conn, id_pelicula, True)
+        if pelicula is None:
+            return False
+        titulo, ano, precio = cambiar(pelicula)
         try:
-            id_estudio = long(input("Introduce el id del estudio: "))
-            break
+            return modificar_pelicula(conn, id_pelicula, titulo, ano, precio, version=pelicula['version'])
+        except ConflictoVersion:
+            if intento >= reintentos:
+                raise
+        time.sleep(espera * (2 ** intento) * (0.5 + random.random()))
+        intento += 1
+
+
+def _sql_peliculas_usuario(despues_de, paginada):
+    """
+    Consulta de las películas de un usuario ordenadas por id_Pelicula, a partir de
+    'despues_de' si se indica y limitada a %(n)s filas si es paginada.
+    """
+    sql = """
+        SELECT c.id_Pelicula, c.titulo, c.precio
+        FROM PELICULA c
+        WHERE c.id_Us = %(dni)s"""
+    if despues_de is not None:
+        sql += "\n          AND c.id_Pelicula > %(despues)s"
+    sql += "\n        ORDER BY c.id_Pelicula"
+    if paginada:
+        sql += "\n        LIMIT %(n)s"
+    return sql
+
+
+def pagina_peliculas_usuario(conn, dni, tam_pagina=100, despues_de=None, control_tx=True):
+    """
+    Devuelve una página de las películas de un usuario, paginando por id_Pelicula.
+    :param conn: la conexión abierta a la base de datos
+    :param dni: el DNI del usuario
+    :param tam_pagina: número máximo de películas de la página
+    :param despues_de: marca devuelta por la página anterior (None para la primera)
+    :param control_tx: indica si se debe realizar commit/rollback o no
+    :return: tupla (lista de namedtuples con id_pelicula, titulo y precio,
+             marca de la página siguiente o None si no hay más)
+    """
+    import psycopg2.extras
+    fijar_aislamiento(conn, psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED)
+    with conn.cursor(cursor_factory=psycopg2.extras.NamedTupleCursor) as cursor:
+        try:
+            # Se pide una fila de más para saber si hay página siguiente
+            cursor.execute(_sql_peliculas_usuario(despues_de, True),
+                           {'dni': dni, 'despues': despues_de, 'n': tam_pagina + 1})
+            rows = cursor.fetchall()
+            if control_tx:
+                conn.commit()
+        except psycopg2.Error:
+            if control_tx:
+                conn.rollback()
+            raise
+    if len(rows) > tam_pagina:
+        rows = rows[:tam_pagina]
+        return rows, rows[-1].id_pelicula
+    return rows, None
+
+
+# Contador para los nombres de los cursores del servidor de iter_peliculas_usuario
+_recorridos = itertools.count()
+
+
+def iter_peliculas_usuario(conn, dni, tam_pagina=1000, despues_de=None, limite=None, control_tx=True):
+    """
+    Recorre las películas de un usuario sin cargarlas todas en memoria, con un cursor
+    del servidor que trae 'tam_pagina' filas en cada viaje.
+    :param conn: la conexión abierta a la base de datos
+    :param dni: el DNI del usuario
+    :param tam_pagina: filas que se traen del servidor en cada viaje (itersize)
+    :param despues_de: empezar después de este id_Pelicula
+    :param limite: número máximo de películas (None: todas)
+    :param control_tx: indica si se debe realizar commit/rollback o no
+    :return: generador de namedtuples con id_pelicula, titulo y precio
+    """
+    import psycopg2.extras
+    fijar_aislamiento(conn, psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED)
+    sql = _sql_peliculas_usuario(despues_de, limite is not None)
+    # Nombre único para poder tener varios recorridos abiertos en la misma conexión
+    cursor = conn.cursor(name=f'peliculas_usuario_{next(_recorridos)}',
+                         cursor_factory=psycopg2.extras.NamedTupleCursor)
+    cursor.itersize = tam_pagina
+    try:
+        cursor.execute(sql, {'dni': dni, 'despues': despues_de, 'n': limite})
+        yield from cursor
+        cursor.close()
+        if control_tx:
+            conn.commit()
+    finally:
+        # Si hay un error o se deja de iterar antes de terminar se cierra el cursor y
+        # la transacción
+        if not cursor.closed:
+            cursor.close()
+            if control_tx:
+                conn.rollback()
+
+
+# Texto sobre el que se busca; debe coincidir con la expresión de los índices
+# pelicula_busqueda_trgm_idx (migraciones/003_busqueda.sql) y pelicula_busqueda_knn_idx
+# (migraciones/009_busqueda_knn.sql)
+TEXTO_BUSQUEDA = "lower(c.titulo || ' ' || c.genero)"
+
+
+def _escapar_like(texto):
+    return texto.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def _sql_buscar_peliculas(prefijo, genero, despues_de):
+    """
+    Consulta de búsqueda de películas. Con prefijo, los títulos que empiezan por el
+    texto en orden alfabético; sin él, las películas cuyo título o género se parecen
+    al texto (similitud de trigramas), de más a menos relevante. La relevancia se
+    ordena por la distancia <<-> (1 - word_similarity), que el índice GiST devuelve
+    ya ordenada, así que solo se leen las filas de la página. La clave de orden de
+    cada fila se devuelve en la columna 'orden' para paginar a partir de ella.
+    """
+    if prefijo:
+        sql = """
+        SELECT c.id_Pelicula, c.titulo, c.genero, c.año, c.precio, lower(c.titulo) COLLATE "C" AS orden
+        FROM PELICULA c
+        WHERE lower(c.titulo) COLLATE "C" LIKE %(patron)s"""
+        if despues_de is not None:
+            sql += '\n          AND (lower(c.titulo) COLLATE "C", c.id_Pelicula) > (%(orden)s, %(despues)s)'
+        orden = "orden, c.id_Pelicula"
+    else:
+        sql = f"""
+        SELECT c.id_Pelicula, c.titulo, c.genero, c.año, c.precio,
+               %(texto)s <<-> {TEXTO_BUSQUEDA} AS orden
+        FROM PELICULA c
+        WHERE %(texto)s <%% {TEXTO_BUSQUEDA}"""
+        if despues_de is not None:
+            sql += f"""
+          AND (%(texto)s <<-> {TEXTO_BUSQUEDA} > %(orden)s::real
+               OR (%(texto)s <<-> {TEXTO_BUSQUEDA} = %(orden)s::real
+                   AND c.id_Pelicula > %(despues)s))"""
+        orden = "orden, c.id_Pelicula"
+    if genero is not None:
+        sql += "\n          AND c.genero = %(genero)s"
+    sql += f"\n        ORDER BY {orden}\n        LIMIT %(n)s"
+    return sql
+
+
+def buscar_peliculas(conn, texto, genero=None, prefijo=False, tam_pagina=20, despues_de=None, control_tx=True):
+    """
+    Busca películas por título y género, por relevancia o en modo autocompletado.
+    :param conn: la conexión abierta a la base de datos
+    :param texto: el texto buscado
+    :param genero: limitar la búsqueda a este género (None: todos)
+    :param prefijo: True para buscar los títulos que empiezan por el texto
+    :param tam_pagina: número máximo de películas de la página
+    :param despues_de: marca devuelta por la página anterior (None para la primera)
+    :param control_tx: indica si se debe realizar commit/rollback o no
+    :return: tupla (lista de namedtuples con id_pelicula, titulo, genero, año, precio y
+             orden, marca de la página siguiente o None si no hay más)
+    """
+    import psycopg2.extras
+    texto = texto.strip().lower()
+    if not texto:
+        return [], None
+    params = {'texto': texto, 'patron': _escapar_like(texto) + '%', 'genero': genero, 'n': tam_pagina + 1}
+    if despues_de is not None:
+        params['orden'], params['despues'] = despues_de
+
+    fijar_aislamiento(conn, psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED)
+    with conn.cursor(cursor_factory=psycopg2.extras.NamedTupleCursor) as cursor:
+        try:
+            cursor.execute(_sql_buscar_peliculas(prefijo, genero, despues_de), params)
+            rows = cursor.fetchall()
+            if control_tx:
+                conn.commit()
+        except psycopg2.Error:
+            if control_tx:
+                conn.rollback()
+            raise
+    if len(rows) > tam_pagina:
+        rows = rows[:tam_pagina]
+        return rows, (rows[-1].orden, rows[-1].id_pelicula)
+    return rows, None
+
+
+def borrar_pelicula(conn, id_pelicula, control_tx=True):
+    """
+    Borra una película.
+    :param conn: la conexión abierta a la base de datos
+    :param control_tx: indica si se debe realizar commit/rollback o no
+    :return: True si se borró, False si no existía
+    """
+    fijar_aislamiento(conn, psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED)
+    with conn.cursor() as cursor:
+        try:
+            sentencias.ejecutar(cursor, 'bda_borrar_pelicula', (id_pelicula, ))
+            if control_tx:
+                conn.commit()
+                cache_peliculas.invalidar(id_pelicula)
+        except psycopg2.Error:
+            if control_tx:
+                conn.rollback()
+            raise
+        return cursor.rowcount > 0
+
+
+def rebajar_precio(conn, id_pelicula, porcentaje, version=None, control_tx=True):
+    """
+    Disminuye el precio de una película en un porcentaje, en una transacción SERIALIZABLE.
+    Si se indica la versión leída, la rebaja solo se aplica si la película no ha cambiado.
+    :param conn: la conexión abierta a la base de datos
+    :param porcentaje: porcentaje de rebaja, como máximo 100
+    :param version: versión de la película leída antes (None: rebajar sin comprobar)
+    :param control_tx: indica si se debe realizar commit/rollback o no
+    :return: True si la película existe, False si no
+    :raises ValueError: si el porcentaje es mayor que 100
+    :raises ConflictoVersion: si la película está en otra versión
+    """
+    if porcentaje is not None and porcentaje > 100:
+        raise ValueError("El decremento no puede ser mayor que 100%.")
+    fijar_aislamiento(conn, psycopg2.extensions.ISOLATION_LEVEL_SERIALIZABLE)
+    params = {'m': id_pelicula, 'd': porcentaje, 'v': version}
+    actual = None
+    with conn.cursor() as cursor:
+        try:
+            if version is None:
+                sentencias.ejecutar(cursor, 'bda_rebajar_precio', params)
+            else:
+                sentencias.ejecutar(cursor, 'bda_rebajar_precio_version', params)
+            modificada = cursor.rowcount > 0
+            if not modificada and version is not None:
+                actual = _version_actual(cursor, id_pelicula)
+            if control_tx:
+                conn.commit()
+                cache_peliculas.invalidar(id_pelicula)
+        except psycopg2.Error:
+            if control_tx:
+                conn.rollback()
+            raise
+    if actual is not None:
+        # La copia de la caché puede ser la que tenía la versión vieja
+        cache_peliculas.invalidar(id_pelicula)
+        raise ConflictoVersion(id_pelicula, version, actual)
+    return modificada
+
+
+def _aplicar_rebaja(cursor, id_pelicula, porcentaje):
+    """
+    Rebaja el precio de una película dentro de la transacción en curso del cursor.
+    :return: True si la película existe, False si no
+    """
+    sentencias.ejecutar(cursor, 'bda_rebajar_precio', {'m': id_pelicula, 'd': porcentaje})
+    return cursor.rowcount > 0
+
+
+def _aplicar_valoracion(cursor, id_pelicula, dni, valoracion):
+    """
+    Guarda una valoración y actualiza el resumen de la película, dentro de la
+    transacción en curso del cursor.
+    :return: True si la película existe, False si no
+    """
+    params = {'p': id_pelicula, 'u': dni, 'v': valoracion}
+    sentencias.ejecutar(cursor, 'bda_crear_resumen', params)
+    sentencias.ejecutar(cursor, 'bda_bloquear_resumen', params)
+    if cursor.fetchone() is None:
+        return False
+
+    sentencias.ejecutar(cursor, 'bda_valoracion_anterior', params)
+    fila = cursor.fetchone()
+    anterior = None if fila is None else fila[0]
+    sentencias.ejecutar(cursor, 'bda_guardar_valoracion', params)
+    if anterior is None:
+        sentencias.ejecutar(cursor, 'bda_sumar_resumen', params)
+    elif anterior != valoracion:
+        sentencias.ejecutar(cursor, 'bda_cambiar_resumen', dict(params, a=anterior))
+    return True
+
+
+def guardar_valoracion(conn, id_pelicula, dni, valoracion, control_tx=True):
+    """
+    Guarda la valoración (1-5) de un usuario para una película, o cambia la que ya
+    tuviera, y actualiza en la misma transacción el resumen de la película
+    (número, suma, media e histograma de valoraciones).
+    :param conn: la conexión abierta a la base de datos
+    :param id_pelicula: el id de la película
+    :param dni: el DNI del usuario que valora
+    :param valoracion: la valoración, de 1 a 5
+    :param control_tx: indica si se debe realizar commit/rollback o no
+    :return: True si la película existe, False si no
+    :raises ValueError: si la valoración no está entre 1 y 5
+    """
+    if valoracion < 1 or valoracion > 5:
+        raise ValueError("La valoración debe estar entre 1 y 5.")
+    fijar_aislamiento(conn, psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED)
+    with conn.cursor() as cursor:
+        try:
+            if not _aplicar_valoracion(cursor, id_pelicula, dni, valoracion):
+                if control_tx:
+                    conn.rollback()
+                return False
+            if control_tx:
+                conn.commit()
+                cache_peliculas.invalidar(id_pelicula)
+        except psycopg2.Error:
+            if control_tx:
+                conn.rollback()
+            raise
+    return True
+
+
+def mejor_valoradas(conn, n=10, minimo=1, control_tx=True):
+    """
+    Devuelve las películas con mejor valoración media, leyendo solo el resumen.
+    :param conn: la conexión abierta a la base de datos
+    :param n: número de películas
+    :param minimo: número mínimo de valoraciones para entrar en la clasificación
+    :param control_tx: indica si se debe realizar commit/rollback o no
+    :return: lista de diccionarios con id_pelicula, titulo, media, num e histograma
+    """
+    import psycopg2.extras
+    fijar_aislamiento(conn, psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED)
+    with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+        try:
+            sentencias.ejecutar(cursor, 'bda_mejor_valoradas', {'n': n, 'minimo': minimo})
+            rows = cursor.fetchall()
+            if control_tx:
+                conn.commit()
+        except psycopg2.Error:
+            if control_tx:
+                conn.rollback()
+            raise
+    return [dict(row) for row in rows]
+
+
+def _filtro_peliculas(genero=None, id_estudio=None, desde=None, hasta=None, ids=None):
+    """
+    Construye la condición WHERE sobre PELICULA para los filtros indicados (combinados con AND).
+    :return: tupla (condición SQL, diccionario de parámetros)
+    """
+    condiciones = []
+    params = {}
+    if genero is not None:
+        condiciones.append("genero = %(genero)s")
+        params['genero'] = genero
+    if id_estudio is not None:
+        condiciones.append("id_Est = %(estudio)s")
+        params['estudio'] = id_estudio
+    if desde is not None:
+        condiciones.append("año >= %(desde)s")
+        params['desde'] = datetime(desde, 1, 1)
+    if hasta is not None:
+        condiciones.append("año < %(hasta)s")
+        params['hasta'] = datetime(hasta + 1, 1, 1)
+    if ids is not None:
+        condiciones.append("id_Pelicula = ANY(%(ids)s)")
+        params['ids'] = list(ids)
+    return (" AND ".join(condiciones) if condiciones else "TRUE"), params
+
+
+def rebajar_precios(conn, porcentaje, genero=None, id_estudio=None, desde=None, hasta=None, ids=None,
+                    tam_lote=None, reintentos=5):
+    """
+    Rebaja un porcentaje el precio de todas las películas que cumplan el filtro,
+    sin interacción con el usuario dentro de la transacción. Los filtros que se
+    indiquen se combinan con AND; sin filtros se rebaja todo el catálogo.
+    Sin tam_lote se hace en una sola sentencia UPDATE; con tam_lote se recorren las
+    películas por id_Pelicula en lotes de ese tamaño, cada uno en su transacción.
+    Cada transacción es SERIALIZABLE y se repite si hay conflicto de serialización.
+    :param conn: la conexión abierta a la base de datos
+    :param porcentaje: porcentaje de rebaja, como máximo 100
+    :param genero: solo películas de este género
+    :param id_estudio: solo películas de este estudio
+    :param desde: solo películas de este año o posteriores
+    :param hasta: solo películas de este año o anteriores
+    :param ids: solo películas con estos id_Pelicula
+    :param tam_lote: número de películas por transacción (None: todas en una)
+    :param reintentos: reintentos por transacción si hay conflicto de serialización
+    :return: número de películas modificadas
+    :raises ValueError: si el porcentaje es mayor que 100
+    """
+    if porcentaje > 100:
+        raise ValueError("El decremento no puede ser mayor que 100%.")
+    fijar_aislamiento(conn, psycopg2.extensions.ISOLATION_LEVEL_SERIALIZABLE)
+
+    filtro, params = _filtro_peliculas(genero, id_estudio, desde, hasta, ids)
+    params['d'] = porcentaje
+
+    if tam_lote is None:
+        def todo(cursor):
+            cursor.execute(SQL_REBAJAR_PRECIOS.format(filtro=filtro), params)
+            return [row[0] for row in cursor.fetchall()]
+        modificadas = _reintentar(conn, todo, reintentos)
+        for id_pelicula in modificadas:
+            cache_peliculas.invalidar(id_pelicula)
+        return len(modificadas)
+
+    total = 0
+    ultimo = None
+    while True:
+        def lote(cursor):
+            desde_id = "" if ultimo is None else "AND id_Pelicula > %(ultimo)s"
+            cursor.execute(SQL_LOTE_PRECIOS.format(filtro=filtro, desde_id=desde_id),
+                           dict(params, ultimo=ultimo, lote=tam_lote))
+            lote_ids = [row[0] for row in cursor.fetchall()]
+            if not lote_ids:
+                return lote_ids, []
+            cursor.execute(SQL_REBAJAR_LOTE.format(filtro=filtro), dict(params, lote_ids=lote_ids))
+            return lote_ids, [row[0] for row in cursor.fetchall()]
+
+        lote_ids, modificadas = _reintentar(conn, lote, reintentos)
+        for id_pelicula in modificadas:
+            cache_peliculas.invalidar(id_pelicula)
+        total += len(modificadas)
+        if len(lote_ids) < tam_lote:
+            return total
+        ultimo = lote_ids[-1]
+
+
+## ------------------------------------------------------------
+## Formularios: piden los datos por teclado y llaman al acceso a datos.
+## ------------------------------------------------------------
+def pedir_id(mensaje):
+    """
+    Pide un identificador numérico hasta que se introduzca uno válido.
+    """
+    while True:
+        try:
+            return int(input(mensaje))
         except ValueError:
             print("Error: Por favor, introduce un valor numérico para el identificador.")
 
+
+## ------------------------------------------------------------
+def insert_estudio(conn):
+    """
+    Pide los datos de un estudio y lo inserta en la tabla 'ESTUDIO'
+    :param conn: la conexión abierta a la base de datos
+    :return: nada
+    """
+    id_estudio = pedir_id("Introduce el id del estudio: ")
+
     while True:
         nombre = input("Introduce el nombre del estudio: ")
         if len(nombre) <= 20:
@@ -84,32 +1144,24 @@ def insert_estudio(conn):
         else:
             print("Error: EL pais debe tener como máximo 20 caracteres.")
 
-    sql = "INSERT INTO ESTUDIO (id_Estudio, nombreE, paisOrigen) " \
-          "VALUES (%(p)s, %(n)s, %(a)s);"
-    with conn.cursor() as cursor:
-        try:
-            cursor.execute(sql, {'p': id_estudio, 'n': nombre, 'a': pais})
-            conn.commit()
-            print("Estudio añadido.")
-        except psycopg2.Error as e:
-            if e.pgcode == psycopg2.errorcodes.UNDEFINED_TABLE:
-                print("La tabla ESTUDIO no existe. No se puede añadir el estudio.")
-            elif e.pgcode == psycopg2.errorcodes.UNIQUE_VIOLATION:
-                print(f"El id {id_estudio} ya existe, no se añade el estudio.")
-
-
-            elif e.pgcode == psycopg2.errorcodes.NOT_NULL_VIOLATION:
-                if 'nombre' in e.pgerror:
-                    print("El nombre del estudio es necesario.")
-                elif 'pais' in e.pgerror:
-                    print("El pais del estudio es necesario.")
-                elif e.pgcode == '42501':
-                    print("Error de permisos: No tienes permiso para acceder a la tabla 'estudio'."
-                          "-- Conceder permisos de INSERT a un usuario sobre la tabla 'estudio': GRANT INSERT ON TABLE estudio TO username;")
-
+    try:
+        crear_estudio(conn, id_estudio, nombre, pais)
+        print("Estudio añadido.")
+    except psycopg2.Error as e:
+        if e.pgcode == psycopg2.errorcodes.UNDEFINED_TABLE:
+            print("La tabla ESTUDIO no existe. No se puede añadir el estudio.")
+        elif e.pgcode == psycopg2.errorcodes.UNIQUE_VIOLATION:
+            print(f"El id {id_estudio} ya existe, no se añade el estudio.")
+        elif e.pgcode == '42501':
+            print("Error de permisos: No tienes permiso para acceder a la tabla 'estudio'."
+                  "-- Conceder permisos de INSERT a un usuario sobre la tabla 'estudio': GRANT INSERT ON TABLE estudio TO username;")
+        elif e.pgcode == psycopg2.errorcodes.NOT_NULL_VIOLATION:
+            if 'nombre' in e.pgerror:
+                print("El nombre del estudio es necesario.")
             else:
-                print(f"Error {e.pgcode}: {e.pgerror}")
-            conn.rollback()
+                print("El pais del estudio es necesario.")
+        else:
+            print(f"Error {e.pgcode}: {e.pgerror}")
 
 ## ------------------------------------------------------------
 def insert_usuario(conn):
@@ -118,8 +1170,6 @@ def insert_usuario(conn):
     :param conn: la conexión abierta a la base de datos
     :return: nada
     """
-    conn.isolation_level = psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED
-
     while True:
         sDNI = input("DNI del usuario: ")
         if es_dni_valido(sDNI):
@@ -153,39 +1203,34 @@ def insert_usuario(conn):
         except ValueError:
             print("Error: Por favor, introduce un valor numérico para el teléfono.")
 
-    sql = "INSERT INTO USUARIO (DNI, nombre, apellido, telefono) " \
-          "VALUES (%(p)s, %(n)s, %(a)s, %(t)s);"
-    with conn.cursor() as cursor:
-        try:
-            cursor.execute(sql, {'p': DNI, 'n': nombre, 'a': apellido, 't': telefono})
-            conn.commit()
-            print("Usuario añadido.")
-        except psycopg2.Error as e:
-            if e.pgcode == psycopg2.errorcodes.UNDEFINED_TABLE:
-                print("La tabla USUARIO no existe. No se puede añadir el usuario.")
-            elif e.pgcode == psycopg2.errorcodes.UNIQUE_VIOLATION:
-                print(f"El DNI {DNI} ya existe, no se añade el usuario.")
-            elif e.pgcode == '42501':
-                print("Error de permisos: No tienes permiso para acceder a la tabla 'usuario'."
-                      "-- Conceder permisos de INSERT a un usuario sobre la tabla 'usuario': GRANT INSERT ON TABLE usuario TO username;")
-            elif e.pgcode == psycopg2.errorcodes.NOT_NULL_VIOLATION:
-                if 'nombre' in e.pgerror:
-                    print("El nombre del usuario es necesario.")
-                elif 'apellido' in e.pgerror:
-                    print("El primer apellido del usuario es necesario.")
-                else:
-                    print("El teléfono es necesario.")
+    try:
+        crear_usuario(conn, DNI, nombre, apellido, telefono)
+        print("Usuario añadido.")
+    except psycopg2.Error as e:
+        if e.pgcode == psycopg2.errorcodes.UNDEFINED_TABLE:
+            print("La tabla USUARIO no existe. No se puede añadir el usuario.")
+        elif e.pgcode == psycopg2.errorcodes.UNIQUE_VIOLATION:
+            print(f"El DNI {DNI} ya existe, no se añade el usuario.")
+        elif e.pgcode == '42501':
+            print("Error de permisos: No tienes permiso para acceder a la tabla 'usuario'."
+                  "-- Conceder permisos de INSERT a un usuario sobre la tabla 'usuario': GRANT INSERT ON TABLE usuario TO username;")
+        elif e.pgcode == psycopg2.errorcodes.NOT_NULL_VIOLATION:
+            if 'nombre' in e.pgerror:
+                print("El nombre del usuario es necesario.")
+            elif 'apellido' in e.pgerror:
+                print("El primer apellido del usuario es necesario.")
             else:
-                print(f"Error {e.pgcode}: {e.pgerror}")
-            conn.rollback()
+                print("El teléfono es necesario.")
+        else:
+            print(f"Error {e.pgcode}: {e.pgerror}")
 
+## ------------------------------------------------------------
 def insert_pelicula(conn):
     """
     Pide los datos de una película y lo inserta en la tabla 'PELÍCULA'
     :param conn: la conexión abierta a la base de datos
     :return: nada
     """
-    conn.isolation_level = psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED
     while True:
         sDNI = input("DNI del usuario: ")
         if es_dni_valido(sDNI):
@@ -195,20 +1240,8 @@ def insert_pelicula(conn):
             print(
                 "Error: El DNI debe tener una longitud de 9 caracteres o has introducido un DNI erroneo. Y es obligatorio")
 
-    while True:
-        try:
-            id_Est = long(input("Introduce el id del estudio: "))
-            break
-        except ValueError:
-            print("Error: Por favor, introduce un valor numérico para el identificador.")
-
-
-    while True:
-        try:
-            id_pelicula = long(input("Introduce el id de la película: "))
-            break
-        except ValueError:
-            print("Error: Por favor, introduce un valor numérico para el identificador.")
+    id_Est = pedir_id("Introduce el id del estudio: ")
+    id_pelicula = pedir_id("Introduce el id de la película: ")
 
     while True:
         titulo = input("Introduce el titulo de la película: ")
@@ -232,9 +1265,9 @@ def insert_pelicula(conn):
             print("Error: Por favor, introduce un valor numérico para la duración.")
 
     while True:
-        ano = input("Año (formato xx-xx-xxxx): ")
+        sano = input("Año (formato xx-xx-xxxx): ")
         try:
-            datetime.strptime(ano, '%d-%m-%Y')
+            ano = datetime.strptime(sano, '%d-%m-%Y')
             break
         except ValueError:
             print("Error: El año debe tener el formato dd-mm-yyyy.")
@@ -246,101 +1279,68 @@ def insert_pelicula(conn):
         else:
             print("Error: EL género debe tener como máximo 20 caracteres.")
 
-
-    sql = "INSERT INTO PELICULA (id_Us, id_Est, id_Pelicula, precio, titulo, duracion_Minutos, año, genero) " \
-          "VALUES (%(u)s, %(e)s, %(p)s, %(pr)s, %(t)s, %(d)s, %(a)s, %(g)s);"
-    with conn.cursor() as cursor:
-        try:
-            cursor.execute(sql, {'u': id_Us, 'e': id_Est, 'p': id_pelicula, 'pr': precio, 't': titulo, 'd': duracion_minutos,
-                                 'a': ano, 'g': genero})
-            conn.commit()
-            print("Película añadida.")
-        except psycopg2.Error as e:
-            if e.pgcode == psycopg2.errorcodes.UNDEFINED_TABLE:
-                print("La tabla PELICULA no existe. No se puede añadir la película.")
-            elif e.pgcode == psycopg2.errorcodes.UNIQUE_VIOLATION:
-                print(f"El id de película {id_pelicula} ya existe, no se añade la película")
-            elif e.pgcode == psycopg2.errorcodes.FOREIGN_KEY_VIOLATION:
-                print(f"Error de clave externa: El DNI o el estudio, no existen")
-            elif e.pgcode == '42501':
-                print("Error de permisos: No tienes permiso para acceder a la tabla 'pelicula'."
-                      "-- Conceder permisos de INSERT a un usuario sobre la tabla 'pelicula': GRANT INSERT ON TABLE usuario TO username;")
-
-            elif e.pgcode == psycopg2.errorcodes.NOT_NULL_VIOLATION:
-                if 'id_Us' in e.pgerror:
-                    print("El DNI del usuario es necesario.")
-                elif 'id_Est' in e.pgerror:
-                    print("El ID del estudio es necesario.")
-                else:
-                    print("El precio es necesario.")
-
+    try:
+        crear_pelicula(conn, id_Us, id_Est, id_pelicula, precio, titulo, duracion_minutos, ano, genero)
+        print("Película añadida.")
+    except psycopg2.Error as e:
+        if e.pgcode == psycopg2.errorcodes.UNDEFINED_TABLE:
+            print("La tabla PELICULA no existe. No se puede añadir la película.")
+        elif e.pgcode == psycopg2.errorcodes.UNIQUE_VIOLATION:
+            print(f"El id de película {id_pelicula} ya existe, no se añade la película")
+        elif e.pgcode == psycopg2.errorcodes.FOREIGN_KEY_VIOLATION:
+            print(f"Error de clave externa: El DNI o el estudio, no existen")
+        elif e.pgcode == '42501':
+            print("Error de permisos: No tienes permiso para acceder a la tabla 'pelicula'."
+                  "-- Conceder permisos de INSERT a un usuario sobre la tabla 'pelicula': GRANT INSERT ON TABLE usuario TO username;")
+
+        elif e.pgcode == psycopg2.errorcodes.NOT_NULL_VIOLATION:
+            if 'id_Us' in e.pgerror:
+                print("El DNI del usuario es necesario.")
+            elif 'id_Est' in e.pgerror:
+                print("El ID del estudio es necesario.")
             else:
-                print(f"Error {e.pgcode}: {e.pgerror}")
-            conn.rollback()
+                print("El precio es necesario.")
+
+        else:
+            print(f"Error {e.pgcode}: {e.pgerror}")
 
 ## ------------------------------------------------------------
-def show_pelicula(conn, control_tx=True):
+def show_pelicula(conn, control_tx=True, cache=True):
     """
     Solicita al usuario el id de una pelicula y muestra los detalles de la  mismo,
     incluyendo la valoración si está presente.
     :param conn: la conexión abierta a la base de datos
     :param control_tx: indica si se debe realizar commit/rollback o no
-    :return: el código del coche mostrado, o None si no existe
-    """
-    conn.isolation_level = psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED
-    while True:
-        try:
-            id_pelicula = long(input("Introduce el id de la pelicula: "))
-            break
-        except ValueError:
-            print("Error: Por favor, introduce un valor numérico para el identificador.")
-
-    sql = """
-        SELECT c.id_Us, c.id_Est, c.precio, c.titulo, c.duracion_Minutos, c.año, c.genero,
-               COALESCE(c.valoracion::text, 'Sin valoración') AS valoracion
-        FROM PELICULA c
-        WHERE c.id_pelicula = %(c)s
-    """
-
-    retval = None
-    with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
-        try:
-            cursor.execute(sql, {'c': id_pelicula})
-            row = cursor.fetchone()
-            if row is None:
-                print(f"La pelicula con id {id_pelicula} no existe.")
-            else:
-                usuario = row.get('id_us')
-                estudio = row.get('id_est')
-                precio = row['precio']
-                titulo = row['titulo']
-                minutos = row['duracion_minutos']
-                ano = row['año']
-                genero = row['genero']
-                valoracion = row['valoracion']
-
-                print(f"Id de la película: {id_pelicula}")
-                print(f"Usuario: {usuario}")
-                print(f"Estudio: {estudio}")
-                print(f"Precio: {precio}")
-                print(f"Titulo: {titulo}")
-                print(f"Duracion en minutos: {minutos}")
-                print(f"Año: {ano}")
-                print(f"Género: {genero}")
-                print(f"Valoración de la película: {valoracion}")
-
-                retval = id_pelicula
+    :param cache: False para leerla de la base de datos y no de cache_peliculas
+    :return: el diccionario de la película mostrada, o None si no existe
+    """
+    id_pelicula = pedir_id("Introduce el id de la pelicula: ")
 
-            if control_tx:
-                conn.commit()
-        except psycopg2.Error as e:
-            if e.pgcode == '42501':
-                print("Error de permisos: No tienes permiso para acceder a la tabla 'pelicula'."
-                  "-- Conceder permisos de SELECT a un usuario sobre la tabla 'pelicula': GRANT SELECT ON TABLE usuario TO username;")
-            else:
-                print(f"Error {e.pgcode}: {e.pgerror}")
-            if control_tx:
-                conn.rollback()
+    retval = None
+    try:
+        pelicula = obtener_pelicula(conn, id_pelicula, control_tx, cache)
+        if pelicula is None:
+            print(f"La pelicula con id {id_pelicula} no existe.")
+        else:
+            valoracion = pelicula['valoracion']
+            print(f"Id de la película: {id_pelicula}")
+            print(f"Usuario: {pelicula['id_us']}")
+            print(f"Estudio: {pelicula['id_est']}")
+            print(f"Precio: {pelicula['precio']}")
+            print(f"Titulo: {pelicula['titulo']}")
+            print(f"Duracion en minutos: {pelicula['duracion_minutos']}")
+            print(f"Año: {pelicula['año']}")
+            print(f"Género: {pelicula['genero']}")
+            print(f"Valoración de la película: {'Sin valoración' if valoracion is None else valoracion}")
+            print(f"Número de valoraciones: {pelicula['num_valoraciones']}")
+
+            retval = pelicula
+    except psycopg2.Error as e:
+        if e.pgcode == '42501':
+            print("Error de permisos: No tienes permiso para acceder a la tabla 'pelicula'."
+              "-- Conceder permisos de SELECT a un usuario sobre la tabla 'pelicula': GRANT SELECT ON TABLE usuario TO username;")
+        else:
+            print(f"Error {e.pgcode}: {e.pgerror}")
     return retval
 
 
@@ -348,20 +1348,23 @@ def show_pelicula(conn, control_tx=True):
 def update_pelicula(conn):
     """
     Chama a show_película para pedir un código e mostrar os detalles dunha pelicula,
-    pide novos datos e actualiza a película
+    pide novos datos e actualiza a película.
+    A lectura e a escritura son transaccións curtas separadas: mentres se piden os
+    datos non se bloquea a película, e se outro usuario a modificou entrementres
+    non se sobrescriben os seus cambios.
     :param conn: a conexión aberta á bd
     :return: Nada
     """
-    conn.isolation_level = psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED
-    cod = show_pelicula(conn, control_tx=False)
-    if cod is None:
-        conn.rollback()
+    # Sin caché: la versión leída tiene que ser la actual para que la escritura no choque
+    pelicula = show_pelicula(conn, cache=False)
+    if pelicula is None:
         return
+    cod = pelicula['id_pelicula']
 
     stitulo = input("Título: ")
     titulo = None if stitulo == "" else stitulo
 
-    
+
     while True:
         sano = input("Año: ")
         if sano == "":
@@ -373,7 +1376,7 @@ def update_pelicula(conn):
         except ValueError:
             print("Error: El año debe tener el formato dd-mm-yyyy.")
 
-    
+
     while True:
         sprecio = input("Precio: ")
         if sprecio == "":
@@ -385,36 +1388,32 @@ def update_pelicula(conn):
         except ValueError:
             print("Error: El precio debe ser un número válido.")
 
-    sql = """
-            UPDATE PELICULA
-            SET titulo = %(m)s,
-                año = %(a)s,
-                precio = %(p)s
-            WHERE id_Pelicula = %(c)s
-        """
-    with conn.cursor() as cursor:
-        try:
-            cursor.execute(sql, {'c': cod, 'm': titulo, 'a': ano, 'p': precio})
-            input("Pulsa ENTER")
-            conn.commit()
+    try:
+        if modificar_pelicula(conn, cod, titulo, ano, precio, version=pelicula['version']):
             print("Película modificada.")
-        except psycopg2.Error as e:
-            if e.pgcode == psycopg2.errorcodes.CHECK_VIOLATION:
-                print("El precio debe ser positivo, no se modifica el coche")
-            elif e.pgcode == psycopg2.errorcodes.NUMERIC_VALUE_OUT_OF_RANGE:
-                print("El precio máximo son 999999.99")
-            elif e.pgcode == '42501':
-                print("Error de permisos: No tienes permiso para acceder a la tabla 'pelicula'."
-                      "-- Conceder permisos de SELECT a un usuario sobre la tabla 'pelicula': GRANT UPDATE ON TABLE usuario TO username;")
-
-            elif e.pgcode == psycopg2.errorcodes.NOT_NULL_VIOLATION:
-                if 'modelo' in e.pgerror:
-                    print("El título de la película es necesario.")
-                else:
-                    print("El año de la película es necesario.")
+        else:
+            print(f"La pelicula con id {cod} no existe.")
+    except ConflictoVersion:
+        print("No se modifica la película porque otro usuario la modificó mientras tanto. "
+              "Vuelve a consultarla e inténtalo de nuevo.")
+    except psycopg2.Error as e:
+        if e.pgcode == psycopg2.errorcodes.CHECK_VIOLATION:
+            print("El precio debe ser positivo, no se modifica el coche")
+        elif e.pgcode == psycopg2.errorcodes.NUMERIC_VALUE_OUT_OF_RANGE:
+            print("El precio máximo son 999999.99")
+        elif e.pgcode == '42501':
+            print("Error de permisos: No tienes permiso para acceder a la tabla 'pelicula'."
+                  "-- Conceder permisos de SELECT a un usuario sobre la tabla 'pelicula': GRANT UPDATE ON TABLE usuario TO username;")
+
+        elif e.pgcode == psycopg2.errorcodes.NOT_NULL_VIOLATION:
+            if 'titulo' in e.pgerror:
+                print("El título de la película es necesario.")
+            elif 'precio' in e.pgerror:
+                print("El precio de la película es necesario.")
             else:
-                print(f"Error {e.pgcode}: {e.pgerror}")
-            conn.rollback()
+                print("El año de la película es necesario.")
+        else:
+            print(f"Error {e.pgcode}: {e.pgerror}")
 
 ## ------------------------------------------------------------
 
@@ -425,7 +1424,6 @@ def show_peliculas_usuario(conn, control_tx=True):
     :param control_tx: Indica si se debe realizar commit/rollback o no.
     :return: Nada.
     """
-    conn.isolation_level = psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED
     while True:
         sDNI = input("DNI del usuario: ")
         if es_dni_valido(sDNI):
@@ -435,32 +1433,17 @@ def show_peliculas_usuario(conn, control_tx=True):
             print(
                 "Error: El DNI debe tener una longitud de 9 caracteres o has introducido un DNI erroneo. Y es obligatorio")
 
-    sql = """
-        SELECT c.id_Pelicula, c.titulo, c.precio
-        FROM PELICULA c
-        INNER JOIN usuario p ON c.id_Us = p.DNI
-        WHERE p.DNI = %(dni)s
-    """
-
-    with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
-        try:
-            cursor.execute(sql, {'dni': dni})
-            rows = cursor.fetchall()
-            if not rows:
-                print(f"El usuario con dni {dni} no tiene películas registradas .")
-            else:
+    try:
+        vacio = True
+        for row in iter_peliculas_usuario(conn, dni, control_tx=control_tx):
+            if vacio:
                 print("Peliculas del usuario:")
-                for row in rows:
-                    id_pelicula = row['id_pelicula']
-                    titulo = row['titulo']
-                    precio = row['precio']
-                    print(f"Id_pelicula: {id_pelicula}, titulo: {titulo}, Precio: {precio}")
-            if control_tx:
-                conn.commit()
-        except psycopg2.Error as e:
-            print(f"Error {e.pgcode}: {e.pgerror}")
-            if control_tx:
-                conn.rollback()
+                vacio = False
+            print(f"Id_pelicula: {row.id_pelicula}, titulo: {row.titulo}, Precio: {row.precio}")
+        if vacio:
+            print(f"El usuario con dni {dni} no tiene películas registradas .")
+    except psycopg2.Error as e:
+        print(f"Error {e.pgcode}: {e.pgerror}")
 ## ------------------------------------------------------------
 def delete_pelicula(conn):
     """
@@ -468,40 +1451,29 @@ def delete_pelicula(conn):
     :param conn: La conexión abierta a la base de datos.
     :return: Nada.
     """
-    conn.isolation_level = psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED
-    matricula = input("Introduce el id de la película a borrar: ")
-
-    sql = "DELETE FROM PELICULA WHERE id_Pelicula = %s"
+    id_pelicula = pedir_id("Introduce el id de la película a borrar: ")
 
-    with conn.cursor() as cursor:
-        try:
-            cursor.execute(sql, (matricula, ))
-            conn.commit()
-            if cursor.rowcount == 0:
-                print("La película no existe.")
-            else:
-                print("Película eliminada.")
-        except psycopg2.Error as e:
-            if e.pgcode == '42501':
-                print("Error de permisos: No tienes permiso para acceder a la tabla 'pelicula'."
-                  "-- Conceder permisos de SELECT a un usuario sobre la tabla 'pelicula': GRANT DELETE ON TABLE usuario TO username;")
-            else:
-                print(f"Error {e.pgcode}: {e.pgerror}")
-            conn.rollback()
+    try:
+        if borrar_pelicula(conn, id_pelicula):
+            print("Película eliminada.")
+        else:
+            print("La película no existe.")
+    except psycopg2.Error as e:
+        if e.pgcode == '42501':
+            print("Error de permisos: No tienes permiso para acceder a la tabla 'pelicula'."
+              "-- Conceder permisos de SELECT a un usuario sobre la tabla 'pelicula': GRANT DELETE ON TABLE usuario TO username;")
+        else:
+            print(f"Error {e.pgcode}: {e.pgerror}")
 ## ------------------------------------------------------------
 def decrease_price(conn):
     """
-    Llama a show_row para pedir un id y mostrar los detalles de una película,
-    pide el decremento del precio y actualiza la película.
+    Pide un id y el porcentaje de rebaja y disminuye el precio de la película,
+    esperando confirmación. La confirmación se pide fuera de la transacción; la rebaja
+    solo se aplica si la película sigue como estaba al mostrar el nuevo precio.
     :param conn: La conexión abierta a la base de datos.
     :return: Nada.
     """
-    conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_SERIALIZABLE)
-
-    id_pelicula = input("Introduce el id de la película: ")
-    if not id_pelicula:
-        print("id no válido.")
-        return
+    id_pelicula = pedir_id("Introduce el id de la película: ")
     while True:
         sdecr = input("Decremento de precio (porcentaje): ")
         try:
@@ -513,35 +1485,37 @@ def decrease_price(conn):
         except ValueError:
             print("El valor introducido no es válido, por favor introduce un número decimal.")
 
-    sql = """
-        UPDATE PELICULA
-        SET precio = precio - precio * %(d)s / 100
-        WHERE id_Pelicula = %(m)s
-    """
-
-    with conn.cursor() as cursor:
-        try:
-            cursor.execute(sql, {'m': id_pelicula, 'd': decr})
-            if cursor.rowcount == 0:
-                print("El id no existe.")
-            else:
-                input("Pulsa ENTER para continuar")
-                conn.commit()
-                print("Precio modificado.")
-        except psycopg2.Error as e:
-            if e.pgcode == psycopg2.errorcodes.CHECK_VIOLATION:
-                print("El precio debe ser positivo, no se modifica la película.")
-            elif e.pgcode == psycopg2.errorcodes.NUMERIC_VALUE_OUT_OF_RANGE:
-                print("El precio máximo es 999.99.")
-            elif e.pgcode == psycopg2.errorcodes.SERIALIZATION_FAILURE:
-                print("No se puede modificar el precio porque otro usuario lo modificó.")
-            elif e.pgcode == '42501':
-                print("Error de permisos: No tienes permiso para acceder a la tabla 'pelicula'."
-                 "-- Conceder permisos de SELECT a un usuario sobre la tabla 'pelicula': GRANT UPDATE ON TABLE usuario TO username;")
+    try:
+        pelicula = obtener_pelicula(conn, id_pelicula, cache=False)
+        if pelicula is None:
+            print("El id no existe.")
+            return
+        if decr is not None:
+            nuevo = pelicula['precio'] - pelicula['precio'] * Decimal(str(decr)) / 100
+            print(f"Precio actual: {pelicula['precio']}, nuevo precio: {nuevo:.2f}")
+        input("Pulsa ENTER para continuar")
+        if cola_escritura is not None and decr is not None:
+            cola_escritura.rebajar(id_pelicula, decr)
+            print("Rebaja registrada; se aplicará en unos instantes.")
+        elif rebajar_precio(conn, id_pelicula, decr, version=pelicula['version']):
+            print("Precio modificado.")
+        else:
+            print("El id no existe.")
+    except ConflictoVersion:
+        print("No se puede modificar el precio porque otro usuario lo modificó.")
+    except psycopg2.Error as e:
+        if e.pgcode == psycopg2.errorcodes.CHECK_VIOLATION:
+            print("El precio debe ser positivo, no se modifica la película.")
+        elif e.pgcode == psycopg2.errorcodes.NUMERIC_VALUE_OUT_OF_RANGE:
+            print("El precio máximo es 999.99.")
+        elif e.pgcode == psycopg2.errorcodes.SERIALIZATION_FAILURE:
+            print("No se puede modificar el precio porque otro usuario lo modificó.")
+        elif e.pgcode == '42501':
+            print("Error de permisos: No tienes permiso para acceder a la tabla 'pelicula'."
+             "-- Conceder permisos de SELECT a un usuario sobre la tabla 'pelicula': GRANT UPDATE ON TABLE usuario TO username;")
 
-            else:
-                print(f"Error {e.pgcode}: {e.pgerror}")
-            conn.rollback()
+        else:
+            print(f"Error {e.pgcode}: {e.pgerror}")
 
 ## ------------------------------------------------------------
 def valorar_pelicula(conn):
@@ -550,57 +1524,488 @@ def valorar_pelicula(conn):
     :param conn: la conexión abierta a la base de datos
     :return: Nada
     """
-    select_query = """
-        SELECT id_Pelicula, titulo
-        FROM PELICULA
-        WHERE id_Pelicula = %(id_pelicula)s;
+    id_pelicula = pedir_id("Introduce el id de la pelicula: ")
+    while True:
+        dni = input("DNI del usuario que valora: ")
+        if es_dni_valido(dni):
+            break
+        print("Error: El DNI debe tener una longitud de 9 caracteres o has introducido un DNI erroneo. Y es obligatorio")
+
+    try:
+        pelicula = obtener_pelicula(conn, id_pelicula)
+        if pelicula is None:
+            print(f"No se encontró una película con id:{id_pelicula}.")
+            return
+
+        titulo = pelicula['titulo']
+        valoracion = None
+        while valoracion is None:
+            valor = input(f"Introduce la valoración de la pelicula (1-5) para la pelicula: {titulo}: ")
+
+            try:
+                valoracion = int(valor)
+
+                if valoracion < 1 or valoracion > 5:
+                    print("La valoración debe estar entre 1 y 5.")
+                    valoracion = None
+            except ValueError:
+                print("Debes ingresar un número válido.")
+                valoracion = None
+
+        if cola_escritura is not None:
+            cola_escritura.valorar(id_pelicula, dni, valoracion)
+            print("Valoración registrada; se guardará en unos instantes.")
+        elif guardar_valoracion(conn, id_pelicula, dni, valoracion):
+            print("Valoración de la pelicula actualizada exitosamente.")
+        else:
+            print(f"No se encontró una película con id:{id_pelicula}.")
+
+    except psycopg2.Error as e:
+        if e.pgcode == psycopg2.errorcodes.FOREIGN_KEY_VIOLATION:
+            print(f"El usuario con dni {dni} no existe.")
+        elif e.pgcode == '42501':
+            print("Error de permisos: No tienes permiso para acceder a la tabla 'pelicula'."
+             "-- Conceder permisos de SELECT a un usuario sobre la tabla 'pelicula': GRANT UPDATE ON TABLE usuario TO username;")
+        else:
+            print(f"Error {e.pgcode}: {e.pgerror}")
+
+## ------------------------------------------------------------
+def buscar(conn):
     """
-    update_query = """
-        UPDATE PELICULA
-        SET valoracion = %(valoracion)s
-        WHERE id_Pelicula = %(id_pelicula)s;
+    Pide un texto y muestra las películas cuyo título o género se le parecen, o en
+    modo autocompletado las que empiezan por él, de página en página.
+    :param conn: la conexión abierta a la base de datos
+    :return: Nada
     """
+    texto = input("Texto a buscar: ").strip()
+    if not texto:
+        print("Error: El texto es obligatorio.")
+        return
+    prefijo = input("¿Solo títulos que empiezan por el texto? (s/N): ").strip().lower() == 's'
+    genero = input("Género (vacío para todos): ").strip() or None
+
+    try:
+        despues_de = None
+        vacio = True
+        while True:
+            filas, despues_de = buscar_peliculas(conn, texto, genero, prefijo, despues_de=despues_de)
+            for fila in filas:
+                vacio = False
+                print(f"Id_pelicula: {fila.id_pelicula}, titulo: {fila.titulo}, genero: {fila.genero}, "
+                      f"Precio: {fila.precio}")
+            if despues_de is None or input("Pulsa ENTER para ver más o 'q' para terminar: ").strip() == 'q':
+                break
+        if vacio:
+            print("No se encontraron películas.")
+    except psycopg2.Error as e:
+        print(f"Error {e.pgcode}: {e.pgerror}")
 
-    conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED)
+## ------------------------------------------------------------
+def informes(conn):
+    """
+    Muestra un informe del catálogo por estudio, país, género o año, leído de las
+    vistas materializadas de analitica.py.
+    :param conn: la conexión abierta a la base de datos
+    :return: Nada
+    """
+    tipos = {'1': 'estudios', '2': 'paises', '3': 'generos', '4': 'anos'}
+    tipo = tipos.get(input("Informe (1- Estudios, 2- Países, 3- Géneros, 4- Años): ").strip())
+    if tipo is None:
+        print("Error: Opción no válida.")
+        return
 
-    id_pelicula = input("Introduce el id de la pelicula: ")
+    try:
+        filas, fecha = analitica.informe(conn, tipo, limite=50)
+        if fecha is not None:
+            print(f"Datos actualizados el {fecha:%d-%m-%Y %H:%M:%S}")
+        if not filas:
+            print("No hay datos.")
+        for fila in filas:
+            print(", ".join(f"{clave}: {valor}" for clave, valor in fila.items()))
+    except psycopg2.Error as e:
+        if e.pgcode == psycopg2.errorcodes.UNDEFINED_TABLE:
+            print("Faltan las vistas de informes: aplica las migraciones con 'python migrar.py'.")
+        else:
+            print(f"Error {e.pgcode}: {e.pgerror}")
 
-    with conn.cursor() as cur:
+## ------------------------------------------------------------
+def show_mejor_valoradas(conn):
+    """
+    Muestra la clasificación de las películas mejor valoradas.
+    :param conn: la conexión abierta a la base de datos
+    :return: Nada
+    """
+    while True:
         try:
-            cur.execute(select_query, {'id_pelicula': id_pelicula})
-            result = cur.fetchone()
-
-            if result:
-                titulo = result[1]
-                valoracion = None
+            sn = input("Número de películas (vacío para 10): ")
+            n = int(sn) if sn else 10
+            sminimo = input("Mínimo de valoraciones (vacío para 1): ")
+            minimo = int(sminimo) if sminimo else 1
+            break
+        except ValueError:
+            print("Error: Por favor, introduce un valor numérico.")
 
-                while valoracion is None:
-                    valor = input(f"Introduce la valoración de la pelicula (1-5) para la pelicula: {titulo}: ")
-                    
-                    try:
-                        valoracion = int(valor)
-                        
-                        if valoracion < 1 or valoracion > 5:
-                            print("La valoración debe estar entre 1 y 5.")
-                            valoracion = None
-                    except ValueError:
-                        print("Debes ingresar un número válido.")
-                        valoracion = None
-
-                cur.execute(update_query, {'valoracion': valoracion, 'id_pelicula': id_pelicula})
-                conn.commit()
-                print("Valoración de la pelicula actualizada exitosamente.")
+    try:
+        filas = mejor_valoradas(conn, n, minimo)
+        if not filas:
+            print("Todavía no hay películas valoradas.")
+        for puesto, fila in enumerate(filas, start=1):
+            print(f"{puesto}. Id_pelicula: {fila['id_pelicula']}, titulo: {fila['titulo']}, "
+                  f"media: {fila['media']} ({fila['num']} valoraciones)")
+    except psycopg2.Error as e:
+        print(f"Error {e.pgcode}: {e.pgerror}")
 
+## ------------------------------------------------------------
+def promocion_precios(conn):
+    """
+    Pide un porcentaje y un filtro (género, estudio, años, lista de ids) y rebaja el precio
+    de todas las películas que lo cumplen. Todas las preguntas se hacen antes de abrir
+    la transacción.
+    :param conn: La conexión abierta a la base de datos.
+    :return: Nada.
+    """
+    while True:
+        try:
+            porcentaje = float(input("Decremento de precio (porcentaje): "))
+            if porcentaje > 100:
+                print("El decremento no puede ser mayor que 100%. Por favor, introduce un valor válido.")
             else:
-                print(f"No se encontró una película con id:{id_pelicula}.")
+                break
+        except ValueError:
+            print("El valor introducido no es válido, por favor introduce un número decimal.")
 
-        except (psycopg2.Error, Exception) as e:
-            if e.pgcode == '42501':
-                print("Error de permisos: No tienes permiso para acceder a la tabla 'pelicula'."
-                 "-- Conceder permisos de SELECT a un usuario sobre la tabla 'pelicula': GRANT UPDATE ON TABLE usuario TO username;")
-            else:
-                print(f"Error {e.pgcode}: {e.pgerror}")
+    genero = input("Género (vacío para todos): ") or None
+    sestudio = input("Id del estudio (vacío para todos): ")
+    id_estudio = None
+    if sestudio:
+        try:
+            id_estudio = int(sestudio)
+        except ValueError:
+            print("Error: Por favor, introduce un valor numérico para el identificador.")
+            return
+
+    try:
+        sdesde = input("Desde el año (vacío para no limitar): ")
+        desde = int(sdesde) if sdesde else None
+        shasta = input("Hasta el año (vacío para no limitar): ")
+        hasta = int(shasta) if shasta else None
+        sids = input("Ids de película separados por comas (vacío para todas): ")
+        ids = [int(s) for s in sids.split(',')] if sids else None
+    except ValueError:
+        print("Error: Los años y los ids deben ser numéricos.")
+        return
+
+    if genero is None and id_estudio is None and desde is None and hasta is None and ids is None:
+        if input("No hay filtro: se rebajará todo el catálogo. ¿Continuar? (s/n): ").lower() != 's':
+            return
+
+    try:
+        modificadas = rebajar_precios(conn, porcentaje, genero, id_estudio, desde, hasta, ids, tam_lote=10000)
+        print(f"Precio modificado en {modificadas} películas.")
+    except psycopg2.Error as e:
+        if e.pgcode == psycopg2.errorcodes.CHECK_VIOLATION:
+            print("El precio debe ser positivo, no se modifican las películas.")
+        elif e.pgcode == psycopg2.errorcodes.NUMERIC_VALUE_OUT_OF_RANGE:
+            print("El precio máximo es 99999999.99.")
+        elif e.pgcode == psycopg2.errorcodes.SERIALIZATION_FAILURE:
+            print("No se pudo modificar el precio por conflictos con otros usuarios. Inténtalo de nuevo.")
+        elif e.pgcode == '42501':
+            print("Error de permisos: No tienes permiso para acceder a la tabla 'pelicula'."
+                  "-- Conceder permisos de UPDATE a un usuario sobre la tabla 'pelicula': GRANT UPDATE ON TABLE pelicula TO username;")
+        else:
+            print(f"Error {e.pgcode}: {e.pgerror}")
+
+## ------------------------------------------------------------
+# Columnas de cada tabla en el orden en que las recibe el COPY de la carga masiva
+COLUMNAS_CARGA = {
+    'pelicula': ('id_Us', 'id_Est', 'id_Pelicula', 'precio', 'titulo', 'duracion_Minutos', 'año', 'genero'),
+    'usuario': ('DNI', 'nombre', 'apellido', 'telefono'),
+    'estudio': ('id_Estudio', 'nombreE', 'paisOrigen'),
+}
+
+
+def _campo(fila, nombre):
+    """
+    Devuelve el campo 'nombre' de un registro leído de fichero.
+    :raises ValueError: si el campo no está presente
+    """
+    valor = fila.get(nombre.lower())
+    if valor is None:
+        raise ValueError(f"Falta el campo {nombre}.")
+    return valor
+
+
+def validar_estudio(fila):
+    """
+    Valida un registro de estudio con las mismas reglas que insert_estudio.
+    :param fila: diccionario con las columnas del estudio (claves en minúsculas)
+    :return: tupla con los valores en el orden de COLUMNAS_CARGA['estudio']
+    :raises ValueError: si algún campo no es válido
+    """
+    try:
+        id_estudio = int(_campo(fila, 'id_Estudio'))
+    except (TypeError, ValueError):
+        raise ValueError("Error: El identificador del estudio debe ser numérico.")
+    nombre = str(_campo(fila, 'nombreE'))
+    if len(nombre) > 20:
+        raise ValueError("Error: EL nombre debe tener como máximo 20 caracteres.")
+    pais = str(_campo(fila, 'paisOrigen'))
+    if len(pais) > 20:
+        raise ValueError("Error: EL pais debe tener como máximo 20 caracteres.")
+    return id_estudio, nombre, pais
+
+
+def validar_usuario(fila, dni_valido=None):
+    """
+    Valida un registro de usuario con las mismas reglas que insert_usuario.
+    :param fila: diccionario con las columnas del usuario (claves en minúsculas)
+    :param dni_valido: resultado ya calculado de validar el DNI (None para calcularlo aquí)
+    :return: tupla con los valores en el orden de COLUMNAS_CARGA['usuario']
+    :raises ValueError: si algún campo no es válido
+    """
+    dni = _campo(fila, 'DNI')
+    if dni_valido is None:
+        dni_valido = isinstance(dni, str) and es_dni_valido(dni)
+    if not dni_valido:
+        raise ValueError("Error: El DNI debe tener una longitud de 9 caracteres o has introducido un DNI erroneo.")
+    nombre = str(_campo(fila, 'nombre'))
+    if len(nombre) > 15:
+        raise ValueError("Error: El nombre debe tener como máximo 15 caracteres.")
+    apellido = str(_campo(fila, 'apellido'))
+    if len(apellido) > 25:
+        raise ValueError("Error: Los apellidos deben tener como máximo 25 caracteres.")
+    try:
+        telefono = int(_campo(fila, 'telefono'))
+    except (TypeError, ValueError):
+        raise ValueError("Error: El teléfono debe ser un valor numérico.")
+    if len(str(telefono)) != 9:
+        raise ValueError("Error: El número de teléfono debe tener 9 cifras.")
+    return dni, nombre, apellido, telefono
+
+
+def validar_pelicula(fila, dni_valido=None):
+    """
+    Valida un registro de película con las mismas reglas que insert_pelicula.
+    La fecha se devuelve en formato ISO para que no dependa del DateStyle del servidor.
+    :param fila: diccionario con las columnas de la película (claves en minúsculas)
+    :param dni_valido: resultado ya calculado de validar el DNI (None para calcularlo aquí)
+    :return: tupla con los valores en el orden de COLUMNAS_CARGA['pelicula']
+    :raises ValueError: si algún campo no es válido
+    """
+    id_us = _campo(fila, 'id_Us')
+    if dni_valido is None:
+        dni_valido = isinstance(id_us, str) and es_dni_valido(id_us)
+    if not dni_valido:
+        raise ValueError("Error: El DNI debe tener una longitud de 9 caracteres o has introducido un DNI erroneo.")
+    try:
+        id_est = int(_campo(fila, 'id_Est'))
+        id_pelicula = int(_campo(fila, 'id_Pelicula'))
+    except (TypeError, ValueError):
+        raise ValueError("Error: Los identificadores de estudio y película deben ser numéricos.")
+    try:
+        precio = float(_campo(fila, 'precio'))
+    except (TypeError, ValueError):
+        raise ValueError("Error: El precio debe ser un valor numérico.")
+    titulo = str(_campo(fila, 'titulo'))
+    if len(titulo) > 20:
+        raise ValueError("Error: EL titulo debe tener como máximo 20 caracteres.")
+    try:
+        duracion_minutos = int(_campo(fila, 'duracion_Minutos'))
+    except (TypeError, ValueError):
+        raise ValueError("Error: La duración debe ser un valor numérico.")
+    try:
+        ano = datetime.strptime(str(_campo(fila, 'año')), '%d-%m-%Y').date().isoformat()
+    except ValueError:
+        raise ValueError("Error: El año debe tener el formato dd-mm-yyyy.")
+    genero = str(_campo(fila, 'genero'))
+    if len(genero) > 20:
+        raise ValueError("Error: EL género debe tener como máximo 20 caracteres.")
+    return id_us, id_est, id_pelicula, precio, titulo, duracion_minutos, ano, genero
+
+
+VALIDADORES_CARGA = {
+    'pelicula': validar_pelicula,
+    'usuario': validar_usuario,
+    'estudio': validar_estudio,
+}
+
+# Columna con un DNI en cada tabla, que se valida para todo el bloque a la vez con dnis_validos
+COLUMNA_DNI = {
+    'pelicula': 'id_us',
+    'usuario': 'dni',
+}
+
+
+def _leer_registros(ruta):
+    """
+    Lee un fichero CSV (con cabecera) o JSONL y devuelve sus registros uno a uno,
+    sin cargar el fichero entero en memoria.
+    :param ruta: ruta del fichero; si termina en .jsonl o .json se lee como JSON por líneas
+    :return: generador de tuplas (número de línea, diccionario con claves en minúsculas)
+    """
+    with open(ruta, newline='', encoding='utf-8') as f:
+        if ruta.lower().endswith(('.jsonl', '.json')):
+            for num_linea, linea in enumerate(f, start=1):
+                if not linea.strip():
+                    continue
+                try:
+                    registro = json.loads(linea)
+                except ValueError:
+                    registro = {'_linea': linea.rstrip('\n')}
+                if not isinstance(registro, dict):
+                    registro = {'_linea': linea.rstrip('\n')}
+                yield num_linea, {str(k).lower(): v for k, v in registro.items()}
+        else:
+            lector = csv.DictReader(f)
+            for registro in lector:
+                yield lector.line_num, {str(k).lower(): v for k, v in registro.items() if k is not None}
+
+
+def _validar_bloque(tabla, bloque):
+    """
+    Valida un bloque de registros antes de cargarlo.
+    :param tabla: nombre de la tabla destino (clave de COLUMNAS_CARGA)
+    :param bloque: lista de tuplas (número de línea, registro)
+    :return: (filas válidas, rechazadas como tuplas (línea, registro, motivo))
+    """
+    validar = VALIDADORES_CARGA[tabla]
+    validas = []
+    rechazadas = []
+    columna_dni = COLUMNA_DNI.get(tabla)
+    if columna_dni is None:
+        for num_linea, registro in bloque:
+            try:
+                validas.append(validar(registro))
+            except ValueError as e:
+                rechazadas.append((num_linea, registro, str(e)))
+        return validas, rechazadas
+
+    mascara, _ = dnis_validos([registro.get(columna_dni) for _, registro in bloque])
+    for (num_linea, registro), dni_valido in zip(bloque, mascara.tolist()):
+        try:
+            validas.append(validar(registro, dni_valido))
+        except ValueError as e:
+            rechazadas.append((num_linea, registro, str(e)))
+    return validas, rechazadas
+
+
+def _copiar_bloque(conn, tabla, filas):
+    """
+    Envía un bloque de filas ya validadas con COPY ... FROM STDIN y confirma la transacción.
+    :param conn: la conexión abierta a la base de datos
+    :param tabla: nombre de la tabla destino (clave de COLUMNAS_CARGA)
+    :param filas: lista de tuplas en el orden de COLUMNAS_CARGA[tabla]
+    :raises psycopg2.Error: si el COPY falla; la transacción queda deshecha
+    """
+    buf = io.StringIO()
+    escritor = csv.writer(buf, quoting=csv.QUOTE_NONNUMERIC, lineterminator='\n')
+    escritor.writerows(filas)
+    buf.seek(0)
+
+    sql = f"COPY {tabla.upper()} ({', '.join(COLUMNAS_CARGA[tabla])}) FROM STDIN WITH (FORMAT csv)"
+    with conn.cursor() as cursor:
+        try:
+            cursor.copy_expert(sql, buf)
+            conn.commit()
+        except psycopg2.Error:
             conn.rollback()
+            raise
+
+
+def cargar_fichero(conn, tabla, ruta, ruta_rechazos=None, tam_bloque=10000):
+    """
+    Carga masiva de una tabla desde un fichero CSV o JSONL.
+    El fichero se procesa en bloques de 'tam_bloque' registros: cada bloque se valida
+    con las mismas reglas que los formularios interactivos y las filas válidas se envían
+    con un único COPY y un único commit. Las filas que no pasan la validación, o los
+    bloques que rechaza la base de datos, se escriben en el fichero de rechazos.
+    :param conn: la conexión abierta a la base de datos
+    :param tabla: 'pelicula', 'usuario' o 'estudio'
+    :param ruta: fichero de entrada
+    :param ruta_rechazos: fichero JSONL donde se guardan los rechazos (por defecto <ruta>.rechazos.jsonl)
+    :param tam_bloque: número de registros por bloque
+    :return: tupla (filas cargadas, filas rechazadas)
+    """
+    tabla = tabla.lower()
+    if tabla not in COLUMNAS_CARGA:
+        raise ValueError(f"Tabla desconocida: {tabla}")
+    fijar_aislamiento(conn, psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED)
+    if ruta_rechazos is None:
+        ruta_rechazos = ruta + '.rechazos.jsonl'
+
+    cargadas = 0
+    rechazadas = 0
+    inicio = time.perf_counter()
+
+    with open(ruta_rechazos, 'w', encoding='utf-8') as f_rechazos:
+        def rechazar(num_linea, registro, motivo):
+            f_rechazos.write(json.dumps({'linea': num_linea, 'motivo': motivo, 'registro': registro},
+                                        ensure_ascii=False, default=str) + '\n')
+
+        bloque = []
+        registros = _leer_registros(ruta)
+        while True:
+            bloque.clear()
+            for item in registros:
+                bloque.append(item)
+                if len(bloque) >= tam_bloque:
+                    break
+            if not bloque:
+                break
+
+            validas, malas = _validar_bloque(tabla, bloque)
+            for num_linea, registro, motivo in malas:
+                rechazar(num_linea, registro, motivo)
+            rechazadas += len(malas)
+            if not validas:
+                continue
+
+            try:
+                _copiar_bloque(conn, tabla, validas)
+                cargadas += len(validas)
+            except psycopg2.Error as e:
+                # El COPY es atómico: si la base de datos rechaza una fila se rechaza el bloque entero
+                motivo = f"Error {e.pgcode}: {e.pgerror}"
+                lineas_malas = {n for n, _, _ in malas}
+                for num_linea, registro in bloque:
+                    if num_linea not in lineas_malas:
+                        rechazar(num_linea, registro, motivo)
+                rechazadas += len(validas)
+
+            transcurrido = time.perf_counter() - inicio
+            print(f"  {cargadas} filas cargadas ({cargadas / transcurrido:.0f} filas/s)")
+
+    transcurrido = time.perf_counter() - inicio
+    velocidad = cargadas / transcurrido if transcurrido > 0 else 0.0
+    print(f"Carga de {tabla.upper()} terminada: {cargadas} filas cargadas, {rechazadas} rechazadas "
+          f"en {transcurrido:.2f} s ({velocidad:.0f} filas/s).")
+    if rechazadas:
+        print(f"Las filas rechazadas están en {ruta_rechazos}")
+    return cargadas, rechazadas
+
+
+def carga_masiva(conn):
+    """
+    Pide la tabla y el fichero de entrada y lanza la carga masiva.
+    :param conn: la conexión abierta a la base de datos
+    :return: Nada
+    """
+    while True:
+        tabla = input("Tabla a cargar (pelicula/usuario/estudio): ").lower()
+        if tabla in COLUMNAS_CARGA:
+            break
+        print("Error: La tabla debe ser pelicula, usuario o estudio.")
+
+    ruta = input("Fichero CSV o JSONL: ")
+    if not os.path.isfile(ruta):
+        print(f"El fichero {ruta} no existe.")
+        return
+
+    try:
+        cargar_fichero(conn, tabla, ruta)
+    except OSError as e:
+        print(f"Error al leer el fichero: {e}")
+
 
 ## ------------------------------------------------------------
 def menu(conn):
@@ -619,44 +2024,330 @@ def menu(conn):
 7- Disminuir Precio
 8- Valorar una película
 9- Insertar un estudio
+10- Carga masiva desde fichero
+11- Promoción de precios por filtro
+12- Películas mejor valoradas
+13- Buscar películas por título o género
+14- Informes del catálogo
 q - Saír   
 """
+    # Opciones de solo lectura, que pueden ir a una réplica (conexion_lectura)
+    de_lectura = {show_pelicula, show_peliculas_usuario, show_mejor_valoradas, buscar, informes}
+    opciones = {
+        '1': insert_pelicula,
+        '2': insert_usuario,
+        '3': show_pelicula,
+        '4': update_pelicula,
+        '5': show_peliculas_usuario,
+        '6': delete_pelicula,
+        '7': decrease_price,
+        '8': valorar_pelicula,
+        '9': insert_estudio,
+        '10': carga_masiva,
+        '11': promocion_precios,
+        '12': show_mejor_valoradas,
+        '13': buscar,
+        '14': informes,
+    }
     while True:
         print(MENU_TEXT)
         tecla = input('Opción> ')
         if tecla == 'q':
             break
-        elif tecla == '1':
-            insert_pelicula(conn)
-        elif tecla == '2':
-            insert_usuario(conn)
-        elif tecla == '3':
-            show_pelicula(conn)
-        elif tecla == '4':
-            update_pelicula(conn)
-        elif tecla == '5':
-            show_peliculas_usuario(conn)
-        elif tecla == '6':
-            delete_pelicula(conn)
-        elif tecla == '7':
-            decrease_price(conn)
-        elif tecla == '8':
-            valorar_pelicula(conn)
-        elif tecla == '9':
-            insert_estudio(conn)
+        funcion = opciones.get(tecla)
+        if funcion is not None:
+            # Se mide la duración de cada opción y su tiempo en la base de datos (metricas.py)
+            with operacion(funcion.__name__):
+                if funcion in de_lectura:
+                    with conexion_lectura(conn) as conn_lectura:
+                        funcion(conn_lectura)
+                else:
+                    funcion(conn)
+                    anotar_escritura(conn)
+
+
+## ------------------------------------------------------------
+## Órdenes de la línea de comandos: reciben la conexión (None en las que no usan la
+## base de datos) y los argumentos, y devuelven lo que se imprime en JSON.
+## Lanzan LookupError si la película no existe.
+## ------------------------------------------------------------
+def _fecha_cli(valor):
+    try:
+        return datetime.strptime(valor, '%d-%m-%Y')
+    except ValueError:
+        raise argparse.ArgumentTypeError("El año debe tener el formato dd-mm-yyyy.")
+
+
+def _ids_cli(valor):
+    try:
+        return [int(s) for s in valor.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError("Los ids deben ser numéricos y estar separados por comas.")
+
+
+def _existe(existe, id_pelicula):
+    if not existe:
+        raise LookupError(f"La pelicula con id {id_pelicula} no existe.")
+
+
+def orden_validar_dni(conn, args):
+    return {dni: es_dni_valido(dni) for dni in args.dni}
+
+
+def orden_nueva_pelicula(conn, args):
+    pelicula = validar_pelicula({'id_us': args.dni, 'id_est': args.estudio, 'id_pelicula': args.id,
+                                 'precio': args.precio, 'titulo': args.titulo,
+                                 'duracion_minutos': args.duracion, 'año': args.ano, 'genero': args.genero})
+    usuario = None
+    if args.nombre is not None:
+        usuario = validar_usuario({'dni': args.dni, 'nombre': args.nombre, 'apellido': args.apellido,
+                                   'telefono': args.telefono})
+    estudio = None
+    if args.nombre_estudio is not None:
+        estudio = validar_estudio({'id_estudio': args.estudio, 'nombree': args.nombre_estudio,
+                                   'paisorigen': args.pais})
+    usuario_nuevo, estudio_nuevo = alta_pelicula(conn, pelicula, usuario, estudio)
+    return {'id_pelicula': pelicula[2], 'usuario_nuevo': usuario_nuevo, 'estudio_nuevo': estudio_nuevo}
+
+
+def orden_nuevo_usuario(conn, args):
+    datos = validar_usuario({'dni': args.dni, 'nombre': args.nombre, 'apellido': args.apellido,
+                             'telefono': args.telefono})
+    crear_usuario(conn, *datos)
+    return {'dni': datos[0]}
+
+
+def orden_nuevo_estudio(conn, args):
+    datos = validar_estudio({'id_estudio': args.id, 'nombree': args.nombre, 'paisorigen': args.pais})
+    crear_estudio(conn, *datos)
+    return {'id_estudio': datos[0]}
+
+
+def orden_ver(conn, args):
+    pelicula = obtener_pelicula(conn, args.id)
+    _existe(pelicula is not None, args.id)
+    return pelicula
+
+
+def orden_modificar(conn, args):
+    if args.titulo is not None and len(args.titulo) > 20:
+        raise ValueError("Error: EL titulo debe tener como máximo 20 caracteres.")
+    _existe(modificar_pelicula(conn, args.id, args.titulo, args.ano, args.precio, version=args.version), args.id)
+    return {'id_pelicula': args.id}
+
+
+def orden_peliculas_usuario(conn, args):
+    filas, siguiente = pagina_peliculas_usuario(conn, args.dni, args.limite, args.despues)
+    return {'peliculas': [fila._asdict() for fila in filas], 'siguiente': siguiente}
+
+
+def orden_borrar(conn, args):
+    _existe(borrar_pelicula(conn, args.id), args.id)
+    return {'id_pelicula': args.id}
+
+
+def orden_rebajar(conn, args):
+    _existe(rebajar_precio(conn, args.id, args.porcentaje, version=args.version), args.id)
+    return {'id_pelicula': args.id}
+
+
+def orden_valorar(conn, args):
+    if not 1 <= args.valoracion <= 5:
+        raise ValueError("La valoración debe estar entre 1 y 5.")
+    _existe(guardar_valoracion(conn, args.id, args.dni, args.valoracion), args.id)
+    return {'id_pelicula': args.id}
+
+
+def orden_promocion(conn, args):
+    if args.genero is None and args.estudio is None and args.desde is None and args.hasta is None \
+            and args.ids is None and not args.todo:
+        raise ValueError("No hay filtro: para rebajar todo el catálogo indica --todo.")
+    modificadas = rebajar_precios(conn, args.porcentaje, args.genero, args.estudio, args.desde, args.hasta,
+                                  args.ids, tam_lote=args.lote)
+    return {'modificadas': modificadas}
+
+
+def orden_mejor_valoradas(conn, args):
+    return mejor_valoradas(conn, args.n, args.minimo)
+
+
+def orden_buscar(conn, args):
+    despues = None if args.despues is None else json.loads(args.despues)
+    filas, siguiente = buscar_peliculas(conn, args.texto, args.genero, args.prefijo, args.limite, despues)
+    return {'peliculas': [fila._asdict() for fila in filas],
+            'siguiente': None if siguiente is None else json.dumps(siguiente, default=str)}
+
+
+def orden_informe(conn, args):
+    filas, fecha = analitica.informe(conn, args.tipo, args.limite, args.pais, args.desde, args.hasta)
+    return {'actualizado': fecha, 'filas': filas}
+
+
+def orden_cargar(conn, args):
+    # cargar_fichero ya informa del progreso y del resultado
+    cargadas, rechazadas = cargar_fichero(conn, args.tabla, args.fichero, args.rechazos, args.bloque)
+    if rechazadas:
+        raise ValueError(f"Se rechazaron {rechazadas} filas.")
+
+
+# Órdenes de solo lectura, que pueden ir a una réplica (conexion_lectura)
+ORDENES_LECTURA = {orden_ver, orden_peliculas_usuario, orden_mejor_valoradas, orden_buscar, orden_informe}
+
+
+def _argumentos():
+    """
+    :return: el analizador de argumentos, con un subcomando por operación
+    """
+    parser = argparse.ArgumentParser(description="Gestión del catálogo de películas. Sin subcomando, "
+                                                 "abre el menú.")
+    subparsers = parser.add_subparsers(dest='comando')
+
+    def orden(nombre, funcion, ayuda, usa_bd=True):
+        p = subparsers.add_parser(nombre, help=ayuda)
+        p.set_defaults(funcion=funcion, usa_bd=usa_bd)
+        return p
+
+    orden('menu', None, "Menú interactivo (por defecto)")
+
+    p = orden('validar-dni', orden_validar_dni, "Comprueba la letra de uno o varios DNI", usa_bd=False)
+    p.add_argument('dni', nargs='+')
+
+    p = orden('nueva-pelicula', orden_nueva_pelicula,
+              "Añade una película y, si se dan sus datos, su usuario y su estudio")
+    p.add_argument('id', type=int)
+    p.add_argument('--dni', required=True, help="DNI del usuario")
+    p.add_argument('--estudio', type=int, required=True, help="Id del estudio")
+    p.add_argument('--titulo', required=True)
+    p.add_argument('--precio', type=float, required=True)
+    p.add_argument('--duracion', type=int, required=True, help="Minutos")
+    p.add_argument('--ano', required=True, help="dd-mm-yyyy")
+    p.add_argument('--genero', required=True)
+    p.add_argument('--nombre', help="Nombre del usuario, para crearlo si no existe")
+    p.add_argument('--apellido')
+    p.add_argument('--telefono')
+    p.add_argument('--nombre-estudio', help="Nombre del estudio, para crearlo si no existe")
+    p.add_argument('--pais')
+
+    p = orden('nuevo-usuario', orden_nuevo_usuario, "Añade un usuario")
+    p.add_argument('dni')
+    p.add_argument('nombre')
+    p.add_argument('apellido')
+    p.add_argument('telefono')
+
+    p = orden('nuevo-estudio', orden_nuevo_estudio, "Añade un estudio")
+    p.add_argument('id', type=int)
+    p.add_argument('nombre')
+    p.add_argument('pais')
+
+    p = orden('ver', orden_ver, "Muestra una película")
+    p.add_argument('id', type=int)
+
+    p = orden('modificar', orden_modificar, "Cambia el título, el año o el precio de una película")
+    p.add_argument('id', type=int)
+    p.add_argument('--titulo')
+    p.add_argument('--ano', type=_fecha_cli, help="dd-mm-yyyy")
+    p.add_argument('--precio', type=float)
+    p.add_argument('--version', type=int, help="Solo si la película sigue en esta versión")
+
+    p = orden('peliculas-usuario', orden_peliculas_usuario, "Películas de un usuario, por páginas")
+    p.add_argument('dni')
+    p.add_argument('--limite', type=int, default=100)
+    p.add_argument('--despues', type=int, default=None, help="Último id de la página anterior")
+
+    p = orden('borrar', orden_borrar, "Borra una película")
+    p.add_argument('id', type=int)
+
+    p = orden('rebajar', orden_rebajar, "Rebaja un porcentaje el precio de una película")
+    p.add_argument('id', type=int)
+    p.add_argument('porcentaje', type=float)
+    p.add_argument('--version', type=int, help="Solo si la película sigue en esta versión")
+
+    p = orden('valorar', orden_valorar, "Valora una película de 1 a 5")
+    p.add_argument('id', type=int)
+    p.add_argument('dni')
+    p.add_argument('valoracion', type=int)
+
+    p = orden('promocion', orden_promocion, "Rebaja el precio de las películas que cumplen un filtro")
+    p.add_argument('porcentaje', type=float)
+    p.add_argument('--genero')
+    p.add_argument('--estudio', type=int)
+    p.add_argument('--desde', type=int, help="Desde este año")
+    p.add_argument('--hasta', type=int, help="Hasta este año")
+    p.add_argument('--ids', type=_ids_cli, help="Ids separados por comas")
+    p.add_argument('--lote', type=int, default=10000, help="Películas por transacción")
+    p.add_argument('--todo', action='store_true', help="Rebajar todo el catálogo si no hay filtro")
+
+    p = orden('mejor-valoradas', orden_mejor_valoradas, "Películas mejor valoradas")
+    p.add_argument('--n', type=int, default=10)
+    p.add_argument('--minimo', type=int, default=1, help="Valoraciones mínimas")
+
+    p = orden('buscar', orden_buscar, "Busca películas por título o género")
+    p.add_argument('texto')
+    p.add_argument('--genero')
+    p.add_argument('--prefijo', action='store_true', help="Títulos que empiezan por el texto")
+    p.add_argument('--limite', type=int, default=20)
+    p.add_argument('--despues', help="Marca 'siguiente' de la página anterior")
+
+    p = orden('informe', orden_informe, "Informe del catálogo")
+    p.add_argument('tipo', choices=sorted(analitica.SQL_INFORMES))
+    p.add_argument('--limite', type=int)
+    p.add_argument('--pais')
+    p.add_argument('--desde', type=int)
+    p.add_argument('--hasta', type=int)
+
+    p = orden('cargar', orden_cargar, "Carga masiva desde un fichero CSV o JSONL")
+    p.add_argument('tabla', choices=sorted(COLUMNAS_CARGA))
+    p.add_argument('fichero')
+    p.add_argument('--rechazos', default=None, help="Fichero JSONL para las filas rechazadas")
+    p.add_argument('--bloque', type=int, default=10000, help="Registros por bloque de COPY")
+    return parser
 
 
 ## ------------------------------------------------------------
 def main():
     """
-    Función principal. Conecta á bd e executa o menú.
-    Cando sae do menú, desconecta da bd e remata o programa
+    Función principal. Sen subcomando (ou con 'menu') conecta á bd e executa o menú;
+    cando sae do menú, desconecta da bd e remata o programa.
+    Cada subcomando fai unha operación sen preguntas e imprime o resultado en JSON;
+    só conecta á bd se a operación a usa:
+        python -m app ver 42
+        python -m app cargar pelicula peliculas.csv [--rechazos f.jsonl] [--bloque N]
+    Con 'python -m app' arrinca antes que con 'python app.py', porque usa o código xa
+    compilado (__pycache__) en vez de compilar o ficheiro cada vez.
+    Remata con código 1 se a operación falla (ou a carga rexeita algunha fila).
     """
-    print('Conectando a PosgreSQL...')
-    conn = connect_db()
-    print('Conectado.')
-    menu(conn)
-    disconnect_db(conn)
+    args = _argumentos().parse_args()
+
+    if os.environ.get('BDA_METRICAS_PUERTO'):
+        servir_http(int(os.environ['BDA_METRICAS_PUERTO']))
+
+    funcion = getattr(args, 'funcion', None)
+    if funcion is None:
+        print('Conectando a PosgreSQL...')
+        conn = connect_db()
+        print('Conectado.')
+        menu(conn)
+        disconnect_db(conn)
+        return
+
+    conn = connect_db() if args.usa_bd else None
+    codigo = 0
+    try:
+        with operacion(args.comando):
+            with conexion_lectura(conn) if funcion in ORDENES_LECTURA else nullcontext(conn) as conn_orden:
+                resultado = funcion(conn_orden, args)
+        if resultado is not None:
+            print(json.dumps(resultado, indent=2, ensure_ascii=False, default=str))
+    except psycopg2.Error as e:
+        print(f"Error {e.pgcode}: {e.pgerror}", file=sys.stderr)
+        codigo = 1
+    except (ConflictoVersion, LookupError, ValueError) as e:
+        print(e, file=sys.stderr)
+        codigo = 1
+    finally:
+        if conn is not None:
+            disconnect_db(conn)
+    sys.exit(codigo)
 
 ## ------------------------------------------------------------
 
@@ -0,0 +1,321 @@
+"""
+Capa de acceso a datos asíncrona, equivalente a la de app.py, sobre psycopg 3.
+
+Cada operación es una corrutina que toma una conexión de un AsyncConnectionPool,
+de modo que un solo proceso puede tener muchas consultas en curso a la vez sin
+hilos. Las consultas independientes se envían juntas en modo pipeline (un solo
+viaje de ida y vuelta al servidor), como en obtener_peliculas y guardar_valoracion.
+
+Las sentencias SQL son las de app.py. psycopg 3 prepara por sí mismo las sentencias
+que se repiten en una conexión; con BDA_PREPARAR=0 no prepara ninguna.
+
+    pool = await crear_pool()
+    pelicula = await obtener_pelicula(pool, 1)
+    await pool.close()
+
+    python asincrono.py --peliculas 10000 --concurrencia 200 --operaciones 20000
+"""
+import argparse
+import asyncio
+import os
+import random
+import time
+
+import psycopg
+from psycopg.conninfo import make_conninfo
+from psycopg.rows import dict_row, namedtuple_row
+from psycopg_pool import AsyncConnectionPool
+
+import app
+from conexiones import leer_config
+
+
+LECTURA = psycopg.IsolationLevel.READ_COMMITTED
+SERIALIZABLE = psycopg.IsolationLevel.SERIALIZABLE
+
+
+## ------------------------------------------------------------
+async def crear_pool(ruta=None, **extra):
+    """
+    Crea y abre un pool asíncrono con la misma configuración que PoolConexiones.
+    :param ruta: fichero de configuración; por defecto BDA_CONFIG o bda.ini
+    :param extra: valores que sustituyen a minconn, maxconn o max_inactivo
+    :return: el AsyncConnectionPool abierto
+    """
+    params, pool = leer_config(ruta)
+    pool.update(extra)
+    params['dbname'] = params.pop('database')
+    preparar = os.environ.get('BDA_PREPARAR', '1') != '0'
+    pool_asincrono = AsyncConnectionPool(
+        make_conninfo(**params),
+        min_size=pool['minconn'],
+        max_size=pool['maxconn'],
+        max_idle=pool['max_inactivo'],
+        kwargs={'prepare_threshold': 5 if preparar else None},
+        open=False,
+    )
+    await pool_asincrono.open()
+    return pool_asincrono
+
+
+async def _reintentar(pool, operacion, reintentos=5, espera=0.05):
+    """
+    Ejecuta operacion(conn) en una transacción SERIALIZABLE, repitiéndola con una espera
+    creciente si falla por un conflicto de serialización o un interbloqueo.
+    :param operacion: corrutina que recibe la conexión y devuelve el resultado
+    :return: lo que devuelva operacion
+    """
+    intento = 0
+    while True:
+        try:
+            async with pool.connection() as conn:
+                await conn.set_isolation_level(SERIALIZABLE)
+                return await operacion(conn)
+        except psycopg.Error as e:
+            if e.sqlstate not in app.ERRORES_REINTENTABLES or intento >= reintentos:
+                raise
+        await asyncio.sleep(espera * (2 ** intento) * (0.5 + random.random()))
+        intento += 1
+
+
+## ------------------------------------------------------------
+## Operaciones. Cada una es una transacción: se confirma al devolver la conexión
+## al pool y se deshace si hay una excepción.
+## ------------------------------------------------------------
+async def crear_estudio(pool, id_estudio, nombre, pais):
+    """
+    Inserta un estudio en la tabla 'ESTUDIO'.
+    """
+    async with pool.connection() as conn:
+        await conn.set_isolation_level(LECTURA)
+        await conn.execute(app.SQL_INSERTAR_ESTUDIO, {'p': id_estudio, 'n': nombre, 'a': pais})
+
+
+async def crear_usuario(pool, dni, nombre, apellido, telefono):
+    """
+    Inserta un usuario en la tabla 'USUARIO'.
+    """
+    async with pool.connection() as conn:
+        await conn.set_isolation_level(LECTURA)
+        await conn.execute(app.SQL_INSERTAR_USUARIO, {'p': dni, 'n': nombre, 'a': apellido, 't': telefono})
+
+
+async def crear_pelicula(pool, id_us, id_est, id_pelicula, precio, titulo, duracion_minutos, ano, genero):
+    """
+    Inserta una película en la tabla 'PELICULA'.
+    """
+    async with pool.connection() as conn:
+        await conn.set_isolation_level(LECTURA)
+        await conn.execute(app.SQL_INSERTAR_PELICULA, {'u': id_us, 'e': id_est, 'p': id_pelicula, 'pr': precio,
+                                                       't': titulo, 'd': duracion_minutos, 'a': ano, 'g': genero})
+
+
+async def crear_peliculas(pool, peliculas):
+    """
+    Inserta varias películas en una transacción; psycopg 3 envía las inserciones
+    de executemany en pipeline.
+    :param peliculas: secuencia de tuplas con los argumentos de crear_pelicula
+    """
+    async with pool.connection() as conn:
+        await conn.set_isolation_level(LECTURA)
+        async with conn.cursor() as cursor:
+            await cursor.executemany(app.SQL_INSERTAR_PELICULA, [
+                {'u': id_us, 'e': id_est, 'p': id_pelicula, 'pr': precio, 't': titulo, 'd': duracion_minutos,
+                 'a': ano, 'g': genero}
+                for id_us, id_est, id_pelicula, precio, titulo, duracion_minutos, ano, genero in peliculas])
+
+
+async def obtener_pelicula(pool, id_pelicula):
+    """
+    Devuelve los datos de una película. No pasa por cache_peliculas.
+    :return: diccionario con las columnas de la película, o None si no existe
+    """
+    async with pool.connection() as conn:
+        await conn.set_isolation_level(LECTURA)
+        async with conn.cursor(row_factory=dict_row) as cursor:
+            await cursor.execute(app.SQL_OBTENER_PELICULA, {'c': id_pelicula})
+            return await cursor.fetchone()
+
+
+async def obtener_peliculas(pool, ids):
+    """
+    Devuelve los datos de varias películas con una sola conexión, enviando todas las
+    consultas en pipeline.
+    :param ids: los id de las películas
+    :return: lista con el diccionario de cada película (None si no existe), en el orden de ids
+    """
+    async with pool.connection() as conn:
+        await conn.set_isolation_level(LECTURA)
+        cursores = []
+        async with conn.pipeline():
+            for id_pelicula in ids:
+                cursor = conn.cursor(row_factory=dict_row)
+                await cursor.execute(app.SQL_OBTENER_PELICULA, {'c': id_pelicula})
+                cursores.append(cursor)
+        return [await cursor.fetchone() for cursor in cursores]
+
+
+async def pagina_peliculas_usuario(pool, dni, tam_pagina=100, despues_de=None):
+    """
+    Devuelve una página de las películas de un usuario, paginando por id_Pelicula.
+    :return: tupla (lista de namedtuples con id_pelicula, titulo y precio,
+             marca de la página siguiente o None si no hay más)
+    """
+    async with pool.connection() as conn:
+        await conn.set_isolation_level(LECTURA)
+        async with conn.cursor(row_factory=namedtuple_row) as cursor:
+            await cursor.execute(app._sql_peliculas_usuario(despues_de, True),
+                                 {'dni': dni, 'despues': despues_de, 'n': tam_pagina + 1})
+            rows = await cursor.fetchall()
+    if len(rows) > tam_pagina:
+        rows = rows[:tam_pagina]
+        return rows, rows[-1].id_pelicula
+    return rows, None
+
+
+async def iter_peliculas_usuario(pool, dni, tam_pagina=1000, despues_de=None, limite=None):
+    """
+    Recorre las películas de un usuario con un cursor del servidor que trae
+    'tam_pagina' filas en cada viaje. La conexión se ocupa mientras dura el recorrido.
+    :return: generador asíncrono de namedtuples con id_pelicula, titulo y precio
+    """
+    async with pool.connection() as conn:
+        await conn.set_isolation_level(LECTURA)
+        async with conn.cursor(name='peliculas_usuario', row_factory=namedtuple_row) as cursor:
+            cursor.itersize = tam_pagina
+            await cursor.execute(app._sql_peliculas_usuario(despues_de, limite is not None),
+                                 {'dni': dni, 'despues': despues_de, 'n': limite})
+            async for row in cursor:
+                yield row
+
+
+async def modificar_pelicula(pool, id_pelicula, titulo, ano, precio, version=None):
+    """
+    Actualiza el título, el año y el precio de una película (los que sean None no se
+    cambian); con version, solo si la película no ha cambiado desde que se leyó.
+    :return: True si la película existe, False si no
+    :raises app.ConflictoVersion: si la película está en otra versión
+    """
+    params = {'c': id_pelicula, 'm': titulo, 'a': ano, 'p': precio, 'v': version}
+    actual = None
+    async with pool.connection() as conn:
+        await conn.set_isolation_level(LECTURA)
+        sql = app.SQL_MODIFICAR_PELICULA if version is None else app.SQL_MODIFICAR_PELICULA_VERSION
+        cursor = await conn.execute(sql, params)
+        existe = cursor.rowcount > 0
+        if not existe and version is not None:
+            fila = await (await conn.execute(app.SQL_VERSION_PELICULA, params)).fetchone()
+            actual = None if fila is None else fila[0]
+    app.cache_peliculas.invalidar(id_pelicula)
+    if actual is not None:
+        raise app.ConflictoVersion(id_pelicula, version, actual)
+    return existe
+
+
+async def borrar_pelicula(pool, id_pelicula):
+    """
+    Borra una película.
+    :return: True si se borró, False si no existía
+    """
+    async with pool.connection() as conn:
+        await conn.set_isolation_level(LECTURA)
+        cursor = await conn.execute(app.SQL_BORRAR_PELICULA, (id_pelicula, ))
+        existe = cursor.rowcount > 0
+    app.cache_peliculas.invalidar(id_pelicula)
+    return existe
+
+
+async def rebajar_precio(pool, id_pelicula, porcentaje, reintentos=5):
+    """
+    Disminuye el precio de una película en un porcentaje, en una transacción SERIALIZABLE
+    que se repite si hay conflicto de serialización.
+    :return: True si la película existe, False si no
+    :raises ValueError: si el porcentaje es mayor que 100
+    """
+    if porcentaje is not None and porcentaje > 100:
+        raise ValueError("El decremento no puede ser mayor que 100%.")
+
+    async def rebajar(conn):
+        cursor = await conn.execute(app.SQL_REBAJAR_PRECIO, {'m': id_pelicula, 'd': porcentaje})
+        return cursor.rowcount > 0
+
+    existe = await _reintentar(pool, rebajar, reintentos)
+    app.cache_peliculas.invalidar(id_pelicula)
+    return existe
+
+
+async def guardar_valoracion(pool, id_pelicula, dni, valoracion):
+    """
+    Guarda la valoración (1-5) de un usuario para una película y actualiza el resumen,
+    como app.guardar_valoracion. Las lecturas previas van en un pipeline y las
+    escrituras en otro: dos viajes al servidor en lugar de cinco.
+    :return: True si la película existe, False si no
+    :raises ValueError: si la valoración no está entre 1 y 5
+    """
+    if valoracion < 1 or valoracion > 5:
+        raise ValueError("La valoración debe estar entre 1 y 5.")
+    params = {'p': id_pelicula, 'u': dni, 'v': valoracion}
+    async with pool.connection() as conn:
+        await conn.set_isolation_level(LECTURA)
+        async with conn.pipeline():
+            await conn.execute(app.SQL_CREAR_RESUMEN, params)
+            resumen = await conn.execute(app.SQL_BLOQUEAR_RESUMEN, params)
+            anterior = await conn.execute(app.SQL_VALORACION_ANTERIOR, params)
+        if await resumen.fetchone() is None:
+            return False
+        fila = await anterior.fetchone()
+        async with conn.pipeline():
+            await conn.execute(app.SQL_GUARDAR_VALORACION, params)
+            if fila is None:
+                await conn.execute(app.SQL_SUMAR_RESUMEN, params)
+            elif fila[0] != valoracion:
+                await conn.execute(app.SQL_CAMBIAR_RESUMEN, dict(params, a=fila[0]))
+    app.cache_peliculas.invalidar(id_pelicula)
+    return True
+
+
+## ------------------------------------------------------------
+async def medir_lecturas(pool, peliculas, concurrencia, operaciones, semilla=42):
+    """
+    Lanza 'operaciones' lecturas de películas al azar con 'concurrencia' corrutinas.
+    :return: tupla (segundos, latencias ordenadas en segundos)
+    """
+    rng = random.Random(semilla)
+    latencias = []
+    pendientes = iter(range(operaciones))
+
+    async def trabajador():
+        for _ in pendientes:
+            inicio = time.perf_counter()
+            await obtener_pelicula(pool, rng.randint(1, peliculas))
+            latencias.append(time.perf_counter() - inicio)
+
+    inicio = time.perf_counter()
+    await asyncio.gather(*(trabajador() for _ in range(concurrencia)))
+    return time.perf_counter() - inicio, sorted(latencias)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mide lecturas concurrentes con la capa asíncrona.")
+    parser.add_argument('--peliculas', type=int, default=10000, help="Películas sembradas")
+    parser.add_argument('--concurrencia', type=int, default=200, help="Consultas en curso a la vez")
+    parser.add_argument('--operaciones', type=int, default=20000)
+    parser.add_argument('--conexiones', type=int, default=20, help="Tamaño máximo del pool")
+    args = parser.parse_args()
+
+    from benchmark import percentil
+
+    async def medir():
+        pool = await crear_pool(minconn=args.conexiones, maxconn=args.conexiones)
+        try:
+            return await medir_lecturas(pool, args.peliculas, args.concurrencia, args.operaciones)
+        finally:
+            await pool.close()
+
+    segundos, latencias = asyncio.run(medir())
+    print(f"{len(latencias) / segundos:.1f} ops/s, p50 {percentil(latencias, 50) * 1000:.3f} ms, "
+          f"p99 {percentil(latencias, 99) * 1000:.3f} ms")
+
+
+if __name__ == '__main__':
+    main()
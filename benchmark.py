@@ -0,0 +1,370 @@
+"""
+Banco de pruebas reproducible de las operaciones de app.py contra un PostgreSQL local.
+
+Siembra (opcionalmente) las tablas con semilla.sembrar, lanza cada operación desde
+varios hilos durante un tiempo fijo o un número fijo de operaciones y guarda en JSON
+el rendimiento (operaciones/s) y los percentiles de latencia, para poder comparar
+ejecuciones y detectar regresiones.
+
+    python benchmark.py --sembrar --vaciar --peliculas 1000000 --concurrencia 8 --duracion 30 \
+        --salida resultados.json
+    python benchmark.py --peliculas 1000000 --comparar resultados.json
+    python benchmark.py --arranque 20
+
+Con --arranque solo se mide el tiempo de arranque de 'python -m app' con una orden
+que no usa la base de datos; termina con código 1 si la mediana supera
+OBJETIVO_ARRANQUE_MS.
+
+Para comprobar que las lecturas y las rebajas por lotes no se encarecen al crecer el
+histórico (p. ej. con PELICULA particionada, particionar.py), se guarda una ejecución
+con pocas películas y se compara con otra con muchas más:
+
+    python benchmark.py --sembrar --vaciar --peliculas 1000000 --salida base.json
+    python benchmark.py --sembrar --vaciar --peliculas 10000000 --comparar base.json
+
+Sin --sembrar se supone que los datos ya se sembraron con los mismos --peliculas,
+--usuarios y --estudios. Las operaciones que escriben (ESCRITURAS) cambian esos datos,
+así que para medir alguna hay que elegir: con --vaciar se vuelven a sembrar antes,
+vaciando las tablas (TRUNCATE de la base de datos configurada), para que todas las
+ejecuciones y las comparaciones midan los mismos datos; con --conservar-datos se
+mide sobre los datos actuales, sabiendo que otra ejecución no partirá de los mismos.
+Sin ninguna de las dos no se mide nada. Dentro de una ejecución las lecturas se
+miden antes que las escrituras.
+"""
+import argparse
+import itertools
+import json
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+
+import psycopg2
+import psycopg2.extensions
+
+import app
+from conexiones import PoolConexiones
+from semilla import GENEROS, dni_sembrado, sembrar
+
+
+## ------------------------------------------------------------
+## Operaciones: cada una recibe la conexión, un generador aleatorio y el contexto
+## ------------------------------------------------------------
+def op_show_pelicula(conn, rng, ctx):
+    app.obtener_pelicula(conn, rng.randint(1, ctx['peliculas']))
+
+
+def op_show_peliculas_usuario(conn, rng, ctx):
+    for _ in app.iter_peliculas_usuario(conn, dni_sembrado(rng.randint(1, ctx['usuarios']))):
+        pass
+
+
+def op_insert_pelicula(conn, rng, ctx):
+    id_pelicula = next(ctx['nuevos_ids'])
+    app.crear_pelicula(conn, dni_sembrado(rng.randint(1, ctx['usuarios'])), rng.randint(1, ctx['estudios']),
+                       id_pelicula, round(rng.uniform(1, 50), 2), f"Bench {id_pelicula}"[:20],
+                       rng.randint(60, 180), datetime(rng.randint(1950, 2024), 1, 1), rng.choice(GENEROS))
+
+
+def op_update_pelicula(conn, rng, ctx):
+    id_pelicula = rng.randint(1, ctx['peliculas'])
+    app.modificar_pelicula(conn, id_pelicula, f"Pelicula {id_pelicula}", datetime(rng.randint(1950, 2024), 1, 1),
+                           round(rng.uniform(1, 50), 2))
+
+
+def op_update_pelicula_optimista(conn, rng, ctx):
+    app.modificar_pelicula_optimista(conn, rng.randint(1, ctx['peliculas']),
+                                     lambda p: (p['titulo'], p['año'], round(rng.uniform(1, 50), 2)))
+
+
+def op_decrease_price(conn, rng, ctx):
+    app.rebajar_precio(conn, rng.randint(1, ctx['peliculas']), 0.01)
+
+
+def op_rebajar_precios_ids(conn, rng, ctx):
+    app.rebajar_precios(conn, 0.01, ids=rng.sample(range(1, ctx['peliculas'] + 1), min(100, ctx['peliculas'])))
+
+
+def op_valorar_pelicula(conn, rng, ctx):
+    app.guardar_valoracion(conn, rng.randint(1, ctx['peliculas']), dni_sembrado(rng.randint(1, ctx['usuarios'])),
+                           rng.randint(1, 5))
+
+
+def op_mejor_valoradas(conn, rng, ctx):
+    app.mejor_valoradas(conn, 10)
+
+
+def op_buscar_peliculas(conn, rng, ctx):
+    app.buscar_peliculas(conn, f"pelicula {rng.randint(1, ctx['peliculas'])}")
+
+
+def op_autocompletar(conn, rng, ctx):
+    app.buscar_peliculas(conn, f"pelicula {rng.randint(1, 999)}", prefijo=True)
+
+
+OPERACIONES = {
+    'show_pelicula': (op_show_pelicula, psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED),
+    'show_peliculas_usuario': (op_show_peliculas_usuario, psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED),
+    'insert_pelicula': (op_insert_pelicula, psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED),
+    'update_pelicula': (op_update_pelicula, psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED),
+    'update_pelicula_optimista': (op_update_pelicula_optimista, psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED),
+    'decrease_price': (op_decrease_price, psycopg2.extensions.ISOLATION_LEVEL_SERIALIZABLE),
+    'rebajar_precios_ids': (op_rebajar_precios_ids, psycopg2.extensions.ISOLATION_LEVEL_SERIALIZABLE),
+    'valorar_pelicula': (op_valorar_pelicula, psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED),
+    'mejor_valoradas': (op_mejor_valoradas, psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED),
+    'buscar_peliculas': (op_buscar_peliculas, psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED),
+    'autocompletar': (op_autocompletar, psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED),
+}
+
+# Operaciones que modifican los datos sembrados
+ESCRITURAS = {'insert_pelicula', 'update_pelicula', 'update_pelicula_optimista', 'decrease_price',
+              'rebajar_precios_ids', 'valorar_pelicula'}
+
+
+# Mediana máxima en milisegundos del arranque de una orden de app.py sin base de datos.
+# Casi todo es la importación de psycopg2, que según la máquina va de 60 a más de
+# 100 ms; por eso se muestra también como referencia y lo que app.py añade encima.
+# Antes de quitar NumPy, http.server y psycopg2.extras de las importaciones eran
+# unos 240 ms.
+OBJETIVO_ARRANQUE_MS = 150
+
+
+## ------------------------------------------------------------
+def percentil(ordenadas, p):
+    """
+    Percentil p (0-100) de una lista ordenada, por el método del rango más próximo.
+    """
+    if not ordenadas:
+        return None
+    indice = max(0, min(len(ordenadas) - 1, math.ceil(p / 100 * len(ordenadas)) - 1))
+    return ordenadas[indice]
+
+
+def medir(pool, nombre, concurrencia, duracion, operaciones, semilla, ctx):
+    """
+    Ejecuta una operación desde 'concurrencia' hilos.
+    :param duracion: segundos de prueba (se usa si operaciones es None)
+    :param operaciones: número total de operaciones a repartir entre los hilos
+    :return: diccionario con el rendimiento, los percentiles de latencia y los errores
+    """
+    funcion, nivel = OPERACIONES[nombre]
+    latencias = [[] for _ in range(concurrencia)]
+    errores = [{} for _ in range(concurrencia)]
+    barrera = threading.Barrier(concurrencia + 1)
+    fin = [None]
+
+    def trabajador(i):
+        rng = random.Random(f"{semilla}-{nombre}-{i}")
+        cuota = None if operaciones is None else operaciones // concurrencia + (i < operaciones % concurrencia)
+        with pool.conexion(nivel) as conn:
+            barrera.wait()
+            hechas = 0
+            while (cuota is None and time.perf_counter() < fin[0]) or (cuota is not None and hechas < cuota):
+                inicio = time.perf_counter()
+                try:
+                    funcion(conn, rng, ctx)
+                    latencias[i].append(time.perf_counter() - inicio)
+                except (psycopg2.Error, app.ConflictoVersion) as e:
+                    codigo = getattr(e, 'pgcode', None) or type(e).__name__
+                    errores[i][codigo] = errores[i].get(codigo, 0) + 1
+                hechas += 1
+
+    hilos = [threading.Thread(target=trabajador, args=(i, )) for i in range(concurrencia)]
+    for hilo in hilos:
+        hilo.start()
+    inicio = time.perf_counter()
+    fin[0] = inicio + duracion
+    barrera.wait()
+    for hilo in hilos:
+        hilo.join()
+    transcurrido = time.perf_counter() - inicio
+
+    todas = sorted(itertools.chain.from_iterable(latencias))
+    total_errores = {}
+    for e in errores:
+        for codigo, n in e.items():
+            total_errores[codigo] = total_errores.get(codigo, 0) + n
+    ms = lambda v: None if v is None else round(v * 1000, 3)
+    return {
+        'operaciones': len(todas),
+        'segundos': round(transcurrido, 3),
+        'ops_por_segundo': round(len(todas) / transcurrido, 1) if transcurrido else 0.0,
+        'latencia_ms': {
+            'media': ms(sum(todas) / len(todas)) if todas else None,
+            'p50': ms(percentil(todas, 50)),
+            'p90': ms(percentil(todas, 90)),
+            'p95': ms(percentil(todas, 95)),
+            'p99': ms(percentil(todas, 99)),
+            'max': ms(todas[-1]) if todas else None,
+        },
+        'errores': total_errores,
+    }
+
+
+def medir_arranque(veces):
+    """
+    Mide lo que tarda en arrancar y terminar 'python -m app validar-dni', que no se
+    conecta, y, como referencia, un intérprete que solo importa psycopg2.
+    :return: diccionario con la mediana y el máximo en milisegundos de cada uno
+    """
+    directorio = os.path.dirname(os.path.abspath(__file__))
+    ordenes = {
+        'app': [sys.executable, '-m', 'app', 'validar-dni', dni_sembrado(1)],
+        'psycopg2': [sys.executable, '-c', 'import psycopg2'],
+    }
+    resultado = {}
+    for nombre, orden in ordenes.items():
+        # Una ejecución previa sin medir, para que Python compile y guarde el bytecode
+        # de los módulos que hayan cambiado (compilar app.py cuesta unos 25 ms)
+        subprocess.run(orden, cwd=directorio, stdout=subprocess.DEVNULL, check=True)
+        tiempos = []
+        for _ in range(veces):
+            inicio = time.perf_counter()
+            subprocess.run(orden, cwd=directorio, stdout=subprocess.DEVNULL, check=True)
+            tiempos.append((time.perf_counter() - inicio) * 1000)
+        tiempos.sort()
+        resultado[nombre] = {'p50': round(percentil(tiempos, 50), 1), 'max': round(tiempos[-1], 1)}
+    return resultado
+
+
+def comparar(actual, anterior, tolerancia):
+    """
+    Compara dos resultados e indica las operaciones cuyo rendimiento cae más de 'tolerancia'.
+    :return: lista de nombres de operaciones con regresión
+    """
+    regresiones = []
+    for nombre, res in actual['resultados'].items():
+        previo = anterior.get('resultados', {}).get(nombre)
+        if not previo or not previo['ops_por_segundo']:
+            continue
+        cambio = res['ops_por_segundo'] / previo['ops_por_segundo'] - 1
+        p99, p99_previo = res['latencia_ms']['p99'], previo['latencia_ms']['p99']
+        print(f"  {nombre:24} {previo['ops_por_segundo']:>10} -> {res['ops_por_segundo']:>10} ops/s "
+              f"({cambio:+.1%}), p99 {p99_previo} -> {p99} ms")
+        if cambio < -tolerancia:
+            regresiones.append(nombre)
+    return regresiones
+
+
+## ------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description="Banco de pruebas de las operaciones de app.py.")
+    parser.add_argument('--peliculas', type=int, default=10000, help="Películas sembradas (de 10 mil a 10 millones)")
+    parser.add_argument('--usuarios', type=int, default=None)
+    parser.add_argument('--estudios', type=int, default=None)
+    parser.add_argument('--sembrar', action='store_true', help="Siembra los datos antes de medir")
+    parser.add_argument('--vaciar', action='store_true',
+                        help="Vacía las tablas antes de sembrar; con operaciones que escriben, vuelve a sembrar")
+    parser.add_argument('--conservar-datos', action='store_true',
+                        help="Mide las operaciones que escriben sin volver a sembrar los datos")
+    parser.add_argument('--operacion', action='append', choices=sorted(OPERACIONES),
+                        help="Operación a medir; se puede repetir (por defecto, todas)")
+    parser.add_argument('--concurrencia', type=int, default=4, help="Hilos con una conexión cada uno")
+    parser.add_argument('--duracion', type=float, default=10.0, help="Segundos por operación")
+    parser.add_argument('--operaciones', type=int, default=None, help="Operaciones por prueba en lugar de duración")
+    parser.add_argument('--semilla', type=int, default=42, help="Semilla de los generadores aleatorios")
+    parser.add_argument('--con-cache', action='store_true', help="Mide las lecturas con la caché de películas")
+    parser.add_argument('--salida', default=None, help="Fichero JSON de resultados")
+    parser.add_argument('--comparar', default=None, help="Fichero JSON de una ejecución anterior")
+    parser.add_argument('--tolerancia', type=float, default=0.10,
+                        help="Caída de rendimiento admitida al comparar (0.10 = 10%%)")
+    parser.add_argument('--arranque', type=int, default=None, metavar='VECES',
+                        help="Mide solo el tiempo de arranque de app.py, tantas veces")
+    args = parser.parse_args()
+
+    if args.arranque:
+        arranque = medir_arranque(args.arranque)
+        print(f"Arranque de app.py: p50 {arranque['app']['p50']} ms, máx. {arranque['app']['max']} ms "
+              f"(objetivo {OBJETIVO_ARRANQUE_MS} ms; solo psycopg2: p50 {arranque['psycopg2']['p50']} ms, "
+              f"app.py añade {round(arranque['app']['p50'] - arranque['psycopg2']['p50'], 1)} ms)")
+        sys.exit(1 if arranque['app']['p50'] > OBJETIVO_ARRANQUE_MS else 0)
+
+    usuarios = args.usuarios or max(1, args.peliculas // 10)
+    estudios = args.estudios or max(1, args.peliculas // 1000)
+    # Las lecturas primero, para que no midan lo que han cambiado las escrituras
+    nombres = sorted(args.operacion or list(OPERACIONES), key=lambda nombre: nombre in ESCRITURAS)
+    escrituras = sorted(set(nombres) & ESCRITURAS)
+    if escrituras and not args.vaciar and not args.conservar_datos:
+        parser.error(f"las operaciones {', '.join(escrituras)} modifican los datos sembrados, así que dos "
+                     "ejecuciones no medirían los mismos datos. Usa --vaciar para vaciar las tablas y volver "
+                     "a sembrarlas antes de medir, --conservar-datos para medir sobre los datos actuales, "
+                     "o --operacion para medir solo lecturas.")
+    resembrar = bool(escrituras) and args.vaciar and not args.conservar_datos
+    if not args.con_cache:
+        app.cache_peliculas.tamano = 0
+
+    pool = PoolConexiones.desde_config(minconn=args.concurrencia, maxconn=args.concurrencia + 1)
+    try:
+        with pool.conexion() as conn:
+            if args.sembrar or resembrar:
+                print(f"Sembrando {args.peliculas} películas, {usuarios} usuarios y {estudios} estudios...")
+                inicio = time.perf_counter()
+                sembrar(conn, args.peliculas, usuarios, estudios, vaciar=args.vaciar)
+                print(f"Sembrado en {time.perf_counter() - inicio:.1f} s")
+            with conn.cursor() as cursor:
+                cursor.execute("SHOW server_version")
+                version = cursor.fetchone()[0]
+                cursor.execute("SELECT count(*) FROM pg_inherits WHERE inhparent = 'pelicula'::regclass")
+                particiones = cursor.fetchone()[0]
+            conn.commit()
+
+        ctx = {
+            'peliculas': args.peliculas,
+            'usuarios': usuarios,
+            'estudios': estudios,
+            'nuevos_ids': itertools.count(args.peliculas + 1),
+        }
+        resultados = {}
+        for nombre in nombres:
+            print(f"Midiendo {nombre}...")
+            resultados[nombre] = medir(pool, nombre, args.concurrencia, args.duracion, args.operaciones,
+                                       args.semilla, ctx)
+            r = resultados[nombre]
+            print(f"  {r['ops_por_segundo']} ops/s, p50 {r['latencia_ms']['p50']} ms, "
+                  f"p99 {r['latencia_ms']['p99']} ms, errores {r['errores'] or 0}")
+
+        with pool.conexion() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("DELETE FROM PELICULA WHERE id_Pelicula > %s", (args.peliculas, ))
+            conn.commit()
+    finally:
+        pool.cerrar()
+
+    informe = {
+        'fecha': datetime.now().isoformat(timespec='seconds'),
+        'configuracion': {
+            'peliculas': args.peliculas,
+            'usuarios': usuarios,
+            'estudios': estudios,
+            'concurrencia': args.concurrencia,
+            'duracion': None if args.operaciones else args.duracion,
+            'operaciones': args.operaciones,
+            'semilla': args.semilla,
+            'con_cache': args.con_cache,
+            'particiones': particiones,
+        },
+        'entorno': {'python': platform.python_version(), 'postgresql': version, 'maquina': platform.node()},
+        'resultados': resultados,
+    }
+    if args.salida:
+        with open(args.salida, 'w', encoding='utf-8') as f:
+            json.dump(informe, f, indent=2, ensure_ascii=False)
+        print(f"Resultados guardados en {args.salida}")
+
+    if args.comparar:
+        with open(args.comparar, encoding='utf-8') as f:
+            anterior = json.load(f)
+        print(f"Comparación con {args.comparar}:")
+        regresiones = comparar(informe, anterior, args.tolerancia)
+        if regresiones:
+            print(f"Regresión de rendimiento en: {', '.join(regresiones)}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""
+Caché LRU en memoria con límite de tamaño y caducidad, segura entre hilos.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class CacheLRU:
+    """
+    Caché de lectura: cache.leer(clave, cargar) devuelve el valor guardado o llama a
+    cargar() y guarda el resultado. Los valores None no se guardan.
+
+    Si se invalida una clave mientras se está cargando, el valor cargado no se guarda,
+    para no volver a meter en la caché un dato leído antes de la escritura.
+    """
+
+    def __init__(self, tamano=10000, ttl=60.0):
+        self.tamano = tamano
+        self.ttl = ttl
+        self._datos = OrderedDict()     # clave -> (valor, instante de caducidad)
+        self._cargando = {}             # clave -> conjunto de marcas de las cargas en curso
+        self._cerrojo = threading.Lock()
+        self.aciertos = 0
+        self.fallos = 0
+        self.expulsiones = 0
+        self.invalidaciones = 0
+
+    def leer(self, clave, cargar):
+        """
+        :param clave: la clave buscada
+        :param cargar: función sin argumentos que obtiene el valor si no está en la caché
+        :return: el valor de la caché o el devuelto por cargar()
+        """
+        if self.tamano <= 0:
+            return cargar()
+
+        marca = object()
+        with self._cerrojo:
+            entrada = self._datos.get(clave)
+            if entrada is not None:
+                valor, caduca = entrada
+                if caduca > time.monotonic():
+                    self._datos.move_to_end(clave)
+                    self.aciertos += 1
+                    return valor
+                del self._datos[clave]
+            self.fallos += 1
+            self._cargando.setdefault(clave, set()).add(marca)
+
+        try:
+            valor = cargar()
+        finally:
+            with self._cerrojo:
+                marcas = self._cargando.get(clave)
+                vigente = marcas is not None and marca in marcas
+                if vigente:
+                    marcas.discard(marca)
+                    if not marcas:
+                        del self._cargando[clave]
+
+        if valor is not None and vigente:
+            with self._cerrojo:
+                self._datos[clave] = (valor, time.monotonic() + self.ttl)
+                self._datos.move_to_end(clave)
+                while len(self._datos) > self.tamano:
+                    self._datos.popitem(last=False)
+                    self.expulsiones += 1
+        return valor
+
+    def invalidar(self, clave):
+        """
+        Elimina una clave y descarta las cargas de esa clave que estén en curso.
+        """
+        with self._cerrojo:
+            self._datos.pop(clave, None)
+            self._cargando.pop(clave, None)
+            self.invalidaciones += 1
+
+    def limpiar(self):
+        with self._cerrojo:
+            self._datos.clear()
+            self._cargando.clear()
+
+    def estadisticas(self):
+        """
+        :return: diccionario con el tamaño y los contadores de la caché
+        """
+        with self._cerrojo:
+            consultas = self.aciertos + self.fallos
+            return {
+                'entradas': len(self._datos),
+                'tamano_maximo': self.tamano,
+                'ttl': self.ttl,
+                'aciertos': self.aciertos,
+                'fallos': self.fallos,
+                'tasa_aciertos': self.aciertos / consultas if consultas else 0.0,
+                'expulsiones': self.expulsiones,
+                'invalidaciones': self.invalidaciones,
+            }
@@ -0,0 +1,301 @@
+"""
+Suscripción a los cambios del catálogo registrados en CAMBIO (migraciones/008_cambios.sql;
+desde 010_cambios_por_sentencia.sql los disparadores copian las filas por sentencia).
+
+Cada suscriptor guarda su posición como una instantánea de transacciones
+(pg_snapshot): en cada lectura recibe los cambios de las transacciones confirmadas
+después de esa instantánea, y su posición pasa a ser la instantánea de la lectura.
+Así no se pierde ningún cambio aunque las transacciones no se confirmen en el orden
+de sus id, y un suscriptor con nombre retoma desde donde lo dejó (en
+CAMBIO_SUSCRIPTOR) al volver a arrancar.
+
+Los cambios se entregan en lotes de como mucho 'lote' filas y no se lee el lote
+siguiente hasta que se ha procesado el anterior. La posición se guarda cuando se han
+procesado todos los lotes de una lectura: si el proceso falla antes, esos cambios se
+vuelven a entregar (al menos una vez). Entre lecturas el suscriptor espera el NOTIFY
+bda_cambios, o 'intervalo' segundos como mucho.
+
+    python cambios.py seguir NOMBRE [--lote N]     imprime los cambios en JSONL
+    python cambios.py estado                       posición y pendientes de cada suscriptor
+    python cambios.py purgar [--dias 7]            borra los cambios ya leídos por todos
+"""
+import argparse
+import json
+import select
+import sys
+import threading
+
+import psycopg2
+import psycopg2.extensions
+
+from conexiones import leer_config
+
+
+CANAL = 'bda_cambios'
+
+# Cambios de las transacciones que no estaban confirmadas en la instantánea 'desde'
+# (todas las de la instantánea de la propia lectura, en REPEATABLE READ, lo están)
+SQL_LEER = """
+    SELECT id, txid::text AS txid, tabla, operacion, clave, datos, fecha
+    FROM CAMBIO
+    WHERE txid >= pg_snapshot_xmin(%(desde)s::pg_snapshot)
+      AND NOT pg_visible_in_snapshot(txid, %(desde)s::pg_snapshot)
+    ORDER BY id
+"""
+
+SQL_PURGAR = """
+    DELETE FROM CAMBIO
+    WHERE fecha < now() - make_interval(days => %(dias)s)
+      AND txid < COALESCE((SELECT pg_snapshot_xmin(posicion) FROM CAMBIO_SUSCRIPTOR ORDER BY 1 LIMIT 1),
+                          pg_snapshot_xmin(pg_current_snapshot()))
+"""
+
+SQL_ESTADO = """
+    SELECT s.nombre, s.posicion::text AS posicion, s.actualizado,
+           (SELECT count(*) FROM CAMBIO c
+            WHERE c.txid >= pg_snapshot_xmin(s.posicion)
+              AND NOT pg_visible_in_snapshot(c.txid, s.posicion)) AS pendientes
+    FROM CAMBIO_SUSCRIPTOR s
+    ORDER BY s.nombre
+"""
+
+
+## ------------------------------------------------------------
+def posicion_actual(cursor):
+    """
+    Instantánea de la transacción del cursor, para empezar a seguir los cambios justo
+    después de lo que esa transacción ve (p. ej. tras una carga completa hecha en la
+    misma transacción REPEATABLE READ).
+    :return: la instantánea en formato texto
+    """
+    cursor.execute("SELECT pg_current_snapshot()::text")
+    return cursor.fetchone()[0]
+
+
+def purgar(conn, dias=7):
+    """
+    Borra los cambios de hace más de 'dias' días que ya han leído todos los suscriptores
+    con nombre.
+    :param conn: la conexión abierta a la base de datos
+    :return: número de cambios borrados
+    """
+    with conn.cursor() as cursor:
+        try:
+            cursor.execute(SQL_PURGAR, {'dias': dias})
+            borrados = cursor.rowcount
+            conn.commit()
+        except psycopg2.Error:
+            conn.rollback()
+            raise
+    return borrados
+
+
+def estado(conn):
+    """
+    :return: lista de diccionarios con la posición y los cambios pendientes de cada suscriptor
+    """
+    with conn.cursor() as cursor:
+        try:
+            cursor.execute(SQL_ESTADO)
+            columnas = [c.name for c in cursor.description]
+            filas = [dict(zip(columnas, fila)) for fila in cursor.fetchall()]
+            conn.commit()
+        except psycopg2.Error:
+            conn.rollback()
+            raise
+    return filas
+
+
+## ------------------------------------------------------------
+class Suscriptor:
+    """
+    Lector de los cambios del catálogo con su propia conexión.
+    :param conectar: función sin argumentos que abre una conexión nueva
+    :param nombre: nombre con que se guarda la posición en CAMBIO_SUSCRIPTOR
+                   (None: la posición solo se guarda en memoria)
+    :param desde: posición inicial si el suscriptor no tiene una guardada
+                  (None: los cambios a partir de ahora)
+    :param lote: número máximo de cambios por lote
+    :param intervalo: segundos máximos de espera sin aviso entre lecturas
+    """
+
+    def __init__(self, conectar, nombre=None, desde=None, lote=1000, intervalo=5.0):
+        self.conectar = conectar
+        self.nombre = nombre
+        self.lote = lote
+        self.intervalo = intervalo
+        self.posicion = desde
+        self.entregados = 0
+        self._conn = None
+        self._aviso = None
+        self._cargar_posicion()
+
+    def _conexion(self):
+        if self._conn is None or self._conn.closed:
+            self._conn = self.conectar()
+            self._conn.set_session(isolation_level=psycopg2.extensions.ISOLATION_LEVEL_REPEATABLE_READ)
+        return self._conn
+
+    def _cargar_posicion(self):
+        conn = self._conexion()
+        with conn.cursor() as cursor:
+            try:
+                if self.nombre is not None:
+                    cursor.execute("SELECT posicion::text FROM CAMBIO_SUSCRIPTOR WHERE nombre = %s", (self.nombre, ))
+                    fila = cursor.fetchone()
+                    if fila is not None:
+                        self.posicion = fila[0]
+                if self.posicion is None:
+                    self.posicion = posicion_actual(cursor)
+                if self.nombre is not None:
+                    cursor.execute("""
+                        INSERT INTO CAMBIO_SUSCRIPTOR (nombre, posicion) VALUES (%s, %s::pg_snapshot)
+                        ON CONFLICT (nombre) DO NOTHING
+                    """, (self.nombre, self.posicion))
+                conn.commit()
+            except psycopg2.Error:
+                conn.rollback()
+                raise
+
+    ## ------------------------------------------------------------
+    def lotes(self):
+        """
+        Lee los cambios posteriores a la posición, en una transacción REPEATABLE READ.
+        Cuando se han recorrido todos los lotes, la posición avanza (y se guarda si el
+        suscriptor tiene nombre); si se deja de recorrer antes, no avanza.
+        :return: iterador de listas de diccionarios (id, txid, tabla, operacion, clave,
+                 datos, fecha), en orden de id dentro de cada lectura
+        """
+        conn = self._conexion()
+        completado = False
+        try:
+            with conn.cursor() as cursor:
+                nueva = posicion_actual(cursor)
+            cursor = conn.cursor(name='cambios')
+            cursor.itersize = self.lote
+            try:
+                cursor.execute(SQL_LEER, {'desde': self.posicion})
+                columnas = None
+                while True:
+                    filas = cursor.fetchmany(self.lote)
+                    if not filas:
+                        break
+                    columnas = columnas or [c.name for c in cursor.description]
+                    self.entregados += len(filas)
+                    yield [dict(zip(columnas, fila)) for fila in filas]
+            finally:
+                cursor.close()
+            if self.nombre is not None:
+                with conn.cursor() as cursor:
+                    cursor.execute("""
+                        UPDATE CAMBIO_SUSCRIPTOR SET posicion = %s::pg_snapshot, actualizado = now()
+                        WHERE nombre = %s
+                    """, (nueva, self.nombre))
+            conn.commit()
+            completado = True
+            self.posicion = nueva
+        finally:
+            if not completado and not conn.closed:
+                conn.rollback()
+
+    def esperar(self, segundos=None):
+        """
+        Espera un aviso de cambios (NOTIFY) o 'segundos' (por defecto 'intervalo').
+        :return: True si llegó algún aviso
+        """
+        if self._aviso is None or self._aviso.closed:
+            self._aviso = self.conectar()
+            self._aviso.autocommit = True
+            with self._aviso.cursor() as cursor:
+                cursor.execute(f"LISTEN {CANAL}")
+        segundos = self.intervalo if segundos is None else segundos
+        if not self._aviso.notifies and select.select([self._aviso], [], [], segundos) == ([], [], []):
+            return False
+        # Los avisos acumulados se atienden todos con la misma lectura
+        self._aviso.poll()
+        self._aviso.notifies.clear()
+        return True
+
+    def consumir(self, procesar, parar=None):
+        """
+        Entrega los cambios a procesar(lote) según llegan, hasta que se active 'parar'.
+        :param procesar: función que recibe cada lote; si lanza una excepción se deja
+                         de consumir y los cambios de esa lectura se volverán a entregar
+        :param parar: threading.Event que detiene el bucle (None: no se detiene)
+        """
+        # Se escucha antes de la primera lectura para no perder avisos entre una y otra
+        self.esperar(0)
+        while parar is None or not parar.is_set():
+            for lote in self.lotes():
+                procesar(lote)
+            self.esperar()
+
+    def cerrar(self):
+        for conn in (self._conn, self._aviso):
+            if conn is not None and not conn.closed:
+                conn.close()
+
+
+def seguir_en_hilo(suscriptor, procesar):
+    """
+    Consume los cambios en un hilo aparte. Si falla la conexión vuelve a intentarlo
+    tras 'intervalo' segundos.
+    :return: threading.Event que detiene el hilo al activarlo
+    """
+    parar = threading.Event()
+
+    def bucle():
+        while not parar.is_set():
+            try:
+                suscriptor.consumir(procesar, parar)
+            except psycopg2.Error as e:
+                print(f"Error al leer los cambios: {e}", file=sys.stderr)
+                suscriptor.cerrar()
+                parar.wait(suscriptor.intervalo)
+        suscriptor.cerrar()
+
+    threading.Thread(target=bucle, name='cambios', daemon=True).start()
+    return parar
+
+
+## ------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description="Cambios del catálogo.")
+    subparsers = parser.add_subparsers(dest='comando', required=True)
+    p_seguir = subparsers.add_parser('seguir', help="Imprime los cambios en JSONL según llegan")
+    p_seguir.add_argument('nombre', help="Nombre del suscriptor (guarda la posición)")
+    p_seguir.add_argument('--lote', type=int, default=1000)
+    subparsers.add_parser('estado', help="Posición y cambios pendientes de cada suscriptor")
+    p_purgar = subparsers.add_parser('purgar', help="Borra los cambios ya leídos por todos")
+    p_purgar.add_argument('--dias', type=int, default=7, help="Conservar los de los últimos días")
+    args = parser.parse_args()
+
+    params, _ = leer_config()
+    if args.comando == 'seguir':
+        suscriptor = Suscriptor(lambda: psycopg2.connect(**params), args.nombre, lote=args.lote)
+
+        def imprimir(lote):
+            for cambio in lote:
+                print(json.dumps(cambio, ensure_ascii=False, default=str))
+            sys.stdout.flush()
+
+        try:
+            suscriptor.consumir(imprimir)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            suscriptor.cerrar()
+        return
+
+    conn = psycopg2.connect(**params)
+    try:
+        if args.comando == 'estado':
+            print(json.dumps(estado(conn), indent=2, ensure_ascii=False, default=str))
+        else:
+            print(f"{purgar(conn, args.dias)} cambios borrados.")
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,354 @@
+"""
+Cola de escritura diferida para las valoraciones y las rebajas de precio.
+
+Las escrituras se guardan en memoria y un hilo las escribe en lotes, en una
+transacción por tipo, cuando hay 'max_pendientes' o cada 'intervalo' segundos.
+Las escrituras sobre la misma fila se combinan antes de llegar a la base de datos:
+de varias valoraciones de un usuario a una película solo se escribe la última, y
+varias rebajas de una película se aplican como una sola (10% y luego 10% = 19%).
+
+Con ruta_wal cada escritura se añade antes a un fichero local (una línea JSON por
+escritura) que se vuelve a aplicar al crear la cola, así no se pierden escrituras si
+el proceso termina sin vaciarla. Tras confirmar cada transacción se quitan del fichero
+sus escrituras; si el proceso termina justo entre el commit y ese recorte, las rebajas
+de la transacción se aplicarían dos veces; las valoraciones no, porque guardar la
+misma es idempotente.
+
+Si un lote falla por un error que no se arregla repitiéndolo (p. ej. el usuario que
+valora no existe), se repite escribiendo cada elemento en su propio savepoint y se
+descartan solo los que fallan.
+"""
+import json
+import os
+import threading
+import time
+from collections import deque
+
+import psycopg2
+import psycopg2.extensions
+
+from conexiones import fijar_aislamiento, leer_config, reintentar
+
+
+class ColaEscritura:
+    """
+    Cola de valoraciones y rebajas de precio con su propio hilo y su propia conexión.
+    :param conectar: función sin argumentos que abre una conexión nueva
+    :param escribir_precio: función (cursor, id_pelicula, porcentaje) que rebaja un precio
+                            en la transacción en curso
+    :param escribir_valoracion: función (cursor, id_pelicula, dni, valoracion) que guarda
+                                una valoración en la transacción en curso
+    :param invalidar: función (id_pelicula) a la que se avisa de cada película escrita,
+                      p. ej. para quitarla de una caché (None: no se avisa)
+    :param max_pendientes: elementos pendientes que provocan un vaciado inmediato
+    :param intervalo: segundos máximos que espera una escritura antes de vaciarse
+    :param ruta_wal: fichero de registro local (None: solo en memoria)
+    :param sincronizar: hacer fsync del registro en cada escritura
+    """
+
+    def __init__(self, conectar, escribir_precio, escribir_valoracion, invalidar=None, max_pendientes=1000,
+                 intervalo=0.5, ruta_wal=None, sincronizar=False):
+        self.conectar = conectar
+        self.escribir_precio = escribir_precio
+        self.escribir_valoracion = escribir_valoracion
+        self.invalidar = invalidar
+        self.max_pendientes = max_pendientes
+        self.intervalo = intervalo
+        self.ruta_wal = ruta_wal
+        self.sincronizar = sincronizar
+
+        self._precios = {}          # id_pelicula -> factor por el que queda multiplicado el precio
+        self._valoraciones = {}     # (id_pelicula, dni) -> valoración
+        self._cerrojo = threading.Lock()
+        self._cerrojo_vaciado = threading.Lock()
+        self._aviso = threading.Event()
+        self._parar = False
+        self._conn = None
+        self._wal = None
+        self._wal_bytes = 0
+
+        self.encoladas = 0
+        self.coalescidas = 0
+        self.escritas = 0
+        self.descartadas = 0
+        self.vaciados = 0
+        self.errores = 0
+        self.ultimos_descartes = deque(maxlen=20)
+        self._latencias = deque(maxlen=1000)
+
+        if ruta_wal is not None:
+            self._recuperar_wal()
+            self._wal = open(ruta_wal, 'ab')
+            self._wal_bytes = self._wal.tell()
+
+        self._hilo = threading.Thread(target=self._bucle, name='cola_escritura', daemon=True)
+        self._hilo.start()
+
+    @classmethod
+    def desde_config(cls, ruta=None, **extra):
+        """
+        Crea la cola con los parámetros de conexión de leer_config y la configuración de
+        BDA_COLA_MAX, BDA_COLA_INTERVALO, BDA_COLA_WAL y BDA_COLA_FSYNC.
+        :param extra: escribir_precio, escribir_valoracion y el resto de argumentos de la
+                      cola; los que se indiquen aquí tienen prioridad sobre el entorno
+        """
+        params, _ = leer_config(ruta)
+        opciones = {
+            'max_pendientes': int(os.environ.get('BDA_COLA_MAX', 1000)),
+            'intervalo': float(os.environ.get('BDA_COLA_INTERVALO', 0.5)),
+            'ruta_wal': os.environ.get('BDA_COLA_WAL') or None,
+            'sincronizar': os.environ.get('BDA_COLA_FSYNC', '0') != '0',
+        }
+        opciones.update(extra)
+        return cls(lambda: psycopg2.connect(**params), **opciones)
+
+    ## ------------------------------------------------------------
+    def valorar(self, id_pelicula, dni, valoracion):
+        """
+        Encola la valoración de un usuario a una película.
+        :raises ValueError: si la valoración no está entre 1 y 5
+        """
+        if valoracion < 1 or valoracion > 5:
+            raise ValueError("La valoración debe estar entre 1 y 5.")
+        self._encolar({'t': 'v', 'id': id_pelicula, 'u': dni, 'v': valoracion})
+
+    def rebajar(self, id_pelicula, porcentaje):
+        """
+        Encola una rebaja del precio de una película.
+        :raises ValueError: si el porcentaje es mayor que 100
+        """
+        if porcentaje > 100:
+            raise ValueError("El decremento no puede ser mayor que 100%.")
+        self._encolar({'t': 'p', 'id': id_pelicula, 'd': porcentaje})
+
+    def _encolar(self, mutacion):
+        with self._cerrojo:
+            if self._parar:
+                raise RuntimeError("La cola de escritura está cerrada.")
+            if self._wal is not None:
+                linea = (json.dumps(mutacion) + '\n').encode('utf-8')
+                self._wal.write(linea)
+                self._wal.flush()
+                if self.sincronizar:
+                    os.fsync(self._wal.fileno())
+                self._wal_bytes += len(linea)
+            self._anadir(mutacion)
+            self.encoladas += 1
+            lleno = len(self._precios) + len(self._valoraciones) >= self.max_pendientes
+        if lleno:
+            self._aviso.set()
+
+    def _anadir(self, mutacion):
+        if mutacion['t'] == 'p':
+            factor = 1 - mutacion['d'] / 100
+            if mutacion['id'] in self._precios:
+                self.coalescidas += 1
+            self._precios[mutacion['id']] = self._precios.get(mutacion['id'], 1.0) * factor
+        else:
+            clave = (mutacion['id'], mutacion['u'])
+            if clave in self._valoraciones:
+                self.coalescidas += 1
+            self._valoraciones[clave] = mutacion['v']
+
+    def _recuperar_wal(self):
+        if not os.path.isfile(self.ruta_wal):
+            return
+        with open(self.ruta_wal, encoding='utf-8') as f:
+            for linea in f:
+                if linea.strip():
+                    try:
+                        self._anadir(json.loads(linea))
+                    except (ValueError, KeyError):
+                        # Última línea a medio escribir si el proceso terminó de golpe
+                        break
+
+    ## ------------------------------------------------------------
+    def _bucle(self):
+        while not self._parar:
+            self._aviso.wait(self.intervalo)
+            self._aviso.clear()
+            try:
+                self.vaciar()
+            except (psycopg2.Error, OSError):
+                pass    # Ya contado en errores; las escrituras siguen pendientes
+
+    def vaciar(self):
+        """
+        Escribe ahora todas las escrituras pendientes: las rebajas en una transacción
+        SERIALIZABLE y las valoraciones en otra READ COMMITTED, en orden de id para no
+        provocar interbloqueos. Tras confirmar cada transacción se quitan sus escrituras
+        del registro y se avisa de las películas escritas, así un fallo en la segunda no
+        hace repetir la primera.
+        :return: número de elementos escritos
+        :raises psycopg2.Error: si no se pudo escribir un lote; sigue pendiente
+        :raises OSError: si no se pudo recortar el registro
+        """
+        with self._cerrojo_vaciado:
+            with self._cerrojo:
+                precios, self._precios = self._precios, {}
+                valoraciones, self._valoraciones = self._valoraciones, {}
+                corte = self._wal_bytes
+            if not precios and not valoraciones:
+                return 0
+
+            inicio = time.perf_counter()
+            escritas = 0
+            try:
+                conn = self._conexion()
+                if precios:
+                    fijar_aislamiento(conn, psycopg2.extensions.ISOLATION_LEVEL_SERIALIZABLE)
+                    escritas += self._escribir_lote(conn, sorted(precios.items()), self._escribir_precio)
+                    afectadas, precios = set(precios), {}
+                    corte = self._confirmado(afectadas, corte, 'p')
+                if valoraciones:
+                    fijar_aislamiento(conn, psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED)
+                    escritas += self._escribir_lote(conn, sorted(valoraciones.items()), self._escribir_valoracion)
+                    afectadas, valoraciones = {id_pelicula for id_pelicula, _ in valoraciones}, {}
+                    self._confirmado(afectadas, corte)
+            except (psycopg2.Error, OSError):
+                # Solo vuelve a la cola lo que no llegó a confirmarse
+                with self._cerrojo:
+                    self.errores += 1
+                    self.escritas += escritas
+                    for id_pelicula, factor in precios.items():
+                        self._precios[id_pelicula] = self._precios.get(id_pelicula, 1.0) * factor
+                    for clave, valoracion in valoraciones.items():
+                        self._valoraciones.setdefault(clave, valoracion)
+                raise
+
+            with self._cerrojo:
+                self.escritas += escritas
+                self.vaciados += 1
+                self._latencias.append(time.perf_counter() - inicio)
+            return escritas
+
+    def _conexion(self):
+        if self._conn is None or self._conn.closed:
+            self._conn = self.conectar()
+        return self._conn
+
+    def _confirmado(self, afectadas, corte, tipo=None):
+        """
+        Avisa de las películas de un lote ya confirmado y quita sus escrituras del registro.
+        :return: bytes que quedan en el registro de los primeros 'corte'
+        """
+        if self.invalidar is not None:
+            for id_pelicula in afectadas:
+                self.invalidar(id_pelicula)
+        with self._cerrojo:
+            return self._recortar_wal(corte, tipo)
+
+    def _escribir_lote(self, conn, elementos, escribir):
+        def todos(cursor):
+            for elemento in elementos:
+                escribir(cursor, elemento)
+            return len(elementos)
+
+        def por_separado(cursor):
+            descartes = []
+            for elemento in elementos:
+                cursor.execute("SAVEPOINT mutacion")
+                try:
+                    escribir(cursor, elemento)
+                    cursor.execute("RELEASE SAVEPOINT mutacion")
+                except psycopg2.Error as e:
+                    cursor.execute("ROLLBACK TO SAVEPOINT mutacion")
+                    descartes.append((elemento, e.pgcode))
+            return descartes
+
+        try:
+            return reintentar(conn, todos)
+        except psycopg2.Error as e:
+            if conn.closed or e.pgcode is None:
+                raise
+        descartes = reintentar(conn, por_separado)
+        self.descartadas += len(descartes)
+        self.ultimos_descartes.extend(descartes)
+        return len(elementos) - len(descartes)
+
+    def _escribir_precio(self, cursor, elemento):
+        id_pelicula, factor = elemento
+        self.escribir_precio(cursor, id_pelicula, round((1 - factor) * 100, 10))
+
+    def _escribir_valoracion(self, cursor, elemento):
+        (id_pelicula, dni), valoracion = elemento
+        self.escribir_valoracion(cursor, id_pelicula, dni, valoracion)
+
+    def _recortar_wal(self, corte, tipo=None):
+        """
+        Quita del registro las escrituras ya confirmadas de los primeros 'corte' bytes:
+        todas, o solo las del tipo indicado ('p' rebajas, 'v' valoraciones).
+        :return: bytes que quedan de los primeros 'corte'
+        """
+        if self._wal is None:
+            return 0
+        with open(self.ruta_wal, 'rb') as f:
+            previas = f.read(corte)
+            resto = f.read()
+        quedan = b''
+        if tipo is not None:
+            quedan = b''.join(linea for linea in previas.splitlines(keepends=True)
+                              if self._tipo_linea(linea) not in (tipo, None))
+        temporal = self.ruta_wal + '.tmp'
+        with open(temporal, 'wb') as f:
+            f.write(quedan)
+            f.write(resto)
+            f.flush()
+            os.fsync(f.fileno())
+        self._wal.close()
+        try:
+            os.replace(temporal, self.ruta_wal)
+        finally:
+            self._wal = open(self.ruta_wal, 'ab')
+            self._wal_bytes = self._wal.tell()
+        return len(quedan)
+
+    @staticmethod
+    def _tipo_linea(linea):
+        try:
+            return json.loads(linea)['t']
+        except (ValueError, KeyError):
+            return None
+
+    ## ------------------------------------------------------------
+    def cerrar(self):
+        """
+        Detiene el hilo, escribe lo pendiente y cierra la conexión y el registro.
+        :raises psycopg2.Error: si no se pudo escribir lo pendiente (queda en el registro)
+        """
+        with self._cerrojo:
+            self._parar = True
+        self._aviso.set()
+        self._hilo.join()
+        try:
+            self.vaciar()
+        finally:
+            if self._conn is not None and not self._conn.closed:
+                self._conn.close()
+            if self._wal is not None:
+                self._wal.close()
+
+    def estadisticas(self):
+        """
+        :return: diccionario con la profundidad de la cola, los contadores y la latencia
+                 de los vaciados en milisegundos
+        """
+        with self._cerrojo:
+            latencias = sorted(self._latencias)
+            pendientes = len(self._precios) + len(self._valoraciones)
+            ms = lambda v: round(v * 1000, 3)
+            return {
+                'pendientes': pendientes,
+                'encoladas': self.encoladas,
+                'coalescidas': self.coalescidas,
+                'escritas': self.escritas,
+                'descartadas': self.descartadas,
+                'vaciados': self.vaciados,
+                'errores': self.errores,
+                'latencia_vaciado_ms': {
+                    'media': ms(sum(latencias) / len(latencias)) if latencias else None,
+                    'p50': ms(latencias[len(latencias) // 2]) if latencias else None,
+                    'p99': ms(latencias[min(len(latencias) - 1, len(latencias) * 99 // 100)]) if latencias else None,
+                    'max': ms(latencias[-1]) if latencias else None,
+                },
+            }
@@ -0,0 +1,177 @@
+"""
+Comprueba con EXPLAIN que las consultas de app.py usan índices y no recorren
+tablas enteras.
+
+Conviene ejecutarlo sobre una base de datos de pruebas con muchos datos, porque con
+tablas pequeñas el planificador prefiere un Seq Scan aunque exista el índice:
+
+    python comprobar_indices.py --sembrar 1000000 --vaciar
+
+Termina con código 1 si alguna consulta hace un Seq Scan sobre PELICULA, USUARIO, ESTUDIO o las tablas
+de valoraciones. Si PELICULA está particionada (particionar.py), también si alguna de
+las consultas de una sola película lee más de una partición, y si la búsqueda por
+relevancia no lee las películas ya ordenadas de un índice (k vecinos más próximos).
+"""
+import argparse
+import json
+import sys
+from datetime import datetime
+
+import psycopg2
+
+import analitica
+import app
+from conexiones import leer_config
+from semilla import GENEROS, dni_sembrado, sembrar
+
+
+TABLAS = {'pelicula', 'usuario', 'estudio', 'valoracion', 'valoracion_resumen'}
+
+# Consultas por id_Pelicula, que con PELICULA particionada deben leer una sola partición
+UNA_PELICULA = {"obtener_pelicula", "modificar_pelicula", "modificar_pelicula con versión", "borrar_pelicula",
+                "rebajar_precio"}
+
+# Consultas que deben leer las filas ordenadas por distancia de un índice GiST
+# (Index Scan con 'Order By'), en lugar de puntuarlas todas y ordenarlas
+ORDEN_POR_INDICE = {"buscar_peliculas por relevancia": '<<->'}
+
+
+def consultas(particionada=False):
+    """
+    :param particionada: si PELICULA es una tabla particionada
+    :return: lista de tuplas (descripción, sentencia, parámetros) con las consultas a revisar
+    """
+    dni = dni_sembrado(1)
+    # PostgreSQL comprueba las claves externas de una tabla particionada sin ONLY
+    only = "" if particionada else "ONLY "
+    lista = [
+        ("obtener_pelicula", app.SQL_OBTENER_PELICULA, {'c': 1}),
+        ("modificar_pelicula", app.SQL_MODIFICAR_PELICULA,
+         {'c': 1, 'm': 'Titulo', 'a': datetime(2000, 1, 1), 'p': 10}),
+        ("modificar_pelicula con versión", app.SQL_MODIFICAR_PELICULA_VERSION,
+         {'c': 1, 'm': 'Titulo', 'a': datetime(2000, 1, 1), 'p': 10, 'v': 0}),
+        ("borrar_pelicula", app.SQL_BORRAR_PELICULA, (1, )),
+        ("rebajar_precio", app.SQL_REBAJAR_PRECIO, {'m': 1, 'd': 10}),
+        ("valoración anterior", app.SQL_VALORACION_ANTERIOR, {'p': 1, 'u': dni}),
+        ("resumen de valoraciones", app.SQL_SUMAR_RESUMEN, {'p': 1, 'v': 5}),
+        ("mejor valoradas", app.SQL_MEJOR_VALORADAS, {'n': 10, 'minimo': 1}),
+        ("peliculas del usuario", app._sql_peliculas_usuario(None, True), {'dni': dni, 'n': 101}),
+        ("peliculas del usuario (página siguiente)", app._sql_peliculas_usuario(1000, True),
+         {'dni': dni, 'despues': 1000, 'n': 101}),
+        # Las mismas consultas que lanza PostgreSQL para comprobar las claves externas
+        # al borrar un usuario o un estudio
+        ("clave externa a USUARIO", f"SELECT 1 FROM {only}PELICULA x WHERE id_Us = %(dni)s FOR KEY SHARE OF x",
+         {'dni': dni}),
+        ("clave externa a USUARIO desde VALORACION",
+         "SELECT 1 FROM ONLY VALORACION x WHERE id_Us = %(dni)s FOR KEY SHARE OF x", {'dni': dni}),
+        ("clave externa a ESTUDIO", f"SELECT 1 FROM {only}PELICULA x WHERE id_Est = %(e)s FOR KEY SHARE OF x",
+         {'e': 1}),
+    ]
+    for prefijo in (False, True):
+        modo = "autocompletado" if prefijo else "relevancia"
+        params = {'texto': 'pelicula 1', 'patron': 'pelicula 1%', 'genero': GENEROS[0], 'n': 21}
+        lista.append((f"buscar_peliculas por {modo}", app._sql_buscar_peliculas(prefijo, None, None), params))
+        lista.append((f"buscar_peliculas por {modo} y género", app._sql_buscar_peliculas(prefijo, GENEROS[0], None),
+                      params))
+
+    for tipo, sql in sorted(analitica.SQL_INFORMES.items()):
+        lista.append((f"informe de {tipo}", sql, {'limite': 50, 'pais': None, 'desde': None, 'hasta': None}))
+
+    filtros = [
+        ("estudio y género", {'id_estudio': 1, 'genero': GENEROS[0]}),
+        ("género y año", {'genero': GENEROS[0], 'desde': 2000, 'hasta': 2000}),
+        ("lista de ids", {'ids': [1, 2, 3]}),
+    ]
+    for descripcion, filtro in filtros:
+        condicion, params = app._filtro_peliculas(**filtro)
+        params['d'] = 10
+        lista.append((f"rebajar_precios por {descripcion}", app.SQL_REBAJAR_PRECIOS.format(filtro=condicion), params))
+        lista.append((f"lote de rebajar_precios por {descripcion}",
+                      app.SQL_LOTE_PRECIOS.format(filtro=condicion, desde_id="AND id_Pelicula > %(ultimo)s"),
+                      dict(params, ultimo=0, lote=1000)))
+    return lista
+
+
+def nodos(plan):
+    """
+    Recorre el árbol de un plan en formato JSON.
+    """
+    yield plan
+    for hijo in plan.get('Plans', []):
+        yield from nodos(hijo)
+
+
+def comprobar(conn):
+    """
+    Muestra el plan resumido de cada consulta.
+    :return: lista de descripciones de las consultas que recorren una tabla entera,
+             que leen de más particiones de las necesarias o que no usan el índice
+             que les da el orden
+    """
+    fallos = []
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT inhrelid::regclass::text FROM pg_inherits WHERE inhparent = 'pelicula'::regclass")
+        particiones = {row[0] for row in cursor.fetchall()}
+        for descripcion, sql, params in consultas(bool(particiones)):
+            cursor.execute("EXPLAIN (FORMAT JSON) " + sql.strip().rstrip(';'), params)
+            plan = cursor.fetchone()[0]
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            accesos = []
+            leidas = set()
+            secuenciales = False
+            operador = ORDEN_POR_INDICE.get(descripcion)
+            sin_orden = operador is not None
+            for nodo in nodos(plan[0]['Plan']):
+                if (operador is not None and nodo['Node Type'] in ('Index Scan', 'Index Only Scan')
+                        and operador in nodo.get('Order By', '')):
+                    sin_orden = False
+                tabla = nodo.get('Relation Name')
+                if tabla is None or nodo['Node Type'] in ('ModifyTable', 'LockRows'):
+                    continue
+                accesos.append(f"{nodo['Node Type']} {tabla}" +
+                               (f" ({nodo['Index Name']})" if 'Index Name' in nodo else ""))
+                if tabla in particiones:
+                    leidas.add(tabla)
+                    tabla = 'pelicula'
+                if nodo['Node Type'] == 'Seq Scan' and tabla.lower() in TABLAS:
+                    secuenciales = True
+            sin_poda = descripcion in UNA_PELICULA and len(leidas) > 1
+            if particiones:
+                accesos.append(f"{len(leidas)} de {len(particiones)} particiones")
+            if sin_orden:
+                accesos.append(f"sin orden por índice ({operador})")
+            fallo = secuenciales or sin_poda or sin_orden
+            print(f"[{'FALLO' if fallo else ' OK  '}] {descripcion}: "
+                  f"{', '.join(accesos) or 'sin lecturas'}")
+            if fallo:
+                fallos.append(descripcion)
+    conn.rollback()
+    return fallos
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Comprueba que las consultas de app.py usan índices.")
+    parser.add_argument('--sembrar', type=int, default=None, metavar='PELICULAS',
+                        help="Siembra antes este número de películas")
+    parser.add_argument('--vaciar', action='store_true', help="Vacía las tablas antes de sembrar")
+    args = parser.parse_args()
+
+    params, _ = leer_config()
+    conn = psycopg2.connect(**params)
+    try:
+        if args.sembrar:
+            print(f"Sembrando {args.sembrar} películas...")
+            sembrar(conn, args.sembrar, vaciar=args.vaciar)
+        fallos = comprobar(conn)
+    finally:
+        conn.close()
+
+    if fallos:
+        print(f"{len(fallos)} consultas recorren tablas enteras, leen particiones de más o no usan su índice.")
+        sys.exit(1)
+    print("Todas las consultas usan índices.")
+
+
+if __name__ == '__main__':
+    main()
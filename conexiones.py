@@ -0,0 +1,530 @@
+"""
+Configuración de la conexión a PostgreSQL y pool de conexiones reutilizables.
+
+Los parámetros se leen, por este orden de prioridad, de las variables de entorno
+BDA_HOST, BDA_PORT, BDA_DATABASE, BDA_USER y BDA_PASSWORD, de la sección [postgresql]
+del fichero indicado en BDA_CONFIG (por defecto bda.ini) y de los valores por defecto.
+El tamaño del pool se configura igual con BDA_POOL_MIN, BDA_POOL_MAX y BDA_POOL_INACTIVO
+o en la sección [pool] del fichero.
+
+Las réplicas de solo lectura se indican en BDA_REPLICAS (cadenas de conexión de libpq
+separadas por ';') o en la sección [replicas] del fichero (una cadena por clave); lo
+que no indique cada cadena se toma de la conexión principal. El enrutado de lecturas
+(EnrutadorLecturas) se configura con BDA_REPLICAS_ESTRATEGIA, BDA_REPLICAS_RETRASO_MAX
+y BDA_REPLICAS_REINTENTO o en la sección [enrutado].
+"""
+import configparser
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.errorcodes
+import psycopg2.extensions
+import psycopg2.pool
+
+
+CONFIG_POR_DEFECTO = {
+    'host': 'localhost',
+    'port': '5432',
+    'database': 'diegodb',
+    'user': 'diego',
+    'password': 'clave',
+}
+
+POOL_POR_DEFECTO = {
+    'min': '1',
+    'max': '10',
+    'inactivo': '300',
+}
+
+ENRUTADO_POR_DEFECTO = {
+    'estrategia': 'turno',      # 'turno' (round-robin) o 'menos_conexiones'
+    'retraso_max': '',          # segundos de retraso admitidos en una réplica (vacío: sin límite)
+    'reintento': '30',          # segundos sin usar una réplica que ha fallado
+}
+
+
+## ------------------------------------------------------------
+def leer_config(ruta=None):
+    """
+    Lee los parámetros de conexión y del pool.
+    :param ruta: fichero de configuración; por defecto BDA_CONFIG o bda.ini
+    :return: tupla (parámetros para psycopg2.connect, parámetros del pool)
+    """
+    params = dict(CONFIG_POR_DEFECTO)
+    pool = dict(POOL_POR_DEFECTO)
+
+    ruta = ruta or os.environ.get('BDA_CONFIG', 'bda.ini')
+    if os.path.isfile(ruta):
+        fichero = configparser.ConfigParser()
+        fichero.read(ruta, encoding='utf-8')
+        if fichero.has_section('postgresql'):
+            params.update(fichero['postgresql'])
+        if fichero.has_section('pool'):
+            pool.update(fichero['pool'])
+
+    for clave in CONFIG_POR_DEFECTO:
+        valor = os.environ.get(f'BDA_{clave.upper()}')
+        if valor is not None:
+            params[clave] = valor
+    for clave in POOL_POR_DEFECTO:
+        valor = os.environ.get(f'BDA_POOL_{clave.upper()}')
+        if valor is not None:
+            pool[clave] = valor
+
+    return params, {'minconn': int(pool['min']),
+                    'maxconn': int(pool['max']),
+                    'max_inactivo': float(pool['inactivo'])}
+
+
+def leer_replicas(ruta=None):
+    """
+    Lee las réplicas de solo lectura y la configuración del enrutado.
+    :param ruta: fichero de configuración; por defecto BDA_CONFIG o bda.ini
+    :return: tupla (lista de parámetros para psycopg2.connect de cada réplica,
+             parámetros del enrutado); la lista está vacía si no hay réplicas
+    """
+    params, _ = leer_config(ruta)
+    cadenas = []
+    enrutado = dict(ENRUTADO_POR_DEFECTO)
+
+    ruta = ruta or os.environ.get('BDA_CONFIG', 'bda.ini')
+    if os.path.isfile(ruta):
+        fichero = configparser.ConfigParser()
+        fichero.read(ruta, encoding='utf-8')
+        if fichero.has_section('replicas'):
+            cadenas = [fichero['replicas'][clave] for clave in sorted(fichero['replicas'])]
+        if fichero.has_section('enrutado'):
+            enrutado.update(fichero['enrutado'])
+
+    if os.environ.get('BDA_REPLICAS') is not None:
+        cadenas = os.environ['BDA_REPLICAS'].split(';')
+    for clave in ENRUTADO_POR_DEFECTO:
+        valor = os.environ.get(f'BDA_REPLICAS_{clave.upper()}')
+        if valor is not None:
+            enrutado[clave] = valor
+
+    replicas = []
+    for cadena in cadenas:
+        if not cadena.strip():
+            continue
+        replica = dict(params)
+        replica.update(psycopg2.extensions.parse_dsn(cadena))
+        if 'dbname' in replica:
+            replica['database'] = replica.pop('dbname')
+        replicas.append(replica)
+    return replicas, {'estrategia': enrutado['estrategia'],
+                      'retraso_max': float(enrutado['retraso_max']) if enrutado['retraso_max'] else None,
+                      'reintento': float(enrutado['reintento'])}
+
+
+## ------------------------------------------------------------
+# Marca de los hilos que están dentro de una lectura servida por una réplica
+_hilo = threading.local()
+
+
+def leyendo_de_replica():
+    """
+    Indica si el hilo actual está dentro de un EnrutadorLecturas.lectura que ha ido a
+    una réplica. Lo leído ahí puede ir por detrás de la principal, así que no debe
+    guardarse en cachés que comparten las lecturas hechas en la principal.
+    """
+    return getattr(_hilo, 'en_replica', False)
+
+
+def fijar_aislamiento(conn, nivel):
+    """
+    Fija el nivel de aislamiento de la conexión solo si es distinto del actual,
+    para no cambiar la sesión en cada operación.
+    :param conn: la conexión abierta a la base de datos
+    :param nivel: una de las constantes psycopg2.extensions.ISOLATION_LEVEL_*
+    """
+    if conn.isolation_level != nivel:
+        conn.isolation_level = nivel
+
+
+# Errores que se resuelven repitiendo la transacción
+ERRORES_REINTENTABLES = (psycopg2.errorcodes.SERIALIZATION_FAILURE, psycopg2.errorcodes.DEADLOCK_DETECTED)
+
+
+def reintentar(conn, operacion, reintentos=5, espera=0.05):
+    """
+    Ejecuta operacion(cursor) en una transacción y hace commit, repitiéndola con una espera
+    creciente si falla por un conflicto de serialización o un interbloqueo.
+    :param conn: la conexión abierta a la base de datos
+    :param operacion: función que recibe un cursor y devuelve el resultado de la transacción
+    :param reintentos: número máximo de repeticiones
+    :param espera: espera inicial en segundos; se duplica en cada reintento
+    :return: lo que devuelva operacion
+    """
+    intento = 0
+    while True:
+        with conn.cursor() as cursor:
+            try:
+                resultado = operacion(cursor)
+                conn.commit()
+                return resultado
+            except psycopg2.Error as e:
+                conn.rollback()
+                if e.pgcode not in ERRORES_REINTENTABLES or intento >= reintentos:
+                    raise
+        time.sleep(espera * (2 ** intento) * (0.5 + random.random()))
+        intento += 1
+
+
+## ------------------------------------------------------------
+class PoolConexiones:
+    """
+    Pool de conexiones seguro entre hilos.
+
+    Las conexiones libres se agrupan por nivel de aislamiento, de modo que al pedir
+    una conexión para un nivel se reutiliza preferentemente una que ya lo tenga.
+    Las conexiones que llevan más de 'max_inactivo' segundos sin usarse se cierran
+    mientras haya más de 'minconn', y las que llevan más de 'comprobar_tras'
+    segundos inactivas se comprueban con un SELECT 1 antes de entregarse.
+    """
+
+    def __init__(self, minconn=1, maxconn=10, max_inactivo=300.0, comprobar_tras=30.0, **params):
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise ValueError("Tamaños de pool no válidos.")
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.max_inactivo = max_inactivo
+        self.comprobar_tras = comprobar_tras
+        self._params = params
+        self._libres = {}       # nivel -> lista de (conexión, instante de devolución)
+        self._en_uso = set()
+        self._cond = threading.Condition()
+        self._cerrado = False
+        for _ in range(minconn):
+            conn = self._conectar()
+            self._libres.setdefault(conn.isolation_level, []).append((conn, time.monotonic()))
+
+    @classmethod
+    def desde_config(cls, ruta=None, **extra):
+        """
+        Crea un pool con la configuración de leer_config().
+        """
+        params, pool = leer_config(ruta)
+        pool.update(extra)
+        return cls(**pool, **params)
+
+    def _conectar(self):
+        conn = psycopg2.connect(**self._params)
+        conn.autocommit = False
+        return conn
+
+    def _num_libres(self):
+        return sum(len(lista) for lista in self._libres.values())
+
+    def _expulsar_inactivas(self):
+        """
+        Cierra las conexiones inactivas demasiado tiempo, respetando el mínimo.
+        Se llama con el cerrojo tomado.
+        """
+        limite = time.monotonic() - self.max_inactivo
+        for lista in self._libres.values():
+            while lista and lista[0][1] < limite and self._num_libres() + len(self._en_uso) > self.minconn:
+                conn, _ = lista.pop(0)
+                conn.close()
+
+    def _sana(self, conn, devuelta):
+        """
+        Comprueba que la conexión sigue viva si lleva tiempo sin usarse.
+        """
+        if conn.closed:
+            return False
+        if time.monotonic() - devuelta < self.comprobar_tras:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            conn.close()
+            return False
+
+    def obtener(self, nivel=psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED, espera=None):
+        """
+        Entrega una conexión con el nivel de aislamiento indicado ya fijado.
+        :param nivel: una de las constantes psycopg2.extensions.ISOLATION_LEVEL_*
+        :param espera: segundos máximos de espera si el pool está lleno (None: sin límite)
+        :raises psycopg2.pool.PoolError: si el pool está cerrado o se agota la espera
+        """
+        limite = None if espera is None else time.monotonic() + espera
+        while True:
+            with self._cond:
+                if self._cerrado:
+                    raise psycopg2.pool.PoolError("El pool de conexiones está cerrado.")
+                self._expulsar_inactivas()
+
+                conn = devuelta = None
+                if self._libres.get(nivel):
+                    conn, devuelta = self._libres[nivel].pop()
+                else:
+                    for lista in self._libres.values():
+                        if lista:
+                            conn, devuelta = lista.pop()
+                            break
+
+                if conn is None and self._num_libres() + len(self._en_uso) < self.maxconn:
+                    conn = self._conectar()
+                    devuelta = time.monotonic()
+
+                if conn is None:
+                    restante = None if limite is None else limite - time.monotonic()
+                    if restante is not None and restante <= 0:
+                        raise psycopg2.pool.PoolError("No hay conexiones libres en el pool.")
+                    self._cond.wait(restante)
+                    continue
+
+                self._en_uso.add(conn)
+
+            # La comprobación se hace fuera del cerrojo para no bloquear a los demás hilos
+            if not self._sana(conn, devuelta):
+                with self._cond:
+                    self._en_uso.discard(conn)
+                    self._cond.notify()
+                continue
+            fijar_aislamiento(conn, nivel)
+            return conn
+
+    def devolver(self, conn):
+        """
+        Devuelve una conexión al pool deshaciendo la transacción que haya quedado abierta.
+        """
+        if not conn.closed and conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                conn.close()
+        with self._cond:
+            self._en_uso.discard(conn)
+            if self._cerrado or conn.closed:
+                if not conn.closed:
+                    conn.close()
+            else:
+                self._libres.setdefault(conn.isolation_level, []).append((conn, time.monotonic()))
+            self._cond.notify()
+
+    @contextmanager
+    def conexion(self, nivel=psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED, espera=None):
+        """
+        Uso: with pool.conexion(nivel) as conn: ...
+        """
+        conn = self.obtener(nivel, espera)
+        try:
+            yield conn
+        finally:
+            self.devolver(conn)
+
+    def cerrar(self):
+        """
+        Cierra todas las conexiones libres; las que estén en uso se cierran al devolverse.
+        """
+        with self._cond:
+            self._cerrado = True
+            for lista in self._libres.values():
+                for conn, _ in lista:
+                    conn.close()
+            self._libres.clear()
+            self._cond.notify_all()
+
+
+## ------------------------------------------------------------
+class EnrutadorLecturas:
+    """
+    Reparte las operaciones de solo lectura entre las réplicas, con un pool por réplica.
+
+    Las réplicas se eligen por turno o por la que tenga menos conexiones en uso. Se
+    descartan las que han fallado en los últimos 'reintento' segundos, las que llevan
+    más de 'retraso_max' segundos de retraso y, si la lectura indica la posición (LSN)
+    de una escritura anterior, las que todavía no la han aplicado; así quien acaba de
+    escribir lee lo que escribió. Si no queda ninguna, la lectura va a la principal.
+
+    El retraso de cada réplica se consulta como mucho cada 'comprobar_cada' segundos.
+    Un servidor que no está en recuperación (p. ej. una segunda instancia local para
+    pruebas) se trata como réplica sin retraso.
+    """
+
+    ESTRATEGIAS = ('turno', 'menos_conexiones')
+
+    SQL_ESTADO = """
+        SELECT CASE WHEN NOT pg_is_in_recovery() THEN 0
+                    WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                    ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+               END,
+               pg_last_wal_replay_lsn()::text
+    """
+
+    def __init__(self, replicas, estrategia='turno', retraso_max=None, reintento=30.0, comprobar_cada=1.0,
+                 **pool):
+        if estrategia not in self.ESTRATEGIAS:
+            raise ValueError(f"Estrategia de enrutado desconocida: {estrategia}.")
+        self.estrategia = estrategia
+        self.retraso_max = retraso_max
+        self.reintento = reintento
+        self.comprobar_cada = comprobar_cada
+        self._pool = dict(pool, minconn=0)
+        self._replicas = [{'params': params, 'pool': None, 'caida_hasta': 0.0, 'comprobada': None,
+                           'retraso': None, 'lsn': None, 'lecturas': 0, 'fallos': 0}
+                          for params in replicas]
+        self._cerrojo = threading.Lock()
+        self._turno = 0
+        self.a_principal = 0
+
+    @classmethod
+    def desde_config(cls, ruta=None, **extra):
+        """
+        Crea el enrutador con las réplicas de leer_replicas() y el tamaño de pool de
+        leer_config(); None si no hay réplicas configuradas.
+        :param extra: parámetros adicionales de cada pool (p. ej. connection_factory)
+        """
+        replicas, enrutado = leer_replicas(ruta)
+        if not replicas:
+            return None
+        _, pool = leer_config(ruta)
+        return cls(replicas, **enrutado, **pool, **extra)
+
+    def _candidatas(self):
+        """
+        Réplicas no caídas, en el orden en que se deben probar según la estrategia.
+        """
+        ahora = time.monotonic()
+        with self._cerrojo:
+            vivas = [r for r in self._replicas if r['caida_hasta'] <= ahora]
+            if self.estrategia == 'menos_conexiones':
+                vivas.sort(key=lambda r: len(r['pool']._en_uso) if r['pool'] is not None else 0)
+            elif vivas:
+                self._turno = (self._turno + 1) % len(vivas)
+                vivas = vivas[self._turno:] + vivas[:self._turno]
+            return vivas
+
+    def _al_dia(self, replica, conn, lsn):
+        """
+        Comprueba el retraso de la réplica (si hace falta) y si ha aplicado la escritura lsn.
+        """
+        ahora = time.monotonic()
+        pendiente = lsn is not None and replica['lsn'] is not None and not self._lsn_mayor_igual(replica['lsn'], lsn)
+        if replica['comprobada'] is None or ahora - replica['comprobada'] >= self.comprobar_cada or pendiente:
+            with conn.cursor() as cursor:
+                cursor.execute(self.SQL_ESTADO)
+                retraso, lsn_replica = cursor.fetchone()
+            conn.rollback()
+            replica['retraso'], replica['lsn'], replica['comprobada'] = float(retraso), lsn_replica, ahora
+        if self.retraso_max is not None and replica['retraso'] > self.retraso_max:
+            return False
+        return lsn is None or replica['lsn'] is None or self._lsn_mayor_igual(replica['lsn'], lsn)
+
+    @staticmethod
+    def _lsn_mayor_igual(a, b):
+        """
+        Compara dos posiciones del WAL en formato texto ('16/B374D848').
+        """
+        def numero(lsn):
+            alto, _, bajo = lsn.partition('/')
+            return (int(alto, 16) << 32) | int(bajo, 16)
+        return numero(a) >= numero(b)
+
+    def _obtener(self, nivel, lsn):
+        """
+        :return: tupla (réplica, conexión), o (None, None) si ninguna sirve
+        """
+        for replica in self._candidatas():
+            try:
+                with self._cerrojo:
+                    if replica['pool'] is None:
+                        replica['pool'] = PoolConexiones(**self._pool, **replica['params'])
+                conn = replica['pool'].obtener(nivel, espera=0)
+            except psycopg2.pool.PoolError:
+                continue        # Réplica sin conexiones libres: se prueba la siguiente
+            except psycopg2.OperationalError:
+                self._caida(replica)
+                continue
+            al_dia = False
+            try:
+                al_dia = self._al_dia(replica, conn, lsn)
+            except psycopg2.OperationalError:
+                self._caida(replica)
+            finally:
+                # La conexión vuelve al pool salvo que se entregue, también si _al_dia falla
+                if not al_dia:
+                    replica['pool'].devolver(conn)
+            if al_dia:
+                return replica, conn
+        return None, None
+
+    def _caida(self, replica):
+        with self._cerrojo:
+            replica['caida_hasta'] = time.monotonic() + self.reintento
+            replica['fallos'] += 1
+
+    @contextmanager
+    def lectura(self, principal, nivel=psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED, lsn=None):
+        """
+        Uso: with enrutador.lectura(lambda: pool.conexion(nivel), nivel, lsn) as conn: ...
+        :param principal: función sin argumentos que devuelve un gestor de contexto con
+                          una conexión a la principal, que se usa si ninguna réplica sirve
+        :param lsn: posición de una escritura que la lectura debe ver (de posicion_escritura)
+        """
+        replica, conn = self._obtener(nivel, lsn)
+        if replica is None:
+            with self._cerrojo:
+                self.a_principal += 1
+            with principal() as conn:
+                yield conn
+            return
+        with self._cerrojo:
+            replica['lecturas'] += 1
+        anterior = getattr(_hilo, 'en_replica', False)
+        _hilo.en_replica = True
+        try:
+            yield conn
+        finally:
+            _hilo.en_replica = anterior
+            replica['pool'].devolver(conn)
+
+    @staticmethod
+    def posicion_escritura(conn):
+        """
+        Posición actual del WAL de la principal, para leer después en una réplica lo
+        escrito hasta ahora. Se llama tras el commit de la escritura.
+        :param conn: conexión a la principal, sin transacción en curso
+        :return: la posición en formato texto
+        """
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT pg_current_wal_lsn()::text")
+            lsn = cursor.fetchone()[0]
+        conn.commit()
+        return lsn
+
+    def estadisticas(self):
+        """
+        :return: diccionario con las lecturas servidas por cada réplica y por la principal
+        """
+        ahora = time.monotonic()
+        with self._cerrojo:
+            return {
+                'estrategia': self.estrategia,
+                'retraso_max': self.retraso_max,
+                'a_principal': self.a_principal,
+                'replicas': [{
+                    'host': r['params'].get('host'),
+                    'port': r['params'].get('port'),
+                    'caida': r['caida_hasta'] > ahora,
+                    'retraso': r['retraso'],
+                    'lecturas': r['lecturas'],
+                    'fallos': r['fallos'],
+                    'en_uso': len(r['pool']._en_uso) if r['pool'] is not None else 0,
+                } for r in self._replicas],
+            }
+
+    def cerrar(self):
+        with self._cerrojo:
+            for replica in self._replicas:
+                if replica['pool'] is not None:
+                    replica['pool'].cerrar()
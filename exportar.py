@@ -0,0 +1,204 @@
+"""
+Exportación de PELICULA, USUARIO y ESTUDIO a ficheros Parquet.
+
+Las filas se leen con un cursor del servidor en lotes de 'lote' filas; cada lote se
+convierte en un RecordBatch de Arrow y se escribe en el fichero antes de leer el
+siguiente, así que la memoria no depende del tamaño de las tablas. Las tres tablas
+se leen en una misma transacción REPEATABLE READ, de modo que la exportación es una
+foto coherente de la base de datos.
+
+Con --incremental solo se exportan las filas modificadas (columna 'actualizado',
+migraciones/006_actualizado.sql) desde la exportación anterior. La marca de cada
+tabla se guarda en el fichero de estado del directorio de salida y se deja --margen
+segundos por detrás de la hora de la exportación, para no saltarse filas de
+transacciones que estuvieran en curso durante la exportación y duren menos que eso.
+Los borrados no se exportan.
+
+    python exportar.py salida/ [--tabla pelicula ...] [--incremental] [--lote 50000]
+"""
+import argparse
+import json
+import os
+import sys
+from datetime import datetime, timedelta
+
+import psycopg2
+import psycopg2.extensions
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from conexiones import leer_config
+
+
+# Columnas y tipos Arrow de cada tabla, en el orden de la consulta
+ESQUEMAS = {
+    'pelicula': pa.schema([
+        ('id_pelicula', pa.int64()),
+        ('id_us', pa.string()),
+        ('id_est', pa.int64()),
+        ('precio', pa.decimal128(10, 2)),
+        ('titulo', pa.string()),
+        ('duracion_minutos', pa.int32()),
+        ('año', pa.timestamp('us')),
+        ('genero', pa.string()),
+        ('valoracion', pa.int32()),
+        ('version', pa.int64()),
+        ('actualizado', pa.timestamp('us')),
+    ]),
+    'usuario': pa.schema([
+        ('dni', pa.string()),
+        ('nombre', pa.string()),
+        ('apellido', pa.string()),
+        ('telefono', pa.string()),
+        ('actualizado', pa.timestamp('us')),
+    ]),
+    'estudio': pa.schema([
+        ('id_estudio', pa.int64()),
+        ('nombree', pa.string()),
+        ('paisorigen', pa.string()),
+        ('actualizado', pa.timestamp('us')),
+    ]),
+}
+
+ESTADO = 'exportacion.json'
+
+
+def _sql_exportar(tabla, incremental):
+    """
+    Consulta de exportación de una tabla; en incremental, las filas modificadas entre
+    %(desde)s y %(hasta)s.
+    """
+    sql = f"SELECT {', '.join(ESQUEMAS[tabla].names)} FROM {tabla}"
+    if incremental:
+        sql += " WHERE actualizado > %(desde)s AND actualizado <= %(hasta)s"
+    return sql
+
+
+def leer_estado(directorio):
+    """
+    :return: diccionario tabla -> marca (datetime) de la última exportación
+    """
+    ruta = os.path.join(directorio, ESTADO)
+    if not os.path.isfile(ruta):
+        return {}
+    with open(ruta, encoding='utf-8') as f:
+        return {tabla: datetime.fromisoformat(marca) for tabla, marca in json.load(f).items()}
+
+
+def guardar_estado(directorio, estado):
+    ruta = os.path.join(directorio, ESTADO)
+    with open(ruta + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump({tabla: marca.isoformat() for tabla, marca in estado.items()}, f, indent=2)
+    os.replace(ruta + '.tmp', ruta)
+
+
+## ------------------------------------------------------------
+def exportar_tabla(conn, tabla, ruta, desde=None, hasta=None, lote=50000, compresion='zstd'):
+    """
+    Escribe una tabla (o sus filas modificadas entre desde y hasta) en un fichero Parquet,
+    lote a lote, dentro de la transacción en curso de conn. El fichero se escribe con
+    otro nombre y se renombra al terminar.
+    :param conn: la conexión abierta a la base de datos
+    :param tabla: 'pelicula', 'usuario' o 'estudio'
+    :param ruta: fichero Parquet de salida
+    :param desde: exportar solo las filas modificadas después de esta fecha (None: todas)
+    :param hasta: y hasta esta fecha (obligatoria si se indica desde)
+    :param lote: filas por viaje al servidor y por grupo de filas del fichero
+    :return: número de filas exportadas
+    """
+    esquema = ESQUEMAS[tabla]
+    temporal = ruta + '.tmp'
+    filas = 0
+    cursor = conn.cursor(name=f'exportar_{tabla}')
+    cursor.itersize = lote
+    try:
+        cursor.execute(_sql_exportar(tabla, desde is not None), {'desde': desde, 'hasta': hasta})
+        with pq.ParquetWriter(temporal, esquema, compression=compresion) as escritor:
+            while True:
+                bloque = cursor.fetchmany(lote)
+                if not bloque:
+                    break
+                columnas = list(zip(*bloque))
+                escritor.write_batch(pa.RecordBatch.from_arrays(
+                    [pa.array(valores, type=campo.type) for valores, campo in zip(columnas, esquema)],
+                    schema=esquema))
+                filas += len(bloque)
+    except BaseException:
+        if os.path.exists(temporal):
+            os.remove(temporal)
+        raise
+    finally:
+        cursor.close()
+    os.replace(temporal, ruta)
+    return filas
+
+
+def exportar(conn, directorio, tablas=None, incremental=False, lote=50000, margen=60.0, compresion='zstd'):
+    """
+    Exporta las tablas a directorio/<tabla>/<tabla>-<fecha>[-incremental].parquet en una
+    sola transacción REPEATABLE READ de solo lectura.
+    :param conn: la conexión abierta a la base de datos
+    :param tablas: tablas a exportar (None: todas)
+    :param incremental: solo las filas modificadas desde la última exportación de cada tabla;
+                        las tablas sin exportación anterior se exportan enteras
+    :param margen: segundos que la marca queda por detrás de la hora de la exportación
+    :return: diccionario tabla -> (ruta del fichero, filas exportadas)
+    """
+    tablas = list(ESQUEMAS) if tablas is None else tablas
+    os.makedirs(directorio, exist_ok=True)
+    estado = leer_estado(directorio)
+
+    conn.set_session(isolation_level=psycopg2.extensions.ISOLATION_LEVEL_REPEATABLE_READ, readonly=True)
+    resultado = {}
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT now()")
+            ahora = cursor.fetchone()[0]
+        hasta = ahora - timedelta(seconds=margen)
+        sufijo = f"{ahora:%Y%m%dT%H%M%S}"
+        for tabla in tablas:
+            desde = estado.get(tabla) if incremental else None
+            carpeta = os.path.join(directorio, tabla)
+            os.makedirs(carpeta, exist_ok=True)
+            ruta = os.path.join(carpeta, f"{tabla}-{sufijo}{'-incremental' if desde else ''}.parquet")
+            resultado[tabla] = (ruta, exportar_tabla(conn, tabla, ruta, desde, hasta, lote, compresion))
+            # En una exportación completa la marca también es 'hasta': las filas más
+            # recientes se volverán a exportar en la siguiente incremental
+            estado[tabla] = hasta
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        conn.set_session(isolation_level=psycopg2.extensions.ISOLATION_LEVEL_DEFAULT, readonly=False)
+    guardar_estado(directorio, estado)
+    return resultado
+
+
+## ------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description="Exporta el catálogo a ficheros Parquet.")
+    parser.add_argument('directorio', help="Directorio de salida")
+    parser.add_argument('--tabla', action='append', choices=sorted(ESQUEMAS), help="Tabla a exportar; se puede repetir")
+    parser.add_argument('--incremental', action='store_true', help="Solo las filas modificadas desde la anterior")
+    parser.add_argument('--lote', type=int, default=50000, help="Filas por lote")
+    parser.add_argument('--margen', type=float, default=60.0, help="Segundos de margen de la marca incremental")
+    parser.add_argument('--compresion', default='zstd', choices=['zstd', 'snappy', 'gzip', 'none'])
+    args = parser.parse_args()
+
+    params, _ = leer_config()
+    conn = psycopg2.connect(**params)
+    try:
+        resultado = exportar(conn, args.directorio, args.tabla, args.incremental, args.lote, args.margen,
+                             args.compresion)
+    except psycopg2.Error as e:
+        print(f"Error {e.pgcode}: {e.pgerror}")
+        sys.exit(1)
+    finally:
+        conn.close()
+    for tabla, (ruta, filas) in resultado.items():
+        print(f"{tabla}: {filas} filas en {ruta}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,504 @@
+"""
+Instantánea del catálogo en memoria para lecturas sin ir a la base de datos.
+
+Guarda precio, duracion_Minutos, genero, estudio y valoración de todas las películas
+en arrays de NumPy por columnas, ordenados por id_Pelicula para buscar por búsqueda
+binaria, o con un índice directo si los id son casi consecutivos. El género y el
+estudio se guardan como códigos (int16 e int32) de un diccionario. Cada columna es
+un fichero .npy que los lectores abren con mmap: varios procesos comparten la misma
+memoria y abrir la instantánea no lee nada del disco.
+
+Cada construcción o actualización escribe una generación nueva en un subdirectorio y
+después cambia el fichero ACTUAL que apunta a ella, así que los lectores nunca ven
+una generación a medias; con Instantanea.recargar() pasan a la última.
+
+La actualización incremental lee del registro de cambios (cambios.py) los cambios de
+PELICULA y VALORACION_RESUMEN desde la instantánea anterior. La posición se guarda
+como un suscriptor más en CAMBIO_SUSCRIPTOR, para que 'cambios.py purgar' no borre
+cambios que aún no se han aplicado, y solo avanza después de publicar la generación.
+
+    python instantanea.py construir DIRECTORIO      carga completa
+    python instantanea.py actualizar DIRECTORIO     aplica los cambios pendientes
+    python instantanea.py seguir DIRECTORIO         actualiza según llegan los cambios
+    python instantanea.py medir DIRECTORIO          tiempo por búsqueda
+"""
+import argparse
+import bisect
+import json
+import os
+import shutil
+import sys
+import time
+
+import numpy as np
+import psycopg2
+import psycopg2.extensions
+
+import cambios
+from conexiones import leer_config
+
+
+SUSCRIPTOR = 'instantanea'
+ACTUAL = 'ACTUAL'
+# Generaciones que se conservan además de la actual, para los lectores que aún no han recargado
+CONSERVAR = 1
+# Si los id_Pelicula ocupan como mucho DENSIDAD veces su número, se guarda además un
+# índice directo (id - base -> posición) y buscar es un solo acceso a memoria en lugar
+# de una búsqueda binaria con un fallo de caché por paso
+DENSIDAD = 4
+
+COLUMNAS = {
+    'id_pelicula': np.int64,
+    'precio': np.float64,
+    'duracion': np.int32,
+    'genero': np.int16,
+    'estudio': np.int32,
+    # PELICULA.valoracion, la media de VALORACION_RESUMEN y la que muestra app.py
+    # (la media si la película tiene valoraciones); NaN si no hay
+    'valoracion_antigua': np.float32,
+    'media': np.float32,
+    'valoracion': np.float32,
+}
+
+SQL_CARGAR = """
+    SELECT c.id_Pelicula, c.precio, c.duracion_Minutos, c.genero, c.id_Est, c.valoracion, r.media
+    FROM PELICULA c
+    LEFT JOIN VALORACION_RESUMEN r ON r.id_Pelicula = c.id_Pelicula
+    ORDER BY c.id_Pelicula
+"""
+
+# Como cambios.SQL_LEER, solo con las tablas de la instantánea
+SQL_CAMBIOS = """
+    SELECT tabla, operacion, clave, datos
+    FROM CAMBIO
+    WHERE txid >= pg_snapshot_xmin(%(desde)s::pg_snapshot)
+      AND NOT pg_visible_in_snapshot(txid, %(desde)s::pg_snapshot)
+      AND tabla IN ('pelicula', 'valoracion_resumen')
+    ORDER BY id
+"""
+
+SQL_GUARDAR_POSICION = """
+    INSERT INTO CAMBIO_SUSCRIPTOR (nombre, posicion) VALUES (%s, %s::pg_snapshot)
+    ON CONFLICT (nombre) DO UPDATE SET posicion = EXCLUDED.posicion, actualizado = now()
+"""
+
+
+## ------------------------------------------------------------
+class Instantanea:
+    """
+    Lector de la instantánea de un directorio. Las columnas son atributos (arrays de
+    NumPy de solo lectura): id_pelicula, precio, duracion, genero, estudio, valoracion...
+    'generos' es la lista de géneros y 'estudios' el array de id_Estudio: el género de
+    la posición i es generos[genero[i]] y su estudio estudios[estudio[i]].
+    Para leer muchas películas conviene posiciones() con todos los id de una vez;
+    para una sola, posicion() y fila() buscan sobre memoryviews sin pasar por NumPy.
+    """
+
+    def __init__(self, directorio):
+        self.directorio = directorio
+        self.generacion = None
+        self.meta = None
+        if not self.recargar():
+            raise FileNotFoundError(f"No hay ninguna instantánea en {directorio}.")
+
+    def recargar(self):
+        """
+        Pasa a la última generación publicada si ha cambiado.
+        :return: True si se ha cambiado de generación
+        """
+        generacion = generacion_actual(self.directorio)
+        if generacion is None or generacion == self.generacion:
+            return False
+        carpeta = os.path.join(self.directorio, generacion)
+        with open(os.path.join(carpeta, 'meta.json'), encoding='utf-8') as f:
+            meta = json.load(f)
+        for columna in COLUMNAS:
+            setattr(self, columna, np.load(os.path.join(carpeta, f'{columna}.npy'), mmap_mode='r'))
+        self.estudios = np.load(os.path.join(carpeta, 'estudios.npy'), mmap_mode='r')
+        # Acceso elemento a elemento sin crear escalares de NumPy
+        self._vistas = {columna: memoryview(getattr(self, columna)) for columna in COLUMNAS}
+        self._vistas['estudios'] = memoryview(self.estudios)
+        self.base = meta.get('base')
+        self.indice = None
+        if self.base is not None:
+            self.indice = np.load(os.path.join(carpeta, 'indice.npy'), mmap_mode='r')
+            self._vistas['indice'] = memoryview(self.indice)
+        self.generos = meta['generos']
+        self.meta = meta
+        self.generacion = generacion
+        return True
+
+    def __len__(self):
+        return len(self.id_pelicula)
+
+    def posiciones(self, ids):
+        """
+        :param ids: array o lista de id_Pelicula
+        :return: array con la posición de cada id en las columnas, -1 si no está
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        if self.indice is not None:
+            j = ids - self.base
+            dentro = (j >= 0) & (j < len(self.indice))
+            return np.where(dentro, self.indice[np.where(dentro, j, 0)], -1)
+        pos = np.searchsorted(self.id_pelicula, ids)
+        pos[pos == len(self.id_pelicula)] = 0
+        return np.where(self.id_pelicula[pos] == ids, pos, -1) if len(self.id_pelicula) else np.full(len(ids), -1)
+
+    def posicion(self, id_pelicula):
+        """
+        :return: posición de una película en las columnas, -1 si no está
+        """
+        if self.indice is not None:
+            j = id_pelicula - self.base
+            indice = self._vistas['indice']
+            return indice[j] if 0 <= j < len(indice) else -1
+        ids = self._vistas['id_pelicula']
+        i = bisect.bisect_left(ids, id_pelicula)
+        return i if i < len(ids) and ids[i] == id_pelicula else -1
+
+    def fila(self, id_pelicula):
+        """
+        :return: diccionario con los datos de una película, o None si no está
+        """
+        i = self.posicion(id_pelicula)
+        if i < 0:
+            return None
+        v = self._vistas
+        valoracion = v['valoracion'][i]
+        return {
+            'id_pelicula': id_pelicula,
+            'precio': v['precio'][i],
+            'duracion_minutos': v['duracion'][i],
+            'genero': self.generos[v['genero'][i]],
+            'id_est': v['estudios'][v['estudio'][i]],
+            'valoracion': None if valoracion != valoracion else valoracion,
+        }
+
+
+def generacion_actual(directorio):
+    """
+    :return: nombre del subdirectorio de la generación publicada, o None si no hay
+    """
+    try:
+        with open(os.path.join(directorio, ACTUAL), encoding='utf-8') as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+## ------------------------------------------------------------
+def _codificar(valores, diccionario):
+    """
+    Códigos de los valores en el diccionario (valor -> código), al que se añaden los nuevos.
+    """
+    codigos = []
+    for valor in valores:
+        codigo = diccionario.get(valor)
+        if codigo is None:
+            codigo = diccionario[valor] = len(diccionario)
+        codigos.append(codigo)
+    return codigos
+
+
+def _nulos(valores):
+    return [np.nan if v is None else float(v) for v in valores]
+
+
+def _valoracion(columnas):
+    columnas['valoracion'] = np.where(np.isnan(columnas['media']), columnas['valoracion_antigua'],
+                                      columnas['media']).astype(np.float32)
+
+
+def _publicar(directorio, columnas, generos, estudios, posicion):
+    """
+    Escribe una generación nueva, la publica en ACTUAL y borra las antiguas.
+    :return: nombre de la generación
+    """
+    os.makedirs(directorio, exist_ok=True)
+    anterior = generacion_actual(directorio)
+    numero = int(anterior[1:]) + 1 if anterior else 1
+    generacion = f'g{numero:08d}'
+    carpeta = os.path.join(directorio, generacion)
+    temporal = carpeta + '.tmp'
+    shutil.rmtree(temporal, ignore_errors=True)
+    os.makedirs(temporal)
+    for columna, tipo in COLUMNAS.items():
+        np.save(os.path.join(temporal, f'{columna}.npy'), np.ascontiguousarray(columnas[columna], dtype=tipo))
+    orden = sorted(estudios, key=estudios.get)
+    np.save(os.path.join(temporal, 'estudios.npy'), np.array(orden, dtype=np.int64))
+    ids = columnas['id_pelicula']
+    base = None
+    if len(ids) and int(ids[-1]) - int(ids[0]) < DENSIDAD * len(ids):
+        base = int(ids[0])
+        indice = np.full(int(ids[-1]) - base + 1, -1, dtype=np.int32)
+        indice[ids - base] = np.arange(len(ids), dtype=np.int32)
+        np.save(os.path.join(temporal, 'indice.npy'), indice)
+    with open(os.path.join(temporal, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump({'generos': sorted(generos, key=generos.get), 'posicion': posicion, 'base': base,
+                   'peliculas': len(columnas['id_pelicula']), 'fecha': time.time()}, f, ensure_ascii=False)
+    os.rename(temporal, carpeta)
+    with open(os.path.join(directorio, ACTUAL + '.tmp'), 'w', encoding='utf-8') as f:
+        f.write(generacion)
+    os.replace(os.path.join(directorio, ACTUAL + '.tmp'), os.path.join(directorio, ACTUAL))
+
+    generaciones = sorted(g for g in os.listdir(directorio) if g.startswith('g') and not g.endswith('.tmp'))
+    for vieja in generaciones[:-(CONSERVAR + 1)]:
+        shutil.rmtree(os.path.join(directorio, vieja), ignore_errors=True)
+    return generacion
+
+
+## ------------------------------------------------------------
+def construir(conn, directorio, lote=100000):
+    """
+    Carga todo el catálogo en una transacción REPEATABLE READ y publica una generación.
+    La posición en el registro de cambios es la instantánea de esa transacción.
+    :param conn: la conexión abierta a la base de datos
+    :param lote: filas por viaje al servidor
+    :return: número de películas
+    """
+    generos, estudios = {}, {}
+    partes = {columna: [] for columna in COLUMNAS if columna != 'valoracion'}
+    conn.set_session(isolation_level=psycopg2.extensions.ISOLATION_LEVEL_REPEATABLE_READ)
+    try:
+        with conn.cursor() as cursor:
+            posicion = cambios.posicion_actual(cursor)
+        cursor = conn.cursor(name='instantanea')
+        cursor.itersize = lote
+        try:
+            cursor.execute(SQL_CARGAR)
+            while True:
+                filas = cursor.fetchmany(lote)
+                if not filas:
+                    break
+                ids, precios, duraciones, nombres, id_est, antiguas, medias = zip(*filas)
+                partes['id_pelicula'].append(np.array(ids, dtype=np.int64))
+                partes['precio'].append(np.array(precios, dtype=np.float64))
+                partes['duracion'].append(np.array(duraciones, dtype=np.int32))
+                partes['genero'].append(np.array(_codificar(nombres, generos), dtype=np.int16))
+                partes['estudio'].append(np.array(_codificar(id_est, estudios), dtype=np.int32))
+                partes['valoracion_antigua'].append(np.array(_nulos(antiguas), dtype=np.float32))
+                partes['media'].append(np.array(_nulos(medias), dtype=np.float32))
+        finally:
+            cursor.close()
+        columnas = {columna: np.concatenate(p) if p else np.zeros(0, dtype=COLUMNAS[columna])
+                    for columna, p in partes.items()}
+        _valoracion(columnas)
+        _publicar(directorio, columnas, generos, estudios, posicion)
+        # La posición se confirma después de publicar: si algo falla entre medias, los
+        # cambios se vuelven a aplicar, y aplicarlos dos veces da el mismo resultado
+        with conn.cursor() as cursor:
+            cursor.execute(SQL_GUARDAR_POSICION, (SUSCRIPTOR, posicion))
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        conn.set_session(isolation_level=psycopg2.extensions.ISOLATION_LEVEL_DEFAULT)
+    return len(columnas['id_pelicula'])
+
+
+def aplicar(columnas, generos, estudios, peliculas, resumenes):
+    """
+    Aplica cambios a las columnas de una generación y devuelve las de la siguiente.
+    :param columnas: diccionario columna -> array, ordenados por id_pelicula
+    :param generos: diccionario género -> código (se añaden los nuevos)
+    :param estudios: diccionario id_Estudio -> código (se añaden los nuevos)
+    :param peliculas: diccionario id_Pelicula -> fila nueva de PELICULA (None si se ha borrado)
+    :param resumenes: diccionario id_Pelicula -> media de sus valoraciones (None si no tiene)
+    :return: diccionario columna -> array nuevo
+    """
+    ids = columnas['id_pelicula']
+    cambiadas = np.array(sorted(peliculas), dtype=np.int64)
+    nuevas = {columna: np.zeros(0, dtype=tipo) for columna, tipo in COLUMNAS.items()}
+    if len(cambiadas):
+        pos = np.searchsorted(ids, cambiadas)
+        dentro = np.minimum(pos, max(len(ids) - 1, 0))
+        existe = (pos < len(ids)) & (ids[dentro] == cambiadas) if len(ids) else np.zeros(len(cambiadas), dtype=bool)
+        quedan = np.ones(len(ids), dtype=bool)
+        quedan[pos[existe]] = False
+
+        filas = [peliculas[int(i)] for i in cambiadas]
+        vivas = np.array([f is not None for f in filas], dtype=bool)
+        filas = [f for f in filas if f is not None]
+        # Un cambio de PELICULA no cambia su media de valoraciones
+        medias = np.where(existe, columnas['media'][dentro] if len(ids) else np.nan, np.nan)[vivas]
+        nuevas = {
+            'id_pelicula': cambiadas[vivas],
+            'precio': np.array([f['precio'] for f in filas], dtype=np.float64),
+            'duracion': np.array([f['duracion_minutos'] for f in filas], dtype=np.int32),
+            'genero': np.array(_codificar([f['genero'] for f in filas], generos), dtype=np.int16),
+            'estudio': np.array(_codificar([f['id_est'] for f in filas], estudios), dtype=np.int32),
+            'valoracion_antigua': np.array(_nulos([f['valoracion'] for f in filas]), dtype=np.float32),
+            'media': medias.astype(np.float32),
+        }
+        columnas = {columna: np.concatenate([np.asarray(columnas[columna])[quedan], nuevas[columna]])
+                    for columna in nuevas}
+        orden = np.argsort(columnas['id_pelicula'], kind='stable')
+        columnas = {columna: valores[orden] for columna, valores in columnas.items()}
+    else:
+        columnas = {columna: np.array(valores) for columna, valores in columnas.items() if columna != 'valoracion'}
+
+    if resumenes:
+        ids = columnas['id_pelicula']
+        con_resumen = np.array(sorted(resumenes), dtype=np.int64)
+        pos = np.searchsorted(ids, con_resumen)
+        dentro = np.minimum(pos, max(len(ids) - 1, 0))
+        existe = (pos < len(ids)) & (ids[dentro] == con_resumen) if len(ids) else np.zeros(len(con_resumen), bool)
+        columnas['media'][pos[existe]] = _nulos([resumenes[int(i)] for i in con_resumen[existe]])
+    _valoracion(columnas)
+    return columnas
+
+
+def actualizar(conn, directorio):
+    """
+    Aplica a la instantánea publicada los cambios registrados desde su posición y
+    publica una generación nueva. Si no hay instantánea (o su posición no está en
+    CAMBIO_SUSCRIPTOR) la construye entera.
+    :param conn: la conexión abierta a la base de datos
+    :return: número de cambios aplicados, o None si se ha construido entera
+    """
+    try:
+        actual = Instantanea(directorio)
+    except FileNotFoundError:
+        actual = None
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT posicion::text FROM CAMBIO_SUSCRIPTOR WHERE nombre = %s", (SUSCRIPTOR, ))
+        fila = cursor.fetchone()
+    conn.commit()
+    if actual is None or fila is None:
+        construir(conn, directorio)
+        return None
+    desde = fila[0]
+
+    peliculas, resumenes = {}, {}
+    leidos = 0
+    conn.set_session(isolation_level=psycopg2.extensions.ISOLATION_LEVEL_REPEATABLE_READ)
+    try:
+        with conn.cursor() as cursor:
+            posicion = cambios.posicion_actual(cursor)
+        cursor = conn.cursor(name='instantanea_cambios')
+        try:
+            cursor.execute(SQL_CAMBIOS, {'desde': desde})
+            for tabla, operacion, clave, datos in cursor:
+                # Solo cuenta el último cambio de cada película
+                if tabla == 'pelicula':
+                    peliculas[int(clave)] = None if operacion == 'D' else datos
+                elif operacion == 'D':
+                    resumenes[int(clave)] = None
+                else:
+                    resumenes[int(clave)] = datos['media']
+                leidos += 1
+        finally:
+            cursor.close()
+        if leidos:
+            generos = {g: i for i, g in enumerate(actual.generos)}
+            estudios = {int(e): i for i, e in enumerate(actual.estudios)}
+            columnas = {columna: getattr(actual, columna) for columna in COLUMNAS}
+            _publicar(directorio, aplicar(columnas, generos, estudios, peliculas, resumenes), generos, estudios,
+                      posicion)
+        with conn.cursor() as cursor:
+            cursor.execute(SQL_GUARDAR_POSICION, (SUSCRIPTOR, posicion))
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        conn.set_session(isolation_level=psycopg2.extensions.ISOLATION_LEVEL_DEFAULT)
+    return leidos
+
+
+def seguir(conectar, directorio, intervalo=5.0, parar=None):
+    """
+    Mantiene la instantánea al día: la actualiza cada vez que llega un aviso de cambios
+    (NOTIFY) o cada 'intervalo' segundos, hasta que se active 'parar'.
+    :param conectar: función sin argumentos que abre una conexión nueva
+    :param parar: threading.Event que detiene el bucle (None: no se detiene)
+    """
+    conn = conectar()
+    # Solo se usa para esperar los avisos; la posición la lleva actualizar()
+    aviso = cambios.Suscriptor(conectar, intervalo=intervalo)
+    try:
+        aviso.esperar(0)
+        while parar is None or not parar.is_set():
+            aplicados = actualizar(conn, directorio)
+            if aplicados:
+                print(f"{aplicados} cambios aplicados.", file=sys.stderr)
+            aviso.esperar()
+    finally:
+        aviso.cerrar()
+        conn.close()
+
+
+def medir(directorio, busquedas=1000000, semilla=42):
+    """
+    Mide la búsqueda de películas al azar: precio, duración, género y valoración de
+    todas en un solo array, y la posición y la fila de cada una por separado.
+    :return: diccionario con los nanosegundos por búsqueda de cada forma
+    """
+    instantanea = Instantanea(directorio)
+    rng = np.random.default_rng(semilla)
+    ids = rng.choice(instantanea.id_pelicula, size=busquedas) if len(instantanea) else np.zeros(0, np.int64)
+
+    inicio = time.perf_counter()
+    pos = instantanea.posiciones(ids)
+    _ = (instantanea.precio[pos], instantanea.duracion[pos], instantanea.genero[pos], instantanea.valoracion[pos])
+    en_bloque = time.perf_counter() - inicio
+
+    sueltas = ids[:min(busquedas, 100000)].tolist()
+    inicio = time.perf_counter()
+    for id_pelicula in sueltas:
+        instantanea.posicion(id_pelicula)
+    una_a_una = time.perf_counter() - inicio
+    inicio = time.perf_counter()
+    for id_pelicula in sueltas:
+        instantanea.fila(id_pelicula)
+    filas = time.perf_counter() - inicio
+    return {
+        'peliculas': len(instantanea),
+        'ns_en_bloque': round(en_bloque / max(len(ids), 1) * 1e9, 1),
+        'ns_posicion': round(una_a_una / max(len(sueltas), 1) * 1e9, 1),
+        'ns_fila': round(filas / max(len(sueltas), 1) * 1e9, 1),
+    }
+
+
+## ------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description="Instantánea del catálogo en arrays de NumPy.")
+    subparsers = parser.add_subparsers(dest='comando', required=True)
+    for comando, ayuda in (('construir', "Carga completa"), ('actualizar', "Aplica los cambios pendientes"),
+                           ('seguir', "Actualiza según llegan los cambios"), ('medir', "Tiempo por búsqueda")):
+        sub = subparsers.add_parser(comando, help=ayuda)
+        sub.add_argument('directorio')
+        if comando == 'seguir':
+            sub.add_argument('--intervalo', type=float, default=5.0, help="Segundos máximos entre actualizaciones")
+    args = parser.parse_args()
+
+    if args.comando == 'medir':
+        print(json.dumps(medir(args.directorio), indent=2))
+        return
+
+    params, _ = leer_config()
+    try:
+        if args.comando == 'seguir':
+            try:
+                seguir(lambda: psycopg2.connect(**params), args.directorio, args.intervalo)
+            except KeyboardInterrupt:
+                pass
+            return
+        conn = psycopg2.connect(**params)
+        try:
+            if args.comando == 'construir':
+                print(f"{construir(conn, args.directorio)} películas.")
+            else:
+                aplicados = actualizar(conn, args.directorio)
+                print("Construida entera." if aplicados is None else f"{aplicados} cambios aplicados.")
+        finally:
+            conn.close()
+    except psycopg2.Error as e:
+        print(f"Error {e.pgcode}: {e.pgerror}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,423 @@
+"""
+Métricas de latencia de las operaciones y de las sentencias SQL, y registro de
+consultas lentas.
+
+Las conexiones creadas con connection_factory=ConexionMedida miden cada execute de
+sus cursores (del tipo que sean): duración, filas y pgcode si falla. Las operaciones
+se miden con el gestor de contexto operacion(nombre), que además suma el tiempo
+pasado en la base de datos por las sentencias ejecutadas dentro; en las operaciones
+del menú la duración total incluye lo que tarda el usuario en contestar, el tiempo
+de base de datos no.
+
+Las sentencias que tardan más de BDA_LENTAS_MS milisegundos (200 por defecto) se
+escriben en BDA_LENTAS_FICHERO (consultas_lentas.jsonl) con la forma de sus
+parámetros, sin sus valores, y con su plan (EXPLAIN), que no vuelve a ejecutarla;
+con BDA_LENTAS_EXPLAIN=0 no se pide el plan. En el texto y en el plan los literales
+se cambian por ?, porque las sentencias de execute_values y mogrify llegan con los
+valores dentro. Con BDA_LENTAS_ANALYZE=1 el plan es el de EXPLAIN ANALYZE, que
+repite la sentencia dentro de un savepoint que luego se deshace: duplica su coste y,
+en transacciones SERIALIZABLE, sus bloqueos de lectura, así que solo conviene
+mientras se investiga una consulta.
+
+Las métricas se exportan en formato de texto de Prometheus (prometheus()) o como
+diccionario (como_dict()); servir_http(puerto) las publica en /metrics.
+"""
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+import psycopg2
+import psycopg2.extensions
+
+
+# Límites superiores (segundos) de los intervalos de los histogramas
+LIMITES = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_EXECUTE = re.compile(r'^\s*(EXECUTE|PREPARE)\s+(\w+)', re.IGNORECASE)
+_EXPLICABLE = re.compile(r'^\s*(SELECT|INSERT|UPDATE|DELETE|WITH|EXECUTE)\b', re.IGNORECASE)
+_ESPACIOS = re.compile(r'\s+')
+# Literales que execute_values o mogrify dejan en el texto: cadenas (también cortadas
+# al final del texto), números y, tras quitarlos, las listas de tuplas de VALUES
+_CADENAS = re.compile(r"'(?:[^']|'')*(?:'|$)")
+_NUMEROS = re.compile(r'(?<![\w$])-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?\b')
+_TUPLAS = re.compile(r'(\([?,\s]*\))(?:\s*,\s*\([?,\s]*\))+')
+
+
+class Histograma:
+    """
+    Histograma acumulado de duraciones, como los de Prometheus.
+    """
+
+    def __init__(self):
+        self.cubos = [0] * len(LIMITES)
+        self.total = 0
+        self.suma = 0.0
+
+    def observar(self, segundos):
+        for i, limite in enumerate(LIMITES):
+            if segundos <= limite:
+                self.cubos[i] += 1
+                break
+        self.total += 1
+        self.suma += segundos
+
+    def acumulados(self):
+        """
+        :return: lista de (límite, observaciones menores o iguales que el límite)
+        """
+        acumulado = 0
+        resultado = []
+        for limite, n in zip(LIMITES, self.cubos):
+            acumulado += n
+            resultado.append((limite, acumulado))
+        return resultado
+
+    def percentil(self, p):
+        """
+        Estimación del percentil p (0-100): el límite del primer intervalo que lo alcanza.
+        """
+        if not self.total:
+            return None
+        objetivo = p / 100 * self.total
+        for limite, acumulado in self.acumulados():
+            if acumulado >= objetivo:
+                return limite
+        return float('inf')
+
+
+def _sin_literales(sql):
+    """
+    Texto de una sentencia con los literales cambiados por ?, para que ni el registro de
+    consultas lentas ni las etiquetas de las métricas guarden datos (DNI, nombres,
+    teléfonos...) de las sentencias que llegan ya con los valores dentro.
+    """
+    sql = _NUMEROS.sub('?', _CADENAS.sub('?', sql))
+    return _TUPLAS.sub(r'\1, ...', _ESPACIOS.sub(' ', sql)).strip()
+
+
+def _nombre_sentencia(sql):
+    """
+    Etiqueta de una sentencia: el nombre de la sentencia preparada o el texto normalizado.
+    """
+    m = _EXECUTE.match(sql)
+    if m:
+        return m.group(2) if m.group(1).upper() == 'EXECUTE' else 'PREPARE'
+    # Solo el principio: las inserciones por lotes pueden tener megas de texto
+    return _sin_literales(sql[:400])[:80]
+
+
+def _forma(params):
+    """
+    Tipos de los parámetros sin sus valores, para el registro de consultas lentas.
+    """
+    def tipo(valor):
+        if isinstance(valor, (list, tuple)):
+            return f"{type(valor).__name__}[{len(valor)}]"
+        return type(valor).__name__
+
+    if params is None:
+        return None
+    if isinstance(params, dict):
+        return {clave: tipo(valor) for clave, valor in params.items()}
+    return [tipo(valor) for valor in params]
+
+
+## ------------------------------------------------------------
+class RegistroMetricas:
+    """
+    Contadores e histogramas de operaciones y sentencias, seguros entre hilos.
+    :param umbral_lenta: segundos a partir de los cuales una sentencia es lenta (None: sin registro)
+    :param ruta_lentas: fichero JSONL del registro de consultas lentas
+    :param explicar: añadir el plan (EXPLAIN) a las consultas lentas
+    :param analizar: obtener el plan con EXPLAIN ANALYZE, repitiendo la sentencia
+    """
+
+    def __init__(self, umbral_lenta=0.2, ruta_lentas='consultas_lentas.jsonl', explicar=True, analizar=False):
+        self.umbral_lenta = umbral_lenta
+        self.ruta_lentas = ruta_lentas
+        self.explicar = explicar
+        self.analizar = analizar
+        self._cerrojo = threading.Lock()
+        self._local = threading.local()
+        self._sentencias = {}       # nombre -> {'duracion': Histograma, 'filas': n, 'errores': {pgcode: n}}
+        self._operaciones = {}      # nombre -> {'duracion': Histograma, 'bd': Histograma, 'sentencias': n, 'errores': {}}
+        self.lentas = 0
+
+    @classmethod
+    def desde_entorno(cls):
+        ms = os.environ.get('BDA_LENTAS_MS', '200')
+        return cls(umbral_lenta=None if ms == '' else float(ms) / 1000,
+                   ruta_lentas=os.environ.get('BDA_LENTAS_FICHERO', 'consultas_lentas.jsonl'),
+                   explicar=os.environ.get('BDA_LENTAS_EXPLAIN', '1') != '0',
+                   analizar=os.environ.get('BDA_LENTAS_ANALYZE', '0') != '0')
+
+    def _pila(self):
+        pila = getattr(self._local, 'pila', None)
+        if pila is None:
+            pila = self._local.pila = []
+        return pila
+
+    @contextmanager
+    def operacion(self, nombre):
+        """
+        Mide una operación y el tiempo de base de datos de las sentencias ejecutadas
+        dentro, en el mismo hilo.
+        """
+        actual = {'bd': 0.0, 'sentencias': 0}
+        pila = self._pila()
+        pila.append(actual)
+        error = None
+        inicio = time.perf_counter()
+        try:
+            yield actual
+        except psycopg2.Error as e:
+            error = e.pgcode or type(e).__name__
+            raise
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            duracion = time.perf_counter() - inicio
+            pila.pop()
+            with self._cerrojo:
+                datos = self._operaciones.get(nombre)
+                if datos is None:
+                    datos = self._operaciones[nombre] = {'duracion': Histograma(), 'bd': Histograma(),
+                                                        'sentencias': 0, 'errores': {}}
+                datos['duracion'].observar(duracion)
+                datos['bd'].observar(actual['bd'])
+                datos['sentencias'] += actual['sentencias']
+                if error is not None:
+                    datos['errores'][error] = datos['errores'].get(error, 0) + 1
+
+    def sentencia(self, cursor, sql, params, duracion, pgcode):
+        """
+        Anota una sentencia ejecutada y, si es lenta, la escribe en el registro.
+        """
+        if isinstance(sql, bytes):
+            sql = sql.decode('utf-8', 'replace')
+        elif not isinstance(sql, str):
+            sql = sql.as_string(cursor.connection)
+        nombre = _nombre_sentencia(sql)
+        filas = max(cursor.rowcount, 0)
+        for actual in self._pila():
+            actual['bd'] += duracion
+            actual['sentencias'] += 1
+        with self._cerrojo:
+            datos = self._sentencias.get(nombre)
+            if datos is None:
+                datos = self._sentencias[nombre] = {'duracion': Histograma(), 'filas': 0, 'errores': {}}
+            datos['duracion'].observar(duracion)
+            datos['filas'] += filas
+            if pgcode is not None:
+                datos['errores'][pgcode] = datos['errores'].get(pgcode, 0) + 1
+        if self.umbral_lenta is not None and duracion >= self.umbral_lenta and nombre != 'PREPARE':
+            self._registrar_lenta(cursor, nombre, sql, params, duracion, filas, pgcode)
+
+    def _registrar_lenta(self, cursor, nombre, sql, params, duracion, filas, pgcode):
+        entrada = {
+            'fecha': datetime.now().isoformat(timespec='milliseconds'),
+            'sentencia': nombre,
+            'sql': _sin_literales(sql),
+            'parametros': _forma(params),
+            'segundos': round(duracion, 6),
+            'filas': filas,
+            'pgcode': pgcode,
+        }
+        if self.explicar and pgcode is None:
+            plan = self._explicar(cursor, sql, params, self.analizar)
+            entrada['plan'] = None if plan is None else [_sin_literales(linea) for linea in plan]
+        with self._cerrojo:
+            self.lentas += 1
+            if self.ruta_lentas:
+                with open(self.ruta_lentas, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(entrada, ensure_ascii=False, default=str) + '\n')
+
+    @staticmethod
+    def _explicar(cursor, sql, params, analizar=False):
+        """
+        Obtiene el plan de la sentencia dentro de un savepoint que se deshace, con un
+        cursor aparte para no perder el resultado del cursor original.
+        :param analizar: usar EXPLAIN ANALYZE, que vuelve a ejecutar la sentencia
+        :return: lista de líneas del plan, o None si no se puede obtener
+        """
+        conn = cursor.connection
+        if (getattr(cursor, 'name', None) or conn.autocommit or not _EXPLICABLE.match(sql)
+                or conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_INTRANS):
+            return None
+        auxiliar = psycopg2.extensions.cursor(conn)
+        try:
+            auxiliar.execute("SAVEPOINT bda_explain")
+            try:
+                auxiliar.execute(("EXPLAIN (ANALYZE, BUFFERS) " if analizar else "EXPLAIN ") + sql, params)
+                return [fila[0] for fila in auxiliar.fetchall()]
+            except psycopg2.Error as e:
+                return [f"EXPLAIN falló: {e.pgcode}"]
+            finally:
+                auxiliar.execute("ROLLBACK TO SAVEPOINT bda_explain")
+                auxiliar.execute("RELEASE SAVEPOINT bda_explain")
+        finally:
+            auxiliar.close()
+
+    ## ------------------------------------------------------------
+    def como_dict(self):
+        """
+        :return: diccionario con el número, la latencia media, p50, p95 y p99 (en ms,
+                 según los intervalos del histograma) y los errores de cada operación y sentencia
+        """
+        def resumen(h):
+            ms = lambda v: None if v is None else round(v * 1000, 3)
+            return {'total': h.total, 'media_ms': ms(h.suma / h.total) if h.total else None,
+                    'p50_ms': ms(h.percentil(50)), 'p95_ms': ms(h.percentil(95)), 'p99_ms': ms(h.percentil(99))}
+
+        with self._cerrojo:
+            return {
+                'operaciones': {nombre: dict(resumen(d['duracion']), bd=resumen(d['bd']),
+                                             sentencias=d['sentencias'], errores=dict(d['errores']))
+                                for nombre, d in self._operaciones.items()},
+                'sentencias': {nombre: dict(resumen(d['duracion']), filas=d['filas'], errores=dict(d['errores']))
+                               for nombre, d in self._sentencias.items()},
+                'consultas_lentas': self.lentas,
+            }
+
+    def prometheus(self):
+        """
+        :return: las métricas en el formato de texto de Prometheus
+        """
+        def etiqueta(valor):
+            return str(valor).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+        def histograma(lineas, metrica, etiquetas, h):
+            for limite, acumulado in h.acumulados():
+                lineas.append(f'{metrica}_bucket{{{etiquetas},le="{limite}"}} {acumulado}')
+            lineas.append(f'{metrica}_bucket{{{etiquetas},le="+Inf"}} {h.total}')
+            lineas.append(f'{metrica}_sum{{{etiquetas}}} {h.suma}')
+            lineas.append(f'{metrica}_count{{{etiquetas}}} {h.total}')
+
+        lineas = [
+            '# HELP bda_operacion_segundos Duración de las operaciones.',
+            '# TYPE bda_operacion_segundos histogram',
+        ]
+        with self._cerrojo:
+            for nombre, d in sorted(self._operaciones.items()):
+                histograma(lineas, 'bda_operacion_segundos', f'operacion="{etiqueta(nombre)}"', d['duracion'])
+            lineas += ['# HELP bda_operacion_bd_segundos Tiempo de base de datos de las operaciones.',
+                       '# TYPE bda_operacion_bd_segundos histogram']
+            for nombre, d in sorted(self._operaciones.items()):
+                histograma(lineas, 'bda_operacion_bd_segundos', f'operacion="{etiqueta(nombre)}"', d['bd'])
+            lineas += ['# HELP bda_operacion_errores_total Operaciones terminadas con error.',
+                       '# TYPE bda_operacion_errores_total counter']
+            for nombre, d in sorted(self._operaciones.items()):
+                for codigo, n in sorted(d['errores'].items()):
+                    lineas.append(f'bda_operacion_errores_total{{operacion="{etiqueta(nombre)}",'
+                                  f'codigo="{etiqueta(codigo)}"}} {n}')
+            lineas += ['# HELP bda_sentencia_segundos Duración de las sentencias SQL.',
+                       '# TYPE bda_sentencia_segundos histogram']
+            for nombre, d in sorted(self._sentencias.items()):
+                histograma(lineas, 'bda_sentencia_segundos', f'sentencia="{etiqueta(nombre)}"', d['duracion'])
+            lineas += ['# HELP bda_sentencia_filas_total Filas afectadas o devueltas por las sentencias.',
+                       '# TYPE bda_sentencia_filas_total counter']
+            for nombre, d in sorted(self._sentencias.items()):
+                lineas.append(f'bda_sentencia_filas_total{{sentencia="{etiqueta(nombre)}"}} {d["filas"]}')
+            lineas += ['# HELP bda_sentencia_errores_total Sentencias terminadas con error, por pgcode.',
+                       '# TYPE bda_sentencia_errores_total counter']
+            for nombre, d in sorted(self._sentencias.items()):
+                for codigo, n in sorted(d['errores'].items()):
+                    lineas.append(f'bda_sentencia_errores_total{{sentencia="{etiqueta(nombre)}",'
+                                  f'pgcode="{etiqueta(codigo)}"}} {n}')
+            lineas += ['# HELP bda_consultas_lentas_total Sentencias por encima del umbral de lentitud.',
+                       '# TYPE bda_consultas_lentas_total counter',
+                       f'bda_consultas_lentas_total {self.lentas}']
+        return '\n'.join(lineas) + '\n'
+
+
+registro = RegistroMetricas.desde_entorno()
+operacion = registro.operacion
+
+
+## ------------------------------------------------------------
+class _CursorMedido:
+    """
+    Se mezcla con la clase de cursor pedida para medir execute y executemany.
+    """
+
+    def execute(self, query, vars=None):
+        inicio = time.perf_counter()
+        pgcode = None
+        try:
+            return super().execute(query, vars)
+        except psycopg2.Error as e:
+            pgcode = e.pgcode or type(e).__name__
+            raise
+        finally:
+            registro.sentencia(self, query, vars, time.perf_counter() - inicio, pgcode)
+
+    def executemany(self, query, vars_list):
+        inicio = time.perf_counter()
+        pgcode = None
+        try:
+            return super().executemany(query, vars_list)
+        except psycopg2.Error as e:
+            pgcode = e.pgcode or type(e).__name__
+            raise
+        finally:
+            registro.sentencia(self, query, None, time.perf_counter() - inicio, pgcode)
+
+
+_clases_medidas = {}
+
+
+def _clase_medida(clase):
+    medida = _clases_medidas.get(clase)
+    if medida is None:
+        medida = _clases_medidas[clase] = type(f"{clase.__name__}Medido", (_CursorMedido, clase), {})
+    return medida
+
+
+class ConexionMedida(psycopg2.extensions.connection):
+    """
+    Conexión cuyos cursores, de la clase que se pida, anotan cada sentencia en 'registro'.
+    Se usa con psycopg2.connect(..., connection_factory=ConexionMedida).
+    """
+
+    def cursor(self, *args, **kwargs):
+        clase = kwargs.get('cursor_factory') or self.cursor_factory or psycopg2.extensions.cursor
+        kwargs['cursor_factory'] = _clase_medida(clase)
+        return super().cursor(*args, **kwargs)
+
+
+## ------------------------------------------------------------
+def servir_http(puerto, host='127.0.0.1'):
+    """
+    Publica las métricas en un hilo aparte: /metrics en formato Prometheus y
+    /metrics.json como JSON.
+    :return: el servidor HTTP (se detiene con shutdown())
+    """
+    # Se importa aquí: http.server tarda en cargarse y casi nunca se usa
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Manejador(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == '/metrics':
+                cuerpo, tipo = registro.prometheus().encode('utf-8'), 'text/plain; version=0.0.4'
+            elif self.path == '/metrics.json':
+                cuerpo, tipo = json.dumps(registro.como_dict()).encode('utf-8'), 'application/json'
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', f'{tipo}; charset=utf-8')
+            self.send_header('Content-Length', str(len(cuerpo)))
+            self.end_headers()
+            self.wfile.write(cuerpo)
+
+        def log_message(self, formato, *args):
+            pass
+
+    servidor = ThreadingHTTPServer((host, puerto), Manejador)
+    threading.Thread(target=servidor.serve_forever, name='metricas', daemon=True).start()
+    return servidor
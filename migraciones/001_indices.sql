@@ -0,0 +1,23 @@
+-- bda: sin-transaccion
+-- Índices para los accesos de app.py. Se crean con CONCURRENTLY para no bloquear
+-- las escrituras sobre PELICULA mientras se construyen.
+
+-- Películas de un usuario (show_peliculas_usuario): filtro por id_Us y orden por id_Pelicula.
+-- Incluye titulo y precio para que la consulta se resuelva solo con el índice.
+-- También lo usa la comprobación de la clave externa al borrar un usuario.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS pelicula_id_us_idx
+    ON PELICULA (id_Us, id_Pelicula) INCLUDE (titulo, precio);
+
+-- Clave externa a ESTUDIO y promociones por estudio, género y año
+CREATE INDEX CONCURRENTLY IF NOT EXISTS pelicula_id_est_idx
+    ON PELICULA (id_Est, genero, año);
+
+-- Promociones por género, con o sin rango de años
+CREATE INDEX CONCURRENTLY IF NOT EXISTS pelicula_genero_ano_idx
+    ON PELICULA (genero, año);
+
+-- Promociones solo por rango de años
+CREATE INDEX CONCURRENTLY IF NOT EXISTS pelicula_ano_idx
+    ON PELICULA (año);
+
+ANALYZE PELICULA;
@@ -0,0 +1,33 @@
+-- Valoraciones de varios usuarios por película y resumen por película mantenido
+-- en la misma transacción que cada valoración (ver guardar_valoracion en app.py).
+-- La columna PELICULA.valoracion se conserva como valoración antigua: se muestra
+-- mientras la película no tenga valoraciones nuevas.
+
+CREATE TABLE IF NOT EXISTS VALORACION (
+    id_Pelicula BIGINT NOT NULL,
+    id_Us VARCHAR(9) NOT NULL,
+    valoracion SMALLINT NOT NULL CHECK (valoracion BETWEEN 1 AND 5),
+    fecha TIMESTAMP NOT NULL DEFAULT now(),
+    PRIMARY KEY (id_Pelicula, id_Us),
+    CONSTRAINT valoracion_id_pelicula_fk FOREIGN KEY (id_Pelicula) REFERENCES PELICULA(id_Pelicula) ON DELETE CASCADE,
+    CONSTRAINT valoracion_id_us_fk FOREIGN KEY (id_Us) REFERENCES USUARIO(DNI)
+);
+
+-- Comprobación de la clave externa al borrar un usuario
+CREATE INDEX IF NOT EXISTS valoracion_id_us_idx ON VALORACION (id_Us);
+
+CREATE TABLE IF NOT EXISTS VALORACION_RESUMEN (
+    id_Pelicula BIGINT PRIMARY KEY,
+    num INT NOT NULL DEFAULT 0,
+    suma INT NOT NULL DEFAULT 0,
+    media NUMERIC(3,2),
+    -- histograma[i] = número de valoraciones con i estrellas
+    histograma INT[] NOT NULL DEFAULT '{0,0,0,0,0}',
+    CONSTRAINT valoracion_resumen_id_pelicula_fk FOREIGN KEY (id_Pelicula) REFERENCES PELICULA(id_Pelicula) ON DELETE CASCADE
+);
+
+-- Clasificación de las mejor valoradas sin recorrer las valoraciones
+CREATE INDEX IF NOT EXISTS valoracion_resumen_media_idx ON VALORACION_RESUMEN (media DESC, num DESC, id_Pelicula);
+
+GRANT INSERT,SELECT,UPDATE,DELETE ON TABLE VALORACION TO diego;
+GRANT INSERT,SELECT,UPDATE,DELETE ON TABLE VALORACION_RESUMEN TO diego;
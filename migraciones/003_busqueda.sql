@@ -0,0 +1,16 @@
+-- bda: sin-transaccion
+-- Búsqueda de películas por título y género (buscar_peliculas en app.py).
+
+-- Trigramas: búsqueda tolerante a erratas y a palabras a medias
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+-- Búsqueda por relevancia: el texto buscado se compara con título y género juntos
+CREATE INDEX CONCURRENTLY IF NOT EXISTS pelicula_busqueda_trgm_idx
+    ON PELICULA USING gin (lower(titulo || ' ' || genero) gin_trgm_ops);
+
+-- Autocompletado: títulos que empiezan por el texto, en orden alfabético.
+-- Con la intercalación "C" el mismo índice sirve para el LIKE 'texto%' y para el orden.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS pelicula_titulo_prefijo_idx
+    ON PELICULA ((lower(titulo) COLLATE "C"), id_Pelicula);
+
+ANALYZE PELICULA;
@@ -0,0 +1,18 @@
+-- Número de versión de cada película para las actualizaciones optimistas
+-- (modificar_pelicula y rebajar_precio con version en app.py): la escritura solo se
+-- aplica si la fila sigue en la versión que se leyó.
+-- Con un valor por defecto constante, ADD COLUMN no reescribe la tabla.
+ALTER TABLE PELICULA ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT 0;
+
+-- La versión sube en cada UPDATE, lo haga la aplicación o cualquier otro cliente
+CREATE OR REPLACE FUNCTION pelicula_version() RETURNS trigger AS $$
+BEGIN
+    NEW.version := OLD.version + 1;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS pelicula_version_trg ON PELICULA;
+CREATE TRIGGER pelicula_version_trg
+    BEFORE UPDATE ON PELICULA
+    FOR EACH ROW EXECUTE FUNCTION pelicula_version();
@@ -0,0 +1,68 @@
+-- Vistas materializadas para los informes de analitica.py. Cada una tiene un índice
+-- único para poder refrescarla con REFRESH MATERIALIZED VIEW CONCURRENTLY sin
+-- bloquear las lecturas. Las refresca el propietario: python analitica.py refrescar
+
+-- Catálogo por estudio
+CREATE MATERIALIZED VIEW IF NOT EXISTS MV_ESTUDIO AS
+SELECT e.id_Estudio, e.nombreE, e.paisOrigen,
+       count(c.id_Pelicula) AS num_peliculas,
+       COALESCE(sum(c.precio), 0) AS valor_catalogo,
+       round(avg(c.precio), 2) AS precio_medio,
+       round(avg(c.duracion_Minutos), 1) AS duracion_media
+FROM ESTUDIO e
+LEFT JOIN PELICULA c ON c.id_Est = e.id_Estudio
+GROUP BY e.id_Estudio, e.nombreE, e.paisOrigen;
+
+CREATE UNIQUE INDEX IF NOT EXISTS mv_estudio_pk ON MV_ESTUDIO (id_Estudio);
+CREATE INDEX IF NOT EXISTS mv_estudio_valor_idx ON MV_ESTUDIO (valor_catalogo DESC, id_Estudio);
+
+-- Catálogo por país de origen del estudio, a partir de MV_ESTUDIO (se refresca después)
+CREATE MATERIALIZED VIEW IF NOT EXISTS MV_PAIS AS
+SELECT paisOrigen,
+       count(*) AS num_estudios,
+       sum(num_peliculas) AS num_peliculas,
+       sum(valor_catalogo) AS valor_catalogo
+FROM MV_ESTUDIO
+GROUP BY paisOrigen;
+
+CREATE UNIQUE INDEX IF NOT EXISTS mv_pais_pk ON MV_PAIS (paisOrigen);
+
+-- Precio, duración y valoración por género
+CREATE MATERIALIZED VIEW IF NOT EXISTS MV_GENERO AS
+SELECT c.genero,
+       count(*) AS num_peliculas,
+       round(avg(c.precio), 2) AS precio_medio,
+       min(c.precio) AS precio_min,
+       max(c.precio) AS precio_max,
+       round(avg(c.duracion_Minutos), 1) AS duracion_media,
+       sum(r.num) AS num_valoraciones,
+       round(sum(r.suma)::numeric / NULLIF(sum(r.num), 0), 2) AS valoracion_media
+FROM PELICULA c
+LEFT JOIN VALORACION_RESUMEN r ON r.id_Pelicula = c.id_Pelicula
+GROUP BY c.genero;
+
+CREATE UNIQUE INDEX IF NOT EXISTS mv_genero_pk ON MV_GENERO (genero);
+
+-- Duración y precio por año
+CREATE MATERIALIZED VIEW IF NOT EXISTS MV_ANO AS
+SELECT extract(year FROM año)::int AS ano,
+       count(*) AS num_peliculas,
+       round(avg(duracion_Minutos), 1) AS duracion_media,
+       round(avg(precio), 2) AS precio_medio
+FROM PELICULA
+GROUP BY 1;
+
+CREATE UNIQUE INDEX IF NOT EXISTS mv_ano_pk ON MV_ANO (ano);
+
+-- Último refresco de cada vista
+CREATE TABLE IF NOT EXISTS ANALITICA_REFRESCO (
+    vista VARCHAR(30) PRIMARY KEY,
+    fecha TIMESTAMP NOT NULL,
+    segundos DOUBLE PRECISION NOT NULL
+);
+
+INSERT INTO ANALITICA_REFRESCO (vista, fecha, segundos)
+VALUES ('mv_estudio', now(), 0), ('mv_pais', now(), 0), ('mv_genero', now(), 0), ('mv_ano', now(), 0)
+ON CONFLICT (vista) DO NOTHING;
+
+GRANT SELECT ON MV_ESTUDIO, MV_PAIS, MV_GENERO, MV_ANO, ANALITICA_REFRESCO TO diego;
@@ -0,0 +1,29 @@
+-- Fecha de la última modificación de cada fila, para las exportaciones incrementales
+-- (exportar.py). Al añadir la columna con un valor por defecto no volátil no se
+-- reescriben las tablas; las filas existentes quedan con la fecha de la migración.
+ALTER TABLE PELICULA ADD COLUMN IF NOT EXISTS actualizado TIMESTAMP NOT NULL DEFAULT now();
+ALTER TABLE USUARIO ADD COLUMN IF NOT EXISTS actualizado TIMESTAMP NOT NULL DEFAULT now();
+ALTER TABLE ESTUDIO ADD COLUMN IF NOT EXISTS actualizado TIMESTAMP NOT NULL DEFAULT now();
+
+-- Las inserciones toman la fecha del valor por defecto; las modificaciones, del disparador
+CREATE OR REPLACE FUNCTION fijar_actualizado() RETURNS trigger AS $$
+BEGIN
+    NEW.actualizado := now();
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS pelicula_actualizado_trg ON PELICULA;
+CREATE TRIGGER pelicula_actualizado_trg
+    BEFORE UPDATE ON PELICULA
+    FOR EACH ROW EXECUTE FUNCTION fijar_actualizado();
+
+DROP TRIGGER IF EXISTS usuario_actualizado_trg ON USUARIO;
+CREATE TRIGGER usuario_actualizado_trg
+    BEFORE UPDATE ON USUARIO
+    FOR EACH ROW EXECUTE FUNCTION fijar_actualizado();
+
+DROP TRIGGER IF EXISTS estudio_actualizado_trg ON ESTUDIO;
+CREATE TRIGGER estudio_actualizado_trg
+    BEFORE UPDATE ON ESTUDIO
+    FOR EACH ROW EXECUTE FUNCTION fijar_actualizado();
@@ -0,0 +1,8 @@
+-- bda: sin-transaccion
+-- Exportaciones incrementales (exportar.py): filas modificadas en un rango de fechas
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS pelicula_actualizado_idx ON PELICULA (actualizado);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS usuario_actualizado_idx ON USUARIO (actualizado);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS estudio_actualizado_idx ON ESTUDIO (actualizado);
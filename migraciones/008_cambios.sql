@@ -0,0 +1,71 @@
+-- Registro de cambios (cambios.py): cada fila insertada, modificada o borrada en
+-- PELICULA, USUARIO, ESTUDIO y VALORACION_RESUMEN deja una fila en CAMBIO en la misma
+-- transacción, y la transacción avisa con NOTIFY bda_cambios al confirmarse.
+-- El aviso lleva solo el id de la transacción (PostgreSQL entrega uno por transacción
+-- aunque cambie muchas filas); los cambios se leen de CAMBIO.
+-- TRUNCATE no se registra. Requiere PostgreSQL 13 o posterior (xid8, pg_snapshot).
+
+CREATE TABLE IF NOT EXISTS CAMBIO (
+    id BIGSERIAL PRIMARY KEY,
+    -- Transacción que hizo el cambio: los suscriptores leen por instantáneas de
+    -- transacciones, porque los id no llegan en orden de commit
+    txid XID8 NOT NULL DEFAULT pg_current_xact_id(),
+    tabla VARCHAR(20) NOT NULL,
+    operacion CHAR(1) NOT NULL CHECK (operacion IN ('I', 'U', 'D')),
+    clave VARCHAR(20) NOT NULL,
+    -- La fila nueva (NULL en los borrados)
+    datos JSONB,
+    fecha TIMESTAMP NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS cambio_txid_idx ON CAMBIO (txid);
+
+-- Posición de cada suscriptor: la instantánea hasta la que ha procesado los cambios
+CREATE TABLE IF NOT EXISTS CAMBIO_SUSCRIPTOR (
+    nombre VARCHAR(40) PRIMARY KEY,
+    posicion PG_SNAPSHOT NOT NULL,
+    actualizado TIMESTAMP NOT NULL DEFAULT now()
+);
+
+-- TG_ARGV[0] es la columna de la clave de la tabla
+CREATE OR REPLACE FUNCTION registrar_cambio() RETURNS trigger AS $$
+DECLARE
+    fila JSONB;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        fila := to_jsonb(OLD);
+    ELSE
+        fila := to_jsonb(NEW);
+    END IF;
+    INSERT INTO CAMBIO (tabla, operacion, clave, datos)
+    VALUES (lower(TG_TABLE_NAME), left(TG_OP, 1), fila ->> TG_ARGV[0],
+            CASE WHEN TG_OP = 'DELETE' THEN NULL ELSE fila END);
+    PERFORM pg_notify('bda_cambios', pg_current_xact_id()::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS pelicula_cambio_trg ON PELICULA;
+CREATE TRIGGER pelicula_cambio_trg
+    AFTER INSERT OR UPDATE OR DELETE ON PELICULA
+    FOR EACH ROW EXECUTE FUNCTION registrar_cambio('id_pelicula');
+
+DROP TRIGGER IF EXISTS usuario_cambio_trg ON USUARIO;
+CREATE TRIGGER usuario_cambio_trg
+    AFTER INSERT OR UPDATE OR DELETE ON USUARIO
+    FOR EACH ROW EXECUTE FUNCTION registrar_cambio('dni');
+
+DROP TRIGGER IF EXISTS estudio_cambio_trg ON ESTUDIO;
+CREATE TRIGGER estudio_cambio_trg
+    AFTER INSERT OR UPDATE OR DELETE ON ESTUDIO
+    FOR EACH ROW EXECUTE FUNCTION registrar_cambio('id_estudio');
+
+-- Las valoraciones cambian la valoración media de la película, que está en el resumen
+DROP TRIGGER IF EXISTS valoracion_resumen_cambio_trg ON VALORACION_RESUMEN;
+CREATE TRIGGER valoracion_resumen_cambio_trg
+    AFTER INSERT OR UPDATE OR DELETE ON VALORACION_RESUMEN
+    FOR EACH ROW EXECUTE FUNCTION registrar_cambio('id_pelicula');
+
+GRANT INSERT,SELECT,DELETE ON TABLE CAMBIO TO diego;
+GRANT USAGE ON SEQUENCE cambio_id_seq TO diego;
+GRANT INSERT,SELECT,UPDATE,DELETE ON TABLE CAMBIO_SUSCRIPTOR TO diego;
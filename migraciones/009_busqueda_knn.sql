@@ -0,0 +1,14 @@
+-- bda: sin-transaccion
+-- Búsqueda por relevancia con los k vecinos más próximos (buscar_peliculas en app.py).
+
+-- El índice GIN de 003 filtra con <% pero no devuelve las filas ordenadas, así que
+-- con un texto frecuente había que puntuar y ordenar todas las que coinciden. Un
+-- índice GiST sí las devuelve por la distancia <<-> y el LIMIT corta el recorrido.
+-- El GIN se mantiene para los filtros sin orden por relevancia.
+-- El desempate por id_Pelicula (para paginar) se hace con un Incremental Sort sobre
+-- el recorrido del índice, que PostgreSQL solo planifica así desde la versión 17; en
+-- versiones anteriores comprobar_indices.py señala que la consulta no usa el índice.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS pelicula_busqueda_knn_idx
+    ON PELICULA USING gist (lower(titulo || ' ' || genero) gist_trgm_ops);
+
+ANALYZE PELICULA;
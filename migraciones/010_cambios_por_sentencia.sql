@@ -0,0 +1,89 @@
+-- Registro de cambios por sentencia en lugar de por fila (sustituye los disparadores de 008).
+
+-- Con FOR EACH ROW cada fila modificada ejecutaba la función, hacía su propio INSERT
+-- en CAMBIO y llamaba a pg_notify, así que las cargas masivas (alta_peliculas,
+-- rebajar_precios) pagaban una llamada a PL/pgSQL y un aviso por fila además de la
+-- copia. Ahora cada sentencia copia todas sus filas con un solo INSERT ... SELECT
+-- desde las tablas de transición y avisa una vez (si cambió alguna fila).
+-- La copia de cada fila en CAMBIO se mantiene: es lo que leen los suscriptores.
+-- PostgreSQL no admite tablas de transición en un disparador de varios eventos, por
+-- eso hay uno por operación y tabla.
+
+CREATE OR REPLACE FUNCTION registrar_cambios() RETURNS trigger AS $$
+DECLARE
+    filas BIGINT;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        INSERT INTO CAMBIO (tabla, operacion, clave, datos)
+        SELECT lower(TG_TABLE_NAME), 'D', to_jsonb(v) ->> TG_ARGV[0], NULL
+        FROM viejas v;
+    ELSE
+        INSERT INTO CAMBIO (tabla, operacion, clave, datos)
+        SELECT lower(TG_TABLE_NAME), left(TG_OP, 1), f.fila ->> TG_ARGV[0], f.fila
+        FROM (SELECT to_jsonb(n) AS fila FROM nuevas n) f;
+    END IF;
+    GET DIAGNOSTICS filas = ROW_COUNT;
+    IF filas > 0 THEN
+        PERFORM pg_notify('bda_cambios', pg_current_xact_id()::text);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS pelicula_cambio_trg ON PELICULA;
+DROP TRIGGER IF EXISTS pelicula_cambio_ins_trg ON PELICULA;
+DROP TRIGGER IF EXISTS pelicula_cambio_upd_trg ON PELICULA;
+DROP TRIGGER IF EXISTS pelicula_cambio_del_trg ON PELICULA;
+CREATE TRIGGER pelicula_cambio_ins_trg
+    AFTER INSERT ON PELICULA REFERENCING NEW TABLE AS nuevas
+    FOR EACH STATEMENT EXECUTE FUNCTION registrar_cambios('id_pelicula');
+CREATE TRIGGER pelicula_cambio_upd_trg
+    AFTER UPDATE ON PELICULA REFERENCING NEW TABLE AS nuevas
+    FOR EACH STATEMENT EXECUTE FUNCTION registrar_cambios('id_pelicula');
+CREATE TRIGGER pelicula_cambio_del_trg
+    AFTER DELETE ON PELICULA REFERENCING OLD TABLE AS viejas
+    FOR EACH STATEMENT EXECUTE FUNCTION registrar_cambios('id_pelicula');
+
+DROP TRIGGER IF EXISTS usuario_cambio_trg ON USUARIO;
+DROP TRIGGER IF EXISTS usuario_cambio_ins_trg ON USUARIO;
+DROP TRIGGER IF EXISTS usuario_cambio_upd_trg ON USUARIO;
+DROP TRIGGER IF EXISTS usuario_cambio_del_trg ON USUARIO;
+CREATE TRIGGER usuario_cambio_ins_trg
+    AFTER INSERT ON USUARIO REFERENCING NEW TABLE AS nuevas
+    FOR EACH STATEMENT EXECUTE FUNCTION registrar_cambios('dni');
+CREATE TRIGGER usuario_cambio_upd_trg
+    AFTER UPDATE ON USUARIO REFERENCING NEW TABLE AS nuevas
+    FOR EACH STATEMENT EXECUTE FUNCTION registrar_cambios('dni');
+CREATE TRIGGER usuario_cambio_del_trg
+    AFTER DELETE ON USUARIO REFERENCING OLD TABLE AS viejas
+    FOR EACH STATEMENT EXECUTE FUNCTION registrar_cambios('dni');
+
+DROP TRIGGER IF EXISTS estudio_cambio_trg ON ESTUDIO;
+DROP TRIGGER IF EXISTS estudio_cambio_ins_trg ON ESTUDIO;
+DROP TRIGGER IF EXISTS estudio_cambio_upd_trg ON ESTUDIO;
+DROP TRIGGER IF EXISTS estudio_cambio_del_trg ON ESTUDIO;
+CREATE TRIGGER estudio_cambio_ins_trg
+    AFTER INSERT ON ESTUDIO REFERENCING NEW TABLE AS nuevas
+    FOR EACH STATEMENT EXECUTE FUNCTION registrar_cambios('id_estudio');
+CREATE TRIGGER estudio_cambio_upd_trg
+    AFTER UPDATE ON ESTUDIO REFERENCING NEW TABLE AS nuevas
+    FOR EACH STATEMENT EXECUTE FUNCTION registrar_cambios('id_estudio');
+CREATE TRIGGER estudio_cambio_del_trg
+    AFTER DELETE ON ESTUDIO REFERENCING OLD TABLE AS viejas
+    FOR EACH STATEMENT EXECUTE FUNCTION registrar_cambios('id_estudio');
+
+DROP TRIGGER IF EXISTS valoracion_resumen_cambio_trg ON VALORACION_RESUMEN;
+DROP TRIGGER IF EXISTS valoracion_resumen_cambio_ins_trg ON VALORACION_RESUMEN;
+DROP TRIGGER IF EXISTS valoracion_resumen_cambio_upd_trg ON VALORACION_RESUMEN;
+DROP TRIGGER IF EXISTS valoracion_resumen_cambio_del_trg ON VALORACION_RESUMEN;
+CREATE TRIGGER valoracion_resumen_cambio_ins_trg
+    AFTER INSERT ON VALORACION_RESUMEN REFERENCING NEW TABLE AS nuevas
+    FOR EACH STATEMENT EXECUTE FUNCTION registrar_cambios('id_pelicula');
+CREATE TRIGGER valoracion_resumen_cambio_upd_trg
+    AFTER UPDATE ON VALORACION_RESUMEN REFERENCING NEW TABLE AS nuevas
+    FOR EACH STATEMENT EXECUTE FUNCTION registrar_cambios('id_pelicula');
+CREATE TRIGGER valoracion_resumen_cambio_del_trg
+    AFTER DELETE ON VALORACION_RESUMEN REFERENCING OLD TABLE AS viejas
+    FOR EACH STATEMENT EXECUTE FUNCTION registrar_cambios('id_pelicula');
+
+DROP FUNCTION IF EXISTS registrar_cambio();
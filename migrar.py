@@ -0,0 +1,131 @@
+"""
+Aplica las migraciones de la carpeta migraciones/ que falten en la base de datos.
+
+Cada fichero se llama NNN_descripcion.sql y se aplica una sola vez, por orden de NNN;
+las aplicadas se registran en la tabla VERSION_ESQUEMA. Cada migración se ejecuta
+en su propia transacción, salvo que su primera línea sea '-- bda: sin-transaccion'
+(necesario para CREATE INDEX CONCURRENTLY): entonces sus sentencias, separadas
+por ';' al final de línea, se ejecutan una a una en modo autocommit.
+
+    python migrar.py            aplica las migraciones pendientes
+    python migrar.py --lista    muestra el estado de cada migración
+"""
+import argparse
+import os
+import re
+import sys
+
+import psycopg2
+
+from conexiones import leer_config
+
+
+CARPETA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migraciones')
+SIN_TRANSACCION = '-- bda: sin-transaccion'
+
+
+## ------------------------------------------------------------
+def listar_migraciones(carpeta=CARPETA):
+    """
+    :return: lista ordenada de tuplas (versión, nombre, ruta)
+    """
+    migraciones = []
+    for nombre in os.listdir(carpeta):
+        m = re.match(r'^(\d+)_.*\.sql$', nombre)
+        if m:
+            migraciones.append((int(m.group(1)), nombre, os.path.join(carpeta, nombre)))
+    return sorted(migraciones)
+
+
+def versiones_aplicadas(conn):
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS VERSION_ESQUEMA (
+                version INT PRIMARY KEY,
+                nombre VARCHAR(100) NOT NULL,
+                aplicada TIMESTAMP NOT NULL DEFAULT now()
+            )
+        """)
+        cursor.execute("SELECT version FROM VERSION_ESQUEMA")
+        versiones = {row[0] for row in cursor.fetchall()}
+    conn.commit()
+    return versiones
+
+
+def aplicar(conn, version, nombre, ruta):
+    """
+    Aplica una migración y la registra en VERSION_ESQUEMA.
+    :raises psycopg2.Error: si falla; si era transaccional no queda nada aplicado
+    """
+    with open(ruta, encoding='utf-8') as f:
+        texto = f.read()
+
+    if texto.startswith(SIN_TRANSACCION):
+        conn.autocommit = True
+        try:
+            with conn.cursor() as cursor:
+                for sentencia in re.split(r';\s*$', texto, flags=re.MULTILINE):
+                    # Se quitan los comentarios para no enviar sentencias vacías
+                    codigo = '\n'.join(l for l in sentencia.splitlines() if not l.strip().startswith('--'))
+                    if codigo.strip():
+                        cursor.execute(codigo)
+                cursor.execute("INSERT INTO VERSION_ESQUEMA (version, nombre) VALUES (%s, %s)", (version, nombre))
+        finally:
+            conn.autocommit = False
+    else:
+        with conn.cursor() as cursor:
+            try:
+                cursor.execute(texto)
+                cursor.execute("INSERT INTO VERSION_ESQUEMA (version, nombre) VALUES (%s, %s)", (version, nombre))
+                conn.commit()
+            except psycopg2.Error:
+                conn.rollback()
+                raise
+
+
+def migrar(conn, carpeta=CARPETA):
+    """
+    Aplica por orden las migraciones pendientes.
+    :return: lista de nombres de las migraciones aplicadas
+    """
+    aplicadas = versiones_aplicadas(conn)
+    nuevas = []
+    for version, nombre, ruta in listar_migraciones(carpeta):
+        if version in aplicadas:
+            continue
+        print(f"Aplicando {nombre}...")
+        aplicar(conn, version, nombre, ruta)
+        nuevas.append(nombre)
+    return nuevas
+
+
+## ------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description="Aplica las migraciones del esquema.")
+    parser.add_argument('--lista', action='store_true', help="Solo muestra qué migraciones están aplicadas")
+    args = parser.parse_args()
+
+    params, _ = leer_config()
+    try:
+        conn = psycopg2.connect(**params)
+    except psycopg2.Error as e:
+        print(f"No se pudo conectar: {e}. Cerrando...")
+        sys.exit(1)
+
+    try:
+        if args.lista:
+            aplicadas = versiones_aplicadas(conn)
+            for version, nombre, _ in listar_migraciones():
+                print(f"[{'x' if version in aplicadas else ' '}] {nombre}")
+        else:
+            nuevas = migrar(conn)
+            print(f"{len(nuevas)} migraciones aplicadas." if nuevas else "El esquema está al día.")
+    except psycopg2.Error as e:
+        print(f"Error {e.pgcode}: {e.pgerror}")
+        sys.exit(1)
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,554 @@
+"""
+Particionado de PELICULA por hash de id_Pelicula sin parar la aplicación.
+
+Se particiona por hash de id_Pelicula y no por rangos de año porque la clave
+primaria de una tabla particionada tiene que incluir la clave de partición: con
+año, id_Pelicula dejaría de ser único por sí solo y no podría ser el destino de
+las claves externas de VALORACION y VALORACION_RESUMEN. Además, casi todas las
+sentencias de app.py sobre una película filtran por id_Pelicula, así que el
+planificador descarta todas las particiones menos una; las que filtran por usuario,
+estudio, género o año usan los índices de cada partición, que crecen más despacio
+que los de una tabla única.
+
+El paso de la tabla actual a la particionada se hace en varias órdenes, que se
+pueden interrumpir y volver a lanzar:
+
+    python particionar.py preparar [--particiones 16]
+        crea PELICULA_PART con sus particiones, índices y claves externas, y un
+        disparador en PELICULA que copia en ella cada cambio desde ese momento
+    python particionar.py copiar [--lote 10000] [--pausa 0.1]
+        copia las filas existentes por lotes de id_Pelicula, cada lote en su
+        transacción; guarda por dónde va en PELICULA_PARTICION y sigue desde ahí
+    python particionar.py verificar
+        compara el número de filas y un hash de su contenido en las dos tablas
+    python particionar.py cambiar [--espera-bloqueo 5]
+        en una transacción corta, renombra PELICULA a PELICULA_ANTIGUA y PELICULA_PART
+        a PELICULA, y pasa a la nueva los disparadores, permisos, claves externas y
+        vistas que dependían de la antigua
+    python particionar.py limpiar      borra PELICULA_ANTIGUA cuando ya no hace falta
+    python particionar.py abandonar    deshace 'preparar' antes de 'cambiar'
+    python particionar.py estado
+
+Durante la copia, cada lote bloquea sus filas con FOR SHARE: una película borrada
+mientras tanto no se copia, y una modificada se copia con su último valor. Las
+vistas materializadas se vuelven a crear vacías al cambiar y se rellenan justo
+después, así que los informes fallan durante ese refresco. TRUNCATE no se copia.
+"""
+import argparse
+import json
+import sys
+import time
+
+import psycopg2
+import psycopg2.extensions
+
+import analitica
+from conexiones import leer_config
+
+
+NUEVA = 'pelicula_part'
+ANTIGUA = 'pelicula_antigua'
+DISPARADOR = 'pelicula_espejo_trg'
+
+# Menor BIGINT: la copia empieza por los id_Pelicula mayores que este
+PRIMER_ID = -2 ** 63
+
+SQL_COPIAR_LOTE = """
+    WITH lote AS (
+        SELECT * FROM PELICULA
+        WHERE id_Pelicula > %(ultimo)s
+        ORDER BY id_Pelicula
+        LIMIT %(lote)s
+        FOR SHARE
+    ), copia AS (
+        INSERT INTO PELICULA_PART SELECT * FROM lote
+        ON CONFLICT (id_Pelicula) DO NOTHING
+    )
+    SELECT count(*), max(id_Pelicula) FROM lote
+"""
+
+SQL_RESUMEN = "SELECT count(*), sum(hashtextextended(t::text, 0)) FROM {tabla} t"
+
+# Vistas que dependen de PELICULA, directamente o a través de otras vistas,
+# en orden de creación (los oid de las dependencias son menores)
+SQL_VISTAS = """
+    WITH RECURSIVE vistas(oid) AS (
+        SELECT r.ev_class
+        FROM pg_depend d JOIN pg_rewrite r ON r.oid = d.objid
+        WHERE d.classid = 'pg_rewrite'::regclass AND d.refclassid = 'pg_class'::regclass
+          AND d.refobjid = 'pelicula'::regclass
+      UNION
+        SELECT r.ev_class
+        FROM vistas v
+        JOIN pg_depend d ON d.refobjid = v.oid
+        JOIN pg_rewrite r ON r.oid = d.objid
+        WHERE d.classid = 'pg_rewrite'::regclass AND d.refclassid = 'pg_class'::regclass
+    )
+    SELECT c.oid::regclass::text, c.relkind, pg_get_viewdef(c.oid)
+    FROM pg_class c
+    WHERE c.oid IN (SELECT oid FROM vistas) AND c.relkind IN ('v', 'm')
+    ORDER BY c.oid
+"""
+
+SQL_PERMISOS = """
+    SELECT a.privilege_type, CASE WHEN a.grantee = 0 THEN 'PUBLIC' ELSE quote_ident(r.rolname) END
+    FROM pg_class c
+    CROSS JOIN aclexplode(c.relacl) a
+    LEFT JOIN pg_roles r ON r.oid = a.grantee
+    WHERE c.oid = %s::regclass AND a.grantee <> c.relowner
+"""
+
+# Índices de una tabla con su definición sin el nombre, para emparejar los de las dos tablas
+SQL_INDICES = """
+    SELECT quote_ident(c.relname), quote_ident(left(c.relname, 54) || '_antiguo'), i.indisunique,
+           regexp_replace(pg_get_indexdef(i.indexrelid), '^.* USING ', '')
+    FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+    WHERE i.indrelid = %s::regclass
+"""
+
+
+## ------------------------------------------------------------
+def _columnas(cursor, tabla):
+    """
+    :return: nombres (entrecomillados si hace falta) de las columnas de la tabla, en orden
+    """
+    cursor.execute("""
+        SELECT quote_ident(attname) FROM pg_attribute
+        WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped
+        ORDER BY attnum
+    """, (tabla, ))
+    return [row[0] for row in cursor.fetchall()]
+
+
+def _sql_espejo(columnas):
+    """
+    Función del disparador que repite en PELICULA_PART cada cambio de PELICULA. Es un
+    disparador AFTER, así que la fila ya lleva la versión y la fecha que le han puesto
+    los disparadores BEFORE de PELICULA.
+    """
+    lista = ", ".join(columnas)
+    nuevos = ", ".join(f"EXCLUDED.{c}" for c in columnas)
+    return f"""
+        CREATE OR REPLACE FUNCTION espejo_pelicula() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'DELETE' OR (TG_OP = 'UPDATE' AND NEW.id_pelicula <> OLD.id_pelicula) THEN
+                DELETE FROM {NUEVA} WHERE id_pelicula = OLD.id_pelicula;
+            END IF;
+            IF TG_OP <> 'DELETE' THEN
+                INSERT INTO {NUEVA} SELECT NEW.*
+                ON CONFLICT (id_pelicula) DO UPDATE SET ({lista}) = ROW({nuevos});
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """
+
+
+def _particionada(cursor):
+    cursor.execute("SELECT relkind = 'p' FROM pg_class WHERE oid = 'pelicula'::regclass")
+    return cursor.fetchone()[0]
+
+
+def _permisos(cursor, tabla):
+    """
+    :return: sentencias GRANT que dan sobre otra tabla con el mismo nombre los permisos
+             que tiene ahora 'tabla' (salvo los del propietario)
+    """
+    cursor.execute(SQL_PERMISOS, (tabla, ))
+    return [f"GRANT {privilegio} ON {tabla} TO {rol}" for privilegio, rol in cursor.fetchall()]
+
+
+def _progreso(cursor):
+    """
+    :return: diccionario con la fila de PELICULA_PARTICION, o None si no se ha preparado
+    """
+    cursor.execute("SELECT to_regclass('pelicula_particion') IS NOT NULL")
+    if not cursor.fetchone()[0]:
+        return None
+    cursor.execute("SELECT particiones, ultimo, inicio, copiado, cambiado FROM PELICULA_PARTICION")
+    columnas = [c.name for c in cursor.description]
+    return dict(zip(columnas, cursor.fetchone()))
+
+
+## ------------------------------------------------------------
+def preparar(conn, particiones=16, espera_bloqueo=5):
+    """
+    Crea PELICULA_PART, particionada por hash de id_Pelicula, con los mismos valores por
+    defecto, restricciones e índices que PELICULA y sus claves externas, y el disparador
+    que le copia los cambios de PELICULA.
+    :param conn: la conexión abierta a la base de datos (del propietario de PELICULA)
+    :param particiones: número de particiones
+    :param espera_bloqueo: segundos máximos de espera por el bloqueo de PELICULA
+    :raises ValueError: si PELICULA ya está particionada o ya se había preparado
+    """
+    with conn.cursor() as cursor:
+        try:
+            if _particionada(cursor):
+                raise ValueError("PELICULA ya está particionada.")
+            if _progreso(cursor) is not None:
+                raise ValueError("El particionado ya está preparado (python particionar.py estado).")
+            cursor.execute(f"SET LOCAL lock_timeout = '{int(espera_bloqueo * 1000)}ms'")
+            cursor.execute(f"CREATE TABLE {NUEVA} (LIKE PELICULA INCLUDING ALL) PARTITION BY HASH (id_Pelicula)")
+            for resto in range(particiones):
+                cursor.execute(f"CREATE TABLE pelicula_p{resto} PARTITION OF {NUEVA} "
+                               f"FOR VALUES WITH (MODULUS {particiones}, REMAINDER {resto})")
+            cursor.execute("""
+                SELECT quote_ident(conname), pg_get_constraintdef(oid) FROM pg_constraint
+                WHERE conrelid = 'pelicula'::regclass AND contype = 'f'
+            """)
+            for nombre, definicion in cursor.fetchall():
+                cursor.execute(f"ALTER TABLE {NUEVA} ADD CONSTRAINT {nombre} {definicion}")
+
+            cursor.execute("""
+                CREATE TABLE PELICULA_PARTICION (
+                    particiones INT NOT NULL,
+                    ultimo BIGINT,
+                    inicio TIMESTAMP NOT NULL DEFAULT now(),
+                    copiado TIMESTAMP,
+                    cambiado TIMESTAMP
+                )
+            """)
+            cursor.execute("INSERT INTO PELICULA_PARTICION (particiones) VALUES (%s)", (particiones, ))
+            cursor.execute(_sql_espejo(_columnas(cursor, 'pelicula')))
+            cursor.execute(f"""
+                CREATE TRIGGER {DISPARADOR}
+                    AFTER INSERT OR UPDATE OR DELETE ON PELICULA
+                    FOR EACH ROW EXECUTE FUNCTION espejo_pelicula()
+            """)
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+
+
+def copiar(conn, lote=10000, pausa=0.0, avisar=None):
+    """
+    Copia en PELICULA_PART las filas de PELICULA por orden de id_Pelicula, 'lote' filas
+    por transacción, desde donde se quedó la copia anterior. Al terminar analiza la tabla
+    nueva y anota la copia como completa.
+    :param conn: la conexión abierta a la base de datos
+    :param pausa: segundos de espera entre lotes, para no cargar el servidor
+    :param avisar: función que recibe el total de filas copiadas tras cada lote
+    :return: número de filas copiadas en esta llamada
+    :raises ValueError: si no se ha preparado el particionado
+    """
+    total = 0
+    while True:
+        with conn.cursor() as cursor:
+            try:
+                progreso = _progreso(cursor)
+                if progreso is None or progreso['cambiado'] is not None:
+                    raise ValueError("No hay un particionado preparado (python particionar.py preparar).")
+                ultimo = PRIMER_ID if progreso['ultimo'] is None else progreso['ultimo']
+                cursor.execute(SQL_COPIAR_LOTE, {'ultimo': ultimo, 'lote': lote})
+                copiadas, maximo = cursor.fetchone()
+                if copiadas:
+                    cursor.execute("UPDATE PELICULA_PARTICION SET ultimo = %s", (maximo, ))
+                else:
+                    cursor.execute("UPDATE PELICULA_PARTICION SET copiado = now()")
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+        total += copiadas
+        if not copiadas:
+            break
+        if avisar is not None:
+            avisar(total)
+        if pausa:
+            time.sleep(pausa)
+
+    autocommit = conn.autocommit
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(f"ANALYZE {NUEVA}")
+    finally:
+        conn.autocommit = autocommit
+    return total
+
+
+def verificar(conn):
+    """
+    Compara PELICULA y PELICULA_PART en una misma instantánea. Recorre las dos tablas enteras.
+    :return: diccionario con el número de filas y el hash de cada tabla, y si coinciden
+    """
+    conn.set_session(isolation_level=psycopg2.extensions.ISOLATION_LEVEL_REPEATABLE_READ, readonly=True)
+    try:
+        resultado = {}
+        with conn.cursor() as cursor:
+            for tabla in ('pelicula', NUEVA):
+                cursor.execute(SQL_RESUMEN.format(tabla=tabla))
+                filas, suma = cursor.fetchone()
+                resultado[tabla] = {'filas': filas, 'hash': str(suma or 0)}
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        conn.set_session(isolation_level=psycopg2.extensions.ISOLATION_LEVEL_DEFAULT, readonly=False)
+    resultado['iguales'] = resultado['pelicula'] == resultado[NUEVA]
+    return resultado
+
+
+## ------------------------------------------------------------
+def _cambiar(cursor, espera_bloqueo):
+    """
+    Cambia una tabla por otra dentro de la transacción en curso.
+    :return: tupla (claves externas que apuntan a PELICULA, vistas recreadas)
+    """
+    cursor.execute(f"SET LOCAL lock_timeout = '{int(espera_bloqueo * 1000)}ms'")
+    cursor.execute("LOCK TABLE PELICULA IN ACCESS EXCLUSIVE MODE")
+    progreso = _progreso(cursor)
+    if progreso is None or progreso['cambiado'] is not None:
+        raise ValueError("No hay un particionado preparado (python particionar.py preparar).")
+    if progreso['copiado'] is None:
+        raise ValueError("La copia no ha terminado (python particionar.py copiar).")
+
+    cursor.execute(SQL_VISTAS)
+    vistas = cursor.fetchall()
+    indices_vistas = {}
+    permisos_vistas = {}
+    for nombre, _, _ in vistas:
+        cursor.execute("SELECT pg_get_indexdef(indexrelid) FROM pg_index WHERE indrelid = %s::regclass",
+                       (nombre, ))
+        indices_vistas[nombre] = [row[0] for row in cursor.fetchall()]
+        permisos_vistas[nombre] = _permisos(cursor, nombre)
+    cursor.execute("""
+        SELECT conrelid::regclass::text, quote_ident(conname), pg_get_constraintdef(oid) FROM pg_constraint
+        WHERE confrelid = 'pelicula'::regclass AND contype = 'f' AND conparentid = 0
+    """)
+    claves = cursor.fetchall()
+    cursor.execute("""
+        SELECT quote_ident(tgname), pg_get_triggerdef(oid) FROM pg_trigger
+        WHERE tgrelid = 'pelicula'::regclass AND NOT tgisinternal
+    """)
+    disparadores = [(nombre, definicion) for nombre, definicion in cursor.fetchall() if nombre != DISPARADOR]
+    permisos = _permisos(cursor, 'pelicula')
+    cursor.execute(SQL_INDICES, ('pelicula', ))
+    antiguos = {(unico, definicion): (nombre, renombrado)
+                for nombre, renombrado, unico, definicion in cursor.fetchall()}
+    cursor.execute(SQL_INDICES, (NUEVA, ))
+    nuevos = {(unico, definicion): nombre for nombre, _, unico, definicion in cursor.fetchall()}
+    cursor.execute("""
+        SELECT quote_ident(conname) FROM pg_constraint WHERE conrelid = 'pelicula'::regclass AND contype = 'f'
+    """)
+    propias = [row[0] for row in cursor.fetchall()]
+
+    for nombre, tipo, _ in reversed(vistas):
+        cursor.execute(f"DROP {'MATERIALIZED VIEW' if tipo == 'm' else 'VIEW'} {nombre}")
+    for tabla, nombre, _ in claves:
+        cursor.execute(f"ALTER TABLE {tabla} DROP CONSTRAINT {nombre}")
+    cursor.execute(f"DROP TRIGGER {DISPARADOR} ON PELICULA")
+    # La tabla antigua se queda sin disparadores (no cambia versiones ni registra cambios)
+    # y sin claves externas (no impide borrar usuarios ni estudios)
+    for nombre, _ in disparadores:
+        cursor.execute(f"DROP TRIGGER {nombre} ON PELICULA")
+    for nombre in propias:
+        cursor.execute(f"ALTER TABLE PELICULA DROP CONSTRAINT {nombre}")
+
+    # Los índices de la tabla nueva toman el nombre de sus equivalentes en la antigua
+    for clave, (nombre, renombrado) in antiguos.items():
+        if clave in nuevos:
+            cursor.execute(f"ALTER INDEX {nombre} RENAME TO {renombrado}")
+    cursor.execute(f"ALTER TABLE PELICULA RENAME TO {ANTIGUA}")
+    cursor.execute(f"ALTER TABLE {NUEVA} RENAME TO PELICULA")
+    for clave, (nombre, _) in antiguos.items():
+        if clave in nuevos:
+            cursor.execute(f"ALTER INDEX {nuevos[clave]} RENAME TO {nombre}")
+
+    # Las definiciones nombran PELICULA, que ya es la tabla nueva
+    for _, definicion in disparadores:
+        cursor.execute(definicion)
+    for sentencia in permisos:
+        cursor.execute(sentencia)
+    for tabla, nombre, definicion in claves:
+        cursor.execute(f"ALTER TABLE {tabla} ADD CONSTRAINT {nombre} {definicion} NOT VALID")
+    for nombre, tipo, definicion in vistas:
+        definicion = definicion.strip().rstrip(';')
+        if tipo == 'm':
+            cursor.execute(f"CREATE MATERIALIZED VIEW {nombre} AS {definicion} WITH NO DATA")
+        else:
+            cursor.execute(f"CREATE VIEW {nombre} AS {definicion}")
+        for sentencia in indices_vistas[nombre] + permisos_vistas[nombre]:
+            cursor.execute(sentencia)
+    cursor.execute("UPDATE PELICULA_PARTICION SET cambiado = now()")
+    return claves, [(nombre, tipo) for nombre, tipo, _ in vistas]
+
+
+def cambiar(conn, espera_bloqueo=5, intentos=10):
+    """
+    Pone PELICULA_PART en el lugar de PELICULA en una sola transacción, que solo espera
+    el bloqueo de PELICULA 'espera_bloqueo' segundos y se reintenta si no lo consigue.
+    Después valida las claves externas, rellena las vistas materializadas y analiza la
+    tabla, ya sin bloquear la aplicación.
+    :param conn: la conexión abierta a la base de datos (del propietario de las tablas y vistas)
+    :return: diccionario con las claves externas validadas y las vistas recreadas
+    :raises ValueError: si no se ha preparado el particionado o la copia no ha terminado
+    :raises psycopg2.Error: si no se consigue el bloqueo tras 'intentos' intentos
+    """
+    intento = 1
+    while True:
+        with conn.cursor() as cursor:
+            try:
+                claves, vistas = _cambiar(cursor, espera_bloqueo)
+                conn.commit()
+                break
+            except psycopg2.Error as e:
+                conn.rollback()
+                # 55P03: lock_not_available
+                if e.pgcode != '55P03' or intento >= intentos:
+                    raise
+            except BaseException:
+                conn.rollback()
+                raise
+        print(f"PELICULA está ocupada; intento {intento} de {intentos}.", file=sys.stderr)
+        intento += 1
+
+    with conn.cursor() as cursor:
+        try:
+            for tabla, nombre, _ in claves:
+                cursor.execute(f"ALTER TABLE {tabla} VALIDATE CONSTRAINT {nombre}")
+                conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+    materializadas = [nombre for nombre, tipo in vistas if tipo == 'm']
+    conocidas = [nombre for nombre in materializadas if nombre in analitica.VISTAS]
+    if conocidas and analitica.refrescar(conn, conocidas, concurrente=False) is None:
+        print("Había otro refresco de las vistas en curso; refrescarlas con: python analitica.py refrescar",
+              file=sys.stderr)
+    autocommit = conn.autocommit
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cursor:
+            for nombre in materializadas:
+                if nombre not in analitica.VISTAS:
+                    cursor.execute(f"REFRESH MATERIALIZED VIEW {nombre}")
+            cursor.execute("ANALYZE PELICULA")
+    finally:
+        conn.autocommit = autocommit
+    return {'claves_externas': [f"{tabla}.{nombre}" for tabla, nombre, _ in claves],
+            'vistas': [nombre for nombre, _ in vistas]}
+
+
+## ------------------------------------------------------------
+def limpiar(conn):
+    """
+    Borra PELICULA_ANTIGUA y lo que usaba la copia, después de 'cambiar'.
+    :raises ValueError: si todavía no se ha hecho el cambio
+    """
+    with conn.cursor() as cursor:
+        try:
+            progreso = _progreso(cursor)
+            if progreso is None or progreso['cambiado'] is None:
+                raise ValueError("Todavía no se ha cambiado la tabla (python particionar.py cambiar).")
+            cursor.execute(f"DROP TABLE {ANTIGUA}")
+            cursor.execute("DROP TABLE PELICULA_PARTICION")
+            cursor.execute("DROP FUNCTION espejo_pelicula()")
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+
+
+def abandonar(conn):
+    """
+    Deshace 'preparar' (y la copia) antes de 'cambiar': PELICULA queda como estaba.
+    :raises ValueError: si no hay nada que deshacer o ya se ha hecho el cambio
+    """
+    with conn.cursor() as cursor:
+        try:
+            progreso = _progreso(cursor)
+            if progreso is None:
+                raise ValueError("No hay un particionado preparado.")
+            if progreso['cambiado'] is not None:
+                raise ValueError("La tabla ya se ha cambiado; la anterior está en PELICULA_ANTIGUA.")
+            cursor.execute(f"DROP TRIGGER {DISPARADOR} ON PELICULA")
+            cursor.execute("DROP FUNCTION espejo_pelicula()")
+            cursor.execute(f"DROP TABLE {NUEVA}")
+            cursor.execute("DROP TABLE PELICULA_PARTICION")
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+
+
+def estado(conn):
+    """
+    :return: diccionario con las particiones de PELICULA y el progreso del particionado
+    """
+    with conn.cursor() as cursor:
+        try:
+            particionada = _particionada(cursor)
+            cursor.execute("""
+                SELECT inhrelid::regclass::text, c.reltuples::bigint
+                FROM pg_inherits JOIN pg_class c ON c.oid = inhrelid
+                WHERE inhparent = 'pelicula'::regclass
+                ORDER BY 1
+            """)
+            particiones = dict(cursor.fetchall())
+            progreso = _progreso(cursor)
+            conn.commit()
+        except psycopg2.Error:
+            conn.rollback()
+            raise
+    return {'particionada': particionada, 'particiones': particiones, 'progreso': progreso}
+
+
+## ------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description="Particiona PELICULA por hash de id_Pelicula sin parar la aplicación.")
+    subparsers = parser.add_subparsers(dest='comando', required=True)
+    p_preparar = subparsers.add_parser('preparar', help="Crea la tabla particionada y el disparador de copia")
+    p_preparar.add_argument('--particiones', type=int, default=16)
+    p_preparar.add_argument('--espera-bloqueo', type=float, default=5.0, help="Segundos de espera por el bloqueo")
+    p_copiar = subparsers.add_parser('copiar', help="Copia las filas existentes por lotes")
+    p_copiar.add_argument('--lote', type=int, default=10000, help="Filas por transacción")
+    p_copiar.add_argument('--pausa', type=float, default=0.0, help="Segundos de pausa entre lotes")
+    subparsers.add_parser('verificar', help="Compara el contenido de las dos tablas")
+    p_cambiar = subparsers.add_parser('cambiar', help="Pone la tabla particionada en lugar de PELICULA")
+    p_cambiar.add_argument('--espera-bloqueo', type=float, default=5.0, help="Segundos de espera por el bloqueo")
+    p_cambiar.add_argument('--intentos', type=int, default=10)
+    subparsers.add_parser('limpiar', help="Borra PELICULA_ANTIGUA")
+    subparsers.add_parser('abandonar', help="Deshace 'preparar' antes de cambiar")
+    subparsers.add_parser('estado', help="Particiones y progreso")
+    args = parser.parse_args()
+
+    params, _ = leer_config()
+    conn = psycopg2.connect(**params)
+    try:
+        if args.comando == 'preparar':
+            preparar(conn, args.particiones, args.espera_bloqueo)
+            print(f"Preparada {NUEVA} con {args.particiones} particiones.")
+        elif args.comando == 'copiar':
+            total = copiar(conn, args.lote, args.pausa,
+                           avisar=lambda n: print(f"\r{n} filas copiadas", end='', flush=True))
+            print(f"\nCopia terminada: {total} filas.")
+        elif args.comando == 'verificar':
+            resultado = verificar(conn)
+            print(json.dumps(resultado, indent=2))
+            if not resultado['iguales']:
+                sys.exit(1)
+        elif args.comando == 'cambiar':
+            print(json.dumps(cambiar(conn, args.espera_bloqueo, args.intentos), indent=2))
+        elif args.comando == 'limpiar':
+            limpiar(conn)
+            print(f"{ANTIGUA} borrada.")
+        elif args.comando == 'abandonar':
+            abandonar(conn)
+            print("Particionado abandonado.")
+        else:
+            print(json.dumps(estado(conn), indent=2, default=str))
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    except psycopg2.Error as e:
+        print(f"Error {e.pgcode}: {e.pgerror}")
+        sys.exit(1)
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,282 @@
+"""
+Carga masiva en paralelo: lectura, validación en varios procesos y carga por varias
+conexiones a la vez.
+
+Es la misma carga que app.cargar_fichero (mismas reglas de validación, mismo COPY por
+bloque y mismo fichero de rechazos), repartida en tres etapas que trabajan a la vez:
+
+    lectura      el proceso principal lee el fichero y lo parte en bloques
+    validación   un grupo de procesos valida los bloques con app._validar_bloque
+    carga        varios hilos, cada uno con una conexión del pool, envían los
+                 bloques válidos con COPY, cada uno en su transacción
+
+Entre etapas como mucho hay 'en_vuelo' bloques, así que la memoria no depende del
+tamaño del fichero y, si la base de datos va más despacio que la validación, la
+lectura espera. Los bloques se cargan en el orden en que terminan de validarse.
+Al final se muestran las filas por segundo de toda la carga y el tiempo ocupado de
+cada etapa, para ver cuál limita.
+
+    python pipeline.py pelicula peliculas.csv [--procesos 4] [--conexiones 4] [--bloque 10000]
+"""
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import time
+
+import psycopg2
+
+import app
+from conexiones import PoolConexiones
+
+
+class CargaInterrumpida(Exception):
+    """
+    Un hilo de carga se quedó sin conexión y la carga se detuvo a medias.
+    """
+
+    def __init__(self, resultado, causa):
+        super().__init__(f"Carga interrumpida: {resultado['cargadas']} filas cargadas y "
+                         f"{resultado['no_cargadas']} válidas sin cargar (en {resultado['rechazos']}): {causa}")
+        self.resultado = resultado
+        self.causa = causa
+
+
+## ------------------------------------------------------------
+def _bloques(ruta, tam_bloque):
+    """
+    :return: generador de listas de como mucho tam_bloque tuplas (número de línea, registro)
+    """
+    bloque = []
+    for item in app._leer_registros(ruta):
+        bloque.append(item)
+        if len(bloque) >= tam_bloque:
+            yield bloque
+            bloque = []
+    if bloque:
+        yield bloque
+
+
+def _validar(tabla, bloque):
+    """
+    Valida un bloque en un proceso del grupo.
+    :return: tupla (filas válidas, rechazadas, segundos de validación)
+    """
+    inicio = time.perf_counter()
+    validas, malas = app._validar_bloque(tabla, bloque)
+    return validas, malas, time.perf_counter() - inicio
+
+
+class _Estadisticas:
+    """
+    Contadores compartidos por las etapas.
+    """
+
+    def __init__(self):
+        self.cerrojo = threading.Lock()
+        self.leidas = 0
+        self.cargadas = 0
+        self.rechazadas = 0
+        self.no_cargadas = 0
+        self.bloques = 0
+        self.segundos = {'lectura': 0.0, 'validacion': 0.0, 'carga': 0.0}
+
+    def sumar(self, etapa=None, segundos=0.0, **contadores):
+        with self.cerrojo:
+            if etapa is not None:
+                self.segundos[etapa] += segundos
+            for nombre, n in contadores.items():
+                setattr(self, nombre, getattr(self, nombre) + n)
+
+
+## ------------------------------------------------------------
+def cargar(pool, tabla, ruta, ruta_rechazos=None, tam_bloque=10000, procesos=None, conexiones=4, en_vuelo=None,
+           avisar=None):
+    """
+    Carga masiva de una tabla desde un fichero CSV o JSONL en paralelo.
+    :param pool: PoolConexiones del que cada hilo de carga toma una conexión
+    :param tabla: 'pelicula', 'usuario' o 'estudio'
+    :param ruta: fichero de entrada
+    :param ruta_rechazos: fichero JSONL donde se guardan los rechazos (por defecto <ruta>.rechazos.jsonl)
+    :param tam_bloque: número de registros por bloque (y por COPY)
+    :param procesos: procesos de validación (None: uno por CPU)
+    :param conexiones: hilos de carga, cada uno con su conexión
+    :param en_vuelo: bloques máximos esperando entre etapas (None: el doble de procesos)
+    :param avisar: función que recibe las estadísticas tras cargar cada bloque
+    :return: diccionario con las filas cargadas y rechazadas, la duración, las filas por
+             segundo y los segundos ocupados de cada etapa
+    :raises CargaInterrumpida: si algún hilo de carga se queda sin conexión; los bloques
+                               ya cargados quedan confirmados, los validados que no se
+                               cargaron van al fichero de rechazos y el error lleva el
+                               resultado con las cuentas de unos y otros
+    """
+    tabla = tabla.lower()
+    if tabla not in app.COLUMNAS_CARGA:
+        raise ValueError(f"Tabla desconocida: {tabla}")
+    procesos = procesos or os.cpu_count() or 1
+    en_vuelo = en_vuelo or 2 * procesos
+    if ruta_rechazos is None:
+        ruta_rechazos = ruta + '.rechazos.jsonl'
+
+    estadisticas = _Estadisticas()
+    validados = queue.Queue(maxsize=en_vuelo)
+    inicio = time.perf_counter()
+
+    with open(ruta_rechazos, 'w', encoding='utf-8') as f_rechazos:
+        cerrojo_rechazos = threading.Lock()
+
+        def rechazar(filas):
+            with cerrojo_rechazos:
+                for num_linea, registro, motivo in filas:
+                    f_rechazos.write(json.dumps({'linea': num_linea, 'motivo': motivo, 'registro': registro},
+                                                ensure_ascii=False, default=str) + '\n')
+
+        errores = []
+
+        def sin_cargar(bloque, malas, motivo):
+            """
+            Manda al fichero de rechazos las filas válidas de un bloque que no se cargó.
+            :return: número de filas
+            """
+            lineas_malas = {n for n, _, _ in malas}
+            filas = [(n, r, motivo) for n, r in bloque if n not in lineas_malas]
+            rechazar(filas)
+            return len(filas)
+
+        def cargador():
+            try:
+                with pool.conexion() as conn:
+                    while True:
+                        trabajo = validados.get()
+                        if trabajo is None:
+                            return
+                        bloque, validas, malas = trabajo
+                        comienzo = time.perf_counter()
+                        try:
+                            app._copiar_bloque(conn, tabla, validas)
+                            estadisticas.sumar('carga', time.perf_counter() - comienzo, cargadas=len(validas))
+                        except psycopg2.Error as e:
+                            # El COPY es atómico: si la base de datos rechaza una fila se rechaza el bloque entero
+                            sin_cargar(bloque, malas, f"Error {e.pgcode}: {e.pgerror}")
+                            estadisticas.sumar('carga', time.perf_counter() - comienzo, rechazadas=len(validas))
+                        if avisar is not None:
+                            avisar(estadisticas)
+            except Exception as e:
+                # Sin conexión no se puede seguir: se anota el error y se vacía la cola
+                # para que la lectura no se quede esperando. Los bloques que quedaban
+                # estaban validados pero no se cargan: van a los rechazos para reintentarlos
+                errores.append(e)
+                motivo = f"No cargada: {type(e).__name__}: {str(e).strip()}"
+                while True:
+                    trabajo = validados.get()
+                    if trabajo is None:
+                        break
+                    bloque, validas, malas = trabajo
+                    estadisticas.sumar(no_cargadas=sin_cargar(bloque, malas, motivo))
+
+        hilos = [threading.Thread(target=cargador, name=f'carga-{i}', daemon=True) for i in range(conexiones)]
+        for hilo in hilos:
+            hilo.start()
+
+        def entregar(hecho):
+            bloque = pendientes.pop(hecho)
+            validas, malas, segundos = hecho.result()
+            rechazar(malas)
+            estadisticas.sumar('validacion', segundos, rechazadas=len(malas), bloques=1)
+            if validas:
+                validados.put((bloque, validas, malas))
+
+        # 'spawn' para que los procesos no hereden las conexiones ni los hilos de este
+        contexto = multiprocessing.get_context('spawn')
+        pendientes = {}
+        try:
+            with concurrent.futures.ProcessPoolExecutor(procesos, mp_context=contexto) as grupo:
+                bloques = _bloques(ruta, tam_bloque)
+                while not errores:
+                    comienzo = time.perf_counter()
+                    bloque = next(bloques, None)
+                    estadisticas.sumar('lectura', time.perf_counter() - comienzo,
+                                       leidas=len(bloque) if bloque else 0)
+                    if bloque is None:
+                        break
+                    pendientes[grupo.submit(_validar, tabla, bloque)] = bloque
+                    # No se lee más mientras haya en_vuelo bloques validándose
+                    while len(pendientes) >= en_vuelo:
+                        hechos, _ = concurrent.futures.wait(pendientes,
+                                                            return_when=concurrent.futures.FIRST_COMPLETED)
+                        for hecho in hechos:
+                            entregar(hecho)
+                for hecho in concurrent.futures.as_completed(list(pendientes)):
+                    entregar(hecho)
+        finally:
+            for _ in hilos:
+                validados.put(None)
+            for hilo in hilos:
+                hilo.join()
+
+    transcurrido = time.perf_counter() - inicio
+    resultado = {
+        'tabla': tabla,
+        'leidas': estadisticas.leidas,
+        'cargadas': estadisticas.cargadas,
+        'rechazadas': estadisticas.rechazadas,
+        'no_cargadas': estadisticas.no_cargadas,
+        'bloques': estadisticas.bloques,
+        'segundos': round(transcurrido, 3),
+        'filas_por_segundo': round(estadisticas.cargadas / transcurrido, 1) if transcurrido else 0.0,
+        'procesos': procesos,
+        'conexiones': conexiones,
+        # Tiempo ocupado de cada etapa, sumado entre sus procesos o hilos
+        'segundos_por_etapa': {etapa: round(s, 3) for etapa, s in estadisticas.segundos.items()},
+        'rechazos': ruta_rechazos,
+    }
+    if errores:
+        raise CargaInterrumpida(resultado, errores[0]) from errores[0]
+    return resultado
+
+
+## ------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description="Carga masiva en paralelo desde un fichero CSV o JSONL.")
+    parser.add_argument('tabla', choices=sorted(app.COLUMNAS_CARGA))
+    parser.add_argument('fichero')
+    parser.add_argument('--rechazos', default=None, help="Fichero JSONL de rechazos")
+    parser.add_argument('--bloque', type=int, default=10000, help="Registros por bloque")
+    parser.add_argument('--procesos', type=int, default=None, help="Procesos de validación (por defecto, uno por CPU)")
+    parser.add_argument('--conexiones', type=int, default=4, help="Conexiones de carga")
+    parser.add_argument('--en-vuelo', type=int, default=None, help="Bloques máximos entre etapas")
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.fichero):
+        print(f"El fichero {args.fichero} no existe.")
+        sys.exit(1)
+
+    def progreso(e):
+        transcurrido = time.perf_counter() - inicio
+        print(f"\r  {e.cargadas} filas cargadas, {e.rechazadas} rechazadas "
+              f"({e.cargadas / transcurrido:.0f} filas/s)", end='', flush=True)
+
+    pool = PoolConexiones.desde_config(minconn=0, maxconn=args.conexiones)
+    inicio = time.perf_counter()
+    try:
+        resultado = cargar(pool, args.tabla, args.fichero, args.rechazos, args.bloque, args.procesos,
+                           args.conexiones, args.en_vuelo, avisar=progreso)
+    except CargaInterrumpida as e:
+        print()
+        print(e)
+        print(json.dumps(e.resultado, indent=2, ensure_ascii=False))
+        sys.exit(1)
+    finally:
+        pool.cerrar()
+    print()
+    print(json.dumps(resultado, indent=2, ensure_ascii=False))
+    if resultado['rechazadas']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
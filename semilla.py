@@ -0,0 +1,86 @@
+"""
+Generación determinista de datos de prueba en USUARIO, ESTUDIO y PELICULA.
+
+Los datos se generan en el servidor con generate_series, así que sembrar millones
+de películas no pasa filas por el cliente. Dos ejecuciones con los mismos tamaños
+producen exactamente los mismos datos, con DNI válidos y todas las claves externas
+resueltas.
+"""
+import psycopg2
+
+# Letras de control del DNI, las mismas que usa es_dni_valido
+LETRAS_DNI = 'TRWAGMYFPDXBNJZSQVHLCKE'
+
+GENEROS = ('drama', 'comedia', 'accion', 'terror', 'ciencia ficcion', 'animacion', 'documental', 'romance')
+
+
+def dni_sembrado(n):
+    """
+    :return: el DNI que la semilla asigna al usuario número n (de 1 en adelante)
+    """
+    return f"{n:08d}{LETRAS_DNI[n % 23]}"
+
+
+def sembrar(conn, peliculas, usuarios=None, estudios=None, vaciar=False):
+    """
+    Siembra las tablas con datos deterministas.
+    :param conn: la conexión abierta a la base de datos
+    :param peliculas: número de películas
+    :param usuarios: número de usuarios (por defecto una décima parte de las películas)
+    :param estudios: número de estudios (por defecto una milésima parte de las películas)
+    :param vaciar: si es True vacía antes las tres tablas; si es False deben estar vacías
+    :raises ValueError: si las tablas tienen datos y no se pide vaciarlas
+    """
+    usuarios = usuarios or max(1, peliculas // 10)
+    estudios = estudios or max(1, peliculas // 1000)
+
+    with conn.cursor() as cursor:
+        try:
+            if vaciar:
+                cursor.execute("TRUNCATE PELICULA, USUARIO, ESTUDIO CASCADE")
+            else:
+                cursor.execute("SELECT EXISTS (SELECT 1 FROM PELICULA) OR EXISTS (SELECT 1 FROM USUARIO) "
+                               "OR EXISTS (SELECT 1 FROM ESTUDIO)")
+                if cursor.fetchone()[0]:
+                    raise ValueError("Las tablas no están vacías; usa vaciar=True para sembrarlas.")
+
+            cursor.execute("""
+                INSERT INTO USUARIO (DNI, telefono, nombre, apellido)
+                SELECT lpad(n::text, 8, '0') || substr(%(letras)s, n %% 23 + 1, 1),
+                       (600000000 + n)::text,
+                       'Nombre' || n %% 1000,
+                       'Apellido' || n %% 5000
+                FROM generate_series(1, %(u)s) AS n
+            """, {'letras': LETRAS_DNI, 'u': usuarios})
+
+            cursor.execute("""
+                INSERT INTO ESTUDIO (id_Estudio, nombreE, paisOrigen)
+                SELECT n, 'Estudio ' || n, (ARRAY['España', 'Francia', 'EEUU', 'Japón', 'México'])[n %% 5 + 1]
+                FROM generate_series(1, %(e)s) AS n
+            """, {'e': estudios})
+
+            # Los multiplicadores son primos para repartir las películas entre usuarios y estudios
+            cursor.execute("""
+                INSERT INTO PELICULA (id_Us, id_Est, id_Pelicula, precio, titulo, duracion_Minutos, año, genero, valoracion)
+                SELECT lpad(u::text, 8, '0') || substr(%(letras)s, (u %% 23)::int + 1, 1),
+                       n * 104729 %% %(e)s + 1,
+                       n,
+                       1 + (n * 37 %% 5000) / 100.0,
+                       'Pelicula ' || n,
+                       60 + n %% 120,
+                       timestamp '1950-01-01' + (n * 7 %% 27000) * interval '1 day',
+                       (%(generos)s::varchar[])[(n %% %(ng)s)::int + 1],
+                       NULLIF(n %% 6, 0)
+                FROM generate_series(1, %(p)s::bigint) AS n,
+                     LATERAL (SELECT n * 7919 %% %(u)s + 1 AS u) AS x
+            """, {'letras': LETRAS_DNI, 'e': estudios, 'u': usuarios, 'p': peliculas,
+                  'generos': list(GENEROS), 'ng': len(GENEROS)})
+            conn.commit()
+        except (psycopg2.Error, ValueError):
+            conn.rollback()
+            raise
+
+    # ANALYZE fuera de la transacción para que el planificador vea los datos nuevos
+    with conn.cursor() as cursor:
+        cursor.execute("ANALYZE USUARIO, ESTUDIO, PELICULA")
+    conn.commit()
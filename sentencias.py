@@ -0,0 +1,115 @@
+"""
+Registro de sentencias preparadas.
+
+Cada sentencia se registra una vez con su texto en el formato de psycopg2
+(%(nombre)s o %s); la primera vez que se ejecuta en una conexión se hace un
+PREPARE y desde entonces se ejecuta con EXECUTE, de modo que el servidor no
+vuelve a analizarla ni a planificarla. Las sentencias preparadas duran lo que
+la sesión, aunque la transacción en que se prepararon se deshaga.
+"""
+import re
+import threading
+import weakref
+
+import psycopg2
+import psycopg2.errorcodes
+
+
+_PARAMETRO = re.compile(r'%\((\w+)\)s|%s|%%')
+
+
+class RegistroSentencias:
+    """
+    Sentencias conocidas, qué conexiones tienen preparada cada una y contadores de uso.
+    Con activo=False se ejecuta directamente el texto original (útil detrás de un
+    pgbouncer en modo transacción, que no conserva las sentencias preparadas).
+    """
+
+    def __init__(self, activo=True):
+        self.activo = activo
+        self._sentencias = {}                               # nombre -> (sql original, sql con $n, parámetros)
+        self._preparadas = weakref.WeakKeyDictionary()      # conexión -> nombres preparados en ella
+        self._cerrojo = threading.Lock()
+        self._preparaciones = {}
+        self._ejecuciones = {}
+
+    def registrar(self, nombre, sql):
+        """
+        Registra una sentencia, convirtiendo sus parámetros al formato $n de PREPARE.
+        :param nombre: nombre de la sentencia preparada (identificador SQL)
+        :param sql: texto con parámetros %(nombre)s o %s
+        """
+        orden = []
+        posicion = {}
+
+        def sustituir(m):
+            if m.group(0) == '%%':
+                return '%'
+            clave = m.group(1) if m.group(1) is not None else len(orden)
+            if clave not in posicion:
+                orden.append(clave)
+                posicion[clave] = len(orden)
+            return f'${posicion[clave]}'
+
+        preparada = _PARAMETRO.sub(sustituir, sql).strip().rstrip(';')
+        with self._cerrojo:
+            self._sentencias[nombre] = (sql, preparada, orden)
+            self._preparaciones[nombre] = 0
+            self._ejecuciones[nombre] = 0
+
+    def ejecutar(self, cursor, nombre, params):
+        """
+        Ejecuta una sentencia registrada, preparándola antes si la conexión del
+        cursor todavía no la tiene.
+        :param cursor: cursor de la conexión
+        :param nombre: nombre con que se registró la sentencia
+        :param params: diccionario o secuencia con los parámetros
+        """
+        sql, preparada, orden = self._sentencias[nombre]
+        if not self.activo:
+            cursor.execute(sql, params)
+            return
+
+        conn = cursor.connection
+        with self._cerrojo:
+            nombres = self._preparadas.setdefault(conn, set())
+            hay_que_preparar = nombre not in nombres
+        if hay_que_preparar:
+            cursor.execute(f"PREPARE {nombre} AS {preparada}")
+            with self._cerrojo:
+                nombres.add(nombre)
+                self._preparaciones[nombre] += 1
+
+        valores = [params[clave] for clave in orden]
+        try:
+            if valores:
+                cursor.execute(f"EXECUTE {nombre} ({', '.join(['%s'] * len(valores))})", valores)
+            else:
+                cursor.execute(f"EXECUTE {nombre}")
+        except psycopg2.Error as e:
+            # Si la sesión perdió la sentencia (p. ej. por un DISCARD ALL) se volverá a preparar
+            if e.pgcode == psycopg2.errorcodes.INVALID_SQL_STATEMENT_NAME:
+                with self._cerrojo:
+                    nombres.discard(nombre)
+            raise
+        with self._cerrojo:
+            self._ejecuciones[nombre] += 1
+
+    def estadisticas(self):
+        """
+        :return: diccionario con las preparaciones y ejecuciones de cada sentencia y la
+                 proporción de ejecuciones que reutilizaron un plan ya preparado
+        """
+        with self._cerrojo:
+            preparaciones = sum(self._preparaciones.values())
+            ejecuciones = sum(self._ejecuciones.values())
+            return {
+                'activo': self.activo,
+                'conexiones': len(self._preparadas),
+                'preparaciones': preparaciones,
+                'ejecuciones': ejecuciones,
+                'reutilizacion': max(0.0, 1 - preparaciones / ejecuciones) if ejecuciones else 0.0,
+                'sentencias': {nombre: {'preparaciones': self._preparaciones[nombre],
+                                        'ejecuciones': self._ejecuciones[nombre]}
+                               for nombre in self._sentencias},
+            }
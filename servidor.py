@@ -0,0 +1,585 @@
+"""
+Servidor HTTP/JSON sobre las operaciones de acceso a datos de app.py.
+
+Se basa en asyncio: cada conexión HTTP se atiende en el bucle de eventos y las
+operaciones de base de datos, que son bloqueantes, se ejecutan en un pool de hilos
+con una conexión del PoolConexiones cada una. Admite keep-alive.
+
+    python servidor.py [--host 127.0.0.1] [--puerto 8080] [--hilos N]
+
+Los parámetros de la query string se reciben junto con los del cuerpo.
+Con 'version' (la que devuelve GET /peliculas/{id}) las modificaciones solo se
+aplican si la película no ha cambiado desde entonces; si cambió responden 409.
+
+Rutas:
+    GET    /peliculas/{id}
+    POST   /peliculas                    {id_us, id_est, id_pelicula, precio, titulo, duracion_minutos, año, genero}
+    POST   /peliculas/alta               {...película, usuario: {nombre, apellido, telefono}, estudio: {nombree, paisorigen}}
+                                         o {peliculas: [...], omitir_existentes}
+    PUT    /peliculas/{id}               {titulo, año, precio, version}; lo que falte no se cambia
+    DELETE /peliculas/{id}
+    POST   /peliculas/{id}/rebaja        {porcentaje, version}
+    POST   /peliculas/{id}/valoracion    {dni, valoracion}
+    GET    /peliculas/mejor-valoradas?n=10&minimo=1
+    GET    /peliculas/buscar?q=TEXTO&genero=G&prefijo=1&limite=N&despues=MARCA
+    POST   /promociones                  {porcentaje, genero, id_estudio, desde, hasta, ids, lote, todo}
+    GET    /usuarios/{dni}/peliculas?limite=N&despues=ID
+    GET    /informes/{estudios|paises|generos|anos}?limite=N&pais=P&desde=A&hasta=A
+    POST   /usuarios                     {dni, nombre, apellido, telefono}
+    POST   /estudios                     {id_estudio, nombree, paisorigen}
+    GET    /cache                        estadísticas de la caché de películas
+    GET    /sentencias                   estadísticas de las sentencias preparadas
+    GET    /cola                         estadísticas de la cola de escritura diferida
+    GET    /metrics[?formato=json]       latencias de operaciones y sentencias (metricas.py)
+
+    GET    /replicas                     lecturas servidas por cada réplica
+
+Con BDA_COLA_ESCRITURA=1 las valoraciones y las rebajas sin 'version' pasan por la
+cola de escritura diferida (cola_escritura.py) y responden 202.
+
+Si hay réplicas configuradas (conexiones.leer_replicas) las consultas GET de películas,
+búsquedas e informes se sirven desde ellas. Las escrituras devuelven la cabecera
+X-BDA-LSN; un cliente que la reenvíe en sus lecturas leerá lo que escribió.
+
+Con BDA_CAMBIOS=1 el servidor sigue los cambios del catálogo (cambios.py) e invalida
+en su caché las películas que modifiquen otros procesos.
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import traceback
+from urllib.parse import parse_qsl
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
+from decimal import Decimal
+from http import HTTPStatus
+
+import psycopg2
+import psycopg2.errorcodes
+import psycopg2.extensions
+
+import analitica
+import app
+import cambios
+import metricas
+from conexiones import EnrutadorLecturas, PoolConexiones, leer_config
+
+
+LECTURA = psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED
+SERIALIZABLE = psycopg2.extensions.ISOLATION_LEVEL_SERIALIZABLE
+
+# Código HTTP para cada error de PostgreSQL que puede provocar el cliente
+ESTADOS_PGCODE = {
+    psycopg2.errorcodes.UNIQUE_VIOLATION: HTTPStatus.CONFLICT,
+    psycopg2.errorcodes.FOREIGN_KEY_VIOLATION: HTTPStatus.CONFLICT,
+    psycopg2.errorcodes.SERIALIZATION_FAILURE: HTTPStatus.CONFLICT,
+    psycopg2.errorcodes.CHECK_VIOLATION: HTTPStatus.UNPROCESSABLE_ENTITY,
+    psycopg2.errorcodes.NOT_NULL_VIOLATION: HTTPStatus.UNPROCESSABLE_ENTITY,
+    psycopg2.errorcodes.NUMERIC_VALUE_OUT_OF_RANGE: HTTPStatus.UNPROCESSABLE_ENTITY,
+    psycopg2.errorcodes.INVALID_TEXT_REPRESENTATION: HTTPStatus.BAD_REQUEST,
+    psycopg2.errorcodes.INSUFFICIENT_PRIVILEGE: HTTPStatus.FORBIDDEN,
+}
+
+
+# Máximo de filas por página en las consultas paginadas
+MAX_PAGINA = 1000
+
+# Forma de una posición del WAL en la cabecera X-BDA-LSN ('16/B374D848')
+LSN = re.compile(r'^[0-9A-Fa-f]{1,8}/[0-9A-Fa-f]{1,8}$')
+
+
+class ErrorHTTP(Exception):
+    def __init__(self, estado, mensaje):
+        super().__init__(mensaje)
+        self.estado = estado
+        self.mensaje = mensaje
+
+
+def _a_json(valor):
+    if isinstance(valor, Decimal):
+        return float(valor)
+    if isinstance(valor, (date, datetime)):
+        return valor.isoformat()
+    raise TypeError(f"Tipo no serializable: {type(valor).__name__}")
+
+
+def _fecha(valor):
+    """
+    Convierte una fecha dd-mm-yyyy (como en los formularios) o None.
+    """
+    if valor is None or valor == "":
+        return None
+    try:
+        return datetime.strptime(str(valor), '%d-%m-%Y')
+    except ValueError:
+        raise ErrorHTTP(HTTPStatus.BAD_REQUEST, "El año debe tener el formato dd-mm-yyyy.")
+
+
+def _numero(cuerpo, campo, tipo=float, obligatorio=True):
+    valor = cuerpo.get(campo)
+    if valor is None or valor == "":
+        if obligatorio:
+            raise ErrorHTTP(HTTPStatus.BAD_REQUEST, f"Falta el campo {campo}.")
+        return None
+    if isinstance(valor, bool):
+        raise ErrorHTTP(HTTPStatus.BAD_REQUEST, f"El campo {campo} debe ser numérico.")
+    try:
+        return tipo(valor)
+    except (TypeError, ValueError):
+        raise ErrorHTTP(HTTPStatus.BAD_REQUEST, f"El campo {campo} debe ser numérico.")
+
+
+def _texto(cuerpo, campo, maximo=None):
+    """
+    Devuelve el campo de texto del cuerpo o None si no viene; 400 si no es una cadena.
+    """
+    valor = cuerpo.get(campo)
+    if valor is None or valor == "":
+        return None
+    if not isinstance(valor, str):
+        raise ErrorHTTP(HTTPStatus.BAD_REQUEST, f"El campo {campo} debe ser un texto.")
+    if maximo is not None and len(valor) > maximo:
+        raise ErrorHTTP(HTTPStatus.BAD_REQUEST, f"El campo {campo} debe tener como máximo {maximo} caracteres.")
+    return valor
+
+
+def _objeto(datos, campo):
+    """
+    Devuelve el objeto JSON anidado en el campo (con las claves en minúsculas) o None.
+    """
+    valor = datos.get(campo)
+    if valor is None:
+        return None
+    if not isinstance(valor, dict):
+        raise ErrorHTTP(HTTPStatus.BAD_REQUEST, f"El campo {campo} debe ser un objeto JSON.")
+    return {str(k).lower(): v for k, v in valor.items()}
+
+
+## ------------------------------------------------------------
+## Manejadores: se ejecutan en un hilo con una conexión del pool
+## ------------------------------------------------------------
+def ver_pelicula(conn, id_pelicula, cuerpo):
+    pelicula = app.obtener_pelicula(conn, id_pelicula)
+    if pelicula is None:
+        raise ErrorHTTP(HTTPStatus.NOT_FOUND, f"La pelicula con id {id_pelicula} no existe.")
+    return HTTPStatus.OK, pelicula
+
+
+def nueva_pelicula(conn, cuerpo):
+    try:
+        datos = app.validar_pelicula({str(k).lower(): v for k, v in cuerpo.items()})
+    except (TypeError, ValueError) as e:
+        raise ErrorHTTP(HTTPStatus.BAD_REQUEST, str(e))
+    app.crear_pelicula(conn, *datos)
+    return HTTPStatus.CREATED, {'id_pelicula': datos[2]}
+
+
+def _alta(cuerpo):
+    """
+    Valida una película con su usuario y su estudio opcionales ({..., usuario, estudio}).
+    """
+    if not isinstance(cuerpo, dict):
+        raise ErrorHTTP(HTTPStatus.BAD_REQUEST, "Cada película debe ser un objeto JSON.")
+    datos = {str(k).lower(): v for k, v in cuerpo.items()}
+    usuario = _objeto(datos, 'usuario')
+    estudio = _objeto(datos, 'estudio')
+    try:
+        pelicula = app.validar_pelicula(datos)
+        usuario = None if usuario is None else app.validar_usuario(dict(usuario, dni=pelicula[0]))
+        estudio = None if estudio is None else app.validar_estudio(dict(estudio, id_estudio=pelicula[1]))
+    except (TypeError, ValueError) as e:
+        raise ErrorHTTP(HTTPStatus.BAD_REQUEST, str(e))
+    return pelicula, usuario, estudio
+
+
+def alta_pelicula(conn, cuerpo):
+    if isinstance(cuerpo.get('peliculas'), list):
+        altas = [_alta(elemento) for elemento in cuerpo['peliculas']]
+        omitir = str(cuerpo.get('omitir_existentes', '')).lower() in ('1', 'true', 'si', 'sí')
+        return HTTPStatus.CREATED, app.alta_peliculas(conn, altas, omitir_existentes=omitir)
+    pelicula, usuario, estudio = _alta(cuerpo)
+    usuario_nuevo, estudio_nuevo = app.alta_pelicula(conn, pelicula, usuario, estudio)
+    return HTTPStatus.CREATED, {'id_pelicula': pelicula[2], 'usuario_nuevo': usuario_nuevo,
+                                'estudio_nuevo': estudio_nuevo}
+
+
+def cambiar_pelicula(conn, id_pelicula, cuerpo):
+    titulo = _texto(cuerpo, 'titulo', 20)
+    ano = _fecha(cuerpo.get('año'))
+    precio = _numero(cuerpo, 'precio', obligatorio=False)
+    version = _numero(cuerpo, 'version', int, False)
+    try:
+        existe = app.modificar_pelicula(conn, id_pelicula, titulo, ano, precio, version=version)
+    except app.ConflictoVersion as e:
+        raise ErrorHTTP(HTTPStatus.CONFLICT, str(e))
+    if not existe:
+        raise ErrorHTTP(HTTPStatus.NOT_FOUND, f"La pelicula con id {id_pelicula} no existe.")
+    return HTTPStatus.OK, {'id_pelicula': id_pelicula}
+
+
+def quitar_pelicula(conn, id_pelicula, cuerpo):
+    if not app.borrar_pelicula(conn, id_pelicula):
+        raise ErrorHTTP(HTTPStatus.NOT_FOUND, "La película no existe.")
+    return HTTPStatus.NO_CONTENT, None
+
+
+def rebaja_pelicula(conn, id_pelicula, cuerpo):
+    porcentaje = _numero(cuerpo, 'porcentaje')
+    version = _numero(cuerpo, 'version', int, False)
+    if app.cola_escritura is not None and version is None:
+        try:
+            app.cola_escritura.rebajar(id_pelicula, porcentaje)
+        except ValueError as e:
+            raise ErrorHTTP(HTTPStatus.BAD_REQUEST, str(e))
+        return HTTPStatus.ACCEPTED, {'id_pelicula': id_pelicula}
+    try:
+        existe = app.rebajar_precio(conn, id_pelicula, porcentaje, version=version)
+    except ValueError as e:
+        raise ErrorHTTP(HTTPStatus.BAD_REQUEST, str(e))
+    except app.ConflictoVersion as e:
+        raise ErrorHTTP(HTTPStatus.CONFLICT, str(e))
+    if not existe:
+        raise ErrorHTTP(HTTPStatus.NOT_FOUND, "El id no existe.")
+    return HTTPStatus.OK, {'id_pelicula': id_pelicula}
+
+
+def valorar(conn, id_pelicula, cuerpo):
+    dni = cuerpo.get('dni')
+    if not isinstance(dni, str) or not app.es_dni_valido(dni):
+        raise ErrorHTTP(HTTPStatus.BAD_REQUEST, "El DNI no es válido.")
+    valoracion = _numero(cuerpo, 'valoracion', tipo=int)
+    try:
+        if app.cola_escritura is not None:
+            app.cola_escritura.valorar(id_pelicula, dni, valoracion)
+            return HTTPStatus.ACCEPTED, {'id_pelicula': id_pelicula}
+        existe = app.guardar_valoracion(conn, id_pelicula, dni, valoracion)
+    except ValueError as e:
+        raise ErrorHTTP(HTTPStatus.BAD_REQUEST, str(e))
+    if not existe:
+        raise ErrorHTTP(HTTPStatus.NOT_FOUND, f"No se encontró una película con id:{id_pelicula}.")
+    return HTTPStatus.OK, {'id_pelicula': id_pelicula}
+
+
+def busqueda(conn, cuerpo):
+    texto = cuerpo.get('q')
+    if not isinstance(texto, str) or not texto.strip():
+        raise ErrorHTTP(HTTPStatus.BAD_REQUEST, "Falta el texto a buscar (q).")
+    genero = _texto(cuerpo, 'genero')
+    prefijo = str(cuerpo.get('prefijo', '')).lower() in ('1', 'true', 's', 'si')
+    limite = min(_numero(cuerpo, 'limite', int, False) or 20, MAX_PAGINA)
+    # La marca de página es la clave de orden y el id de la última película, como JSON
+    despues = cuerpo.get('despues')
+    if despues is not None:
+        try:
+            despues = json.loads(despues) if isinstance(despues, str) else despues
+            orden, id_pelicula = despues
+            despues = (str(orden) if prefijo else float(orden), int(id_pelicula))
+        except (ValueError, TypeError):
+            raise ErrorHTTP(HTTPStatus.BAD_REQUEST, "La marca de página no es válida.")
+    filas, siguiente = app.buscar_peliculas(conn, texto, genero, prefijo, limite, despues)
+    return HTTPStatus.OK, {'peliculas': [fila._asdict() for fila in filas],
+                           'siguiente': None if siguiente is None else json.dumps(siguiente)}
+
+
+def ver_informe(conn, tipo, cuerpo):
+    if tipo not in analitica.SQL_INFORMES:
+        raise ErrorHTTP(HTTPStatus.NOT_FOUND, f"Informe desconocido: {tipo}.")
+    filas, fecha = analitica.informe(conn, tipo, _numero(cuerpo, 'limite', int, False), _texto(cuerpo, 'pais'),
+                                     _numero(cuerpo, 'desde', int, False), _numero(cuerpo, 'hasta', int, False))
+    return HTTPStatus.OK, {'actualizado': fecha, 'filas': filas}
+
+
+def mejor_valoradas(conn, cuerpo):
+    n = min(_numero(cuerpo, 'n', int, False) or 10, MAX_PAGINA)
+    minimo = _numero(cuerpo, 'minimo', int, False) or 1
+    return HTTPStatus.OK, {'peliculas': app.mejor_valoradas(conn, n, minimo)}
+
+
+def promocion(conn, cuerpo):
+    porcentaje = _numero(cuerpo, 'porcentaje')
+    ids = cuerpo.get('ids')
+    if ids is not None:
+        if not isinstance(ids, list):
+            raise ErrorHTTP(HTTPStatus.BAD_REQUEST, "El campo ids debe ser una lista de números.")
+        try:
+            ids = [int(i) for i in ids]
+        except (TypeError, ValueError):
+            raise ErrorHTTP(HTTPStatus.BAD_REQUEST, "El campo ids debe ser una lista de números.")
+    filtros = {'genero': _texto(cuerpo, 'genero'),
+               'id_estudio': _numero(cuerpo, 'id_estudio', int, False),
+               'desde': _numero(cuerpo, 'desde', int, False),
+               'hasta': _numero(cuerpo, 'hasta', int, False),
+               'ids': ids}
+    if all(valor is None for valor in filtros.values()) and cuerpo.get('todo') is not True:
+        raise ErrorHTTP(HTTPStatus.BAD_REQUEST, "No hay filtro: para rebajar todo el catálogo indica \"todo\": true.")
+    try:
+        modificadas = app.rebajar_precios(conn, porcentaje, tam_lote=_numero(cuerpo, 'lote', int, False), **filtros)
+    except ValueError as e:
+        raise ErrorHTTP(HTTPStatus.BAD_REQUEST, str(e))
+    return HTTPStatus.OK, {'modificadas': modificadas}
+
+
+def peliculas_usuario(conn, dni, cuerpo):
+    if not app.es_dni_valido(dni):
+        raise ErrorHTTP(HTTPStatus.BAD_REQUEST, "El DNI no es válido.")
+    limite = min(_numero(cuerpo, 'limite', int, False) or 100, MAX_PAGINA)
+    despues = _numero(cuerpo, 'despues', int, False)
+    filas, siguiente = app.pagina_peliculas_usuario(conn, dni, limite, despues)
+    return HTTPStatus.OK, {'peliculas': [fila._asdict() for fila in filas], 'siguiente': siguiente}
+
+
+def nuevo_usuario(conn, cuerpo):
+    try:
+        datos = app.validar_usuario({str(k).lower(): v for k, v in cuerpo.items()})
+    except (TypeError, ValueError) as e:
+        raise ErrorHTTP(HTTPStatus.BAD_REQUEST, str(e))
+    app.crear_usuario(conn, *datos)
+    return HTTPStatus.CREATED, {'dni': datos[0]}
+
+
+def nuevo_estudio(conn, cuerpo):
+    try:
+        datos = app.validar_estudio({str(k).lower(): v for k, v in cuerpo.items()})
+    except (TypeError, ValueError) as e:
+        raise ErrorHTTP(HTTPStatus.BAD_REQUEST, str(e))
+    app.crear_estudio(conn, *datos)
+    return HTTPStatus.CREATED, {'id_estudio': datos[0]}
+
+
+def estadisticas_cache(conn, cuerpo):
+    return HTTPStatus.OK, app.cache_peliculas.estadisticas()
+
+
+def estadisticas_sentencias(conn, cuerpo):
+    return HTTPStatus.OK, app.sentencias.estadisticas()
+
+
+def estadisticas_metricas(conn, cuerpo):
+    if cuerpo.get('formato') == 'json':
+        return HTTPStatus.OK, metricas.registro.como_dict()
+    return HTTPStatus.OK, metricas.registro.prometheus()
+
+
+def estadisticas_replicas(conn, cuerpo):
+    if servidor_activo is None or servidor_activo.lecturas is None:
+        return HTTPStatus.OK, {'activo': False}
+    return HTTPStatus.OK, dict(servidor_activo.lecturas.estadisticas(), activo=True)
+
+
+def estadisticas_cola(conn, cuerpo):
+    if app.cola_escritura is None:
+        return HTTPStatus.OK, {'activa': False}
+    return HTTPStatus.OK, dict(app.cola_escritura.estadisticas(), activa=True)
+
+
+# (método, expresión de la ruta, conversión del parámetro, manejador, nivel de aislamiento).
+# Los manejadores sin nivel no usan la base de datos y se ejecutan sin conexión.
+RUTAS = [
+    ('GET', re.compile(r'^/peliculas/(\d+)$'), int, ver_pelicula, LECTURA),
+    ('POST', re.compile(r'^/peliculas$'), None, nueva_pelicula, LECTURA),
+    ('POST', re.compile(r'^/peliculas/alta$'), None, alta_pelicula, LECTURA),
+    ('PUT', re.compile(r'^/peliculas/(\d+)$'), int, cambiar_pelicula, LECTURA),
+    ('DELETE', re.compile(r'^/peliculas/(\d+)$'), int, quitar_pelicula, LECTURA),
+    ('POST', re.compile(r'^/peliculas/(\d+)/rebaja$'), int, rebaja_pelicula, SERIALIZABLE),
+    ('POST', re.compile(r'^/peliculas/(\d+)/valoracion$'), int, valorar, LECTURA),
+    ('GET', re.compile(r'^/peliculas/mejor-valoradas$'), None, mejor_valoradas, LECTURA),
+    ('GET', re.compile(r'^/peliculas/buscar$'), None, busqueda, LECTURA),
+    ('POST', re.compile(r'^/promociones$'), None, promocion, SERIALIZABLE),
+    ('GET', re.compile(r'^/usuarios/([^/]+)/peliculas$'), str, peliculas_usuario, LECTURA),
+    ('GET', re.compile(r'^/informes/(\w+)$'), str, ver_informe, LECTURA),
+    ('POST', re.compile(r'^/usuarios$'), None, nuevo_usuario, LECTURA),
+    ('POST', re.compile(r'^/estudios$'), None, nuevo_estudio, LECTURA),
+    ('GET', re.compile(r'^/cache$'), None, estadisticas_cache, None),
+    ('GET', re.compile(r'^/sentencias$'), None, estadisticas_sentencias, None),
+    ('GET', re.compile(r'^/cola$'), None, estadisticas_cola, None),
+    ('GET', re.compile(r'^/metrics$'), None, estadisticas_metricas, None),
+    ('GET', re.compile(r'^/replicas$'), None, estadisticas_replicas, None),
+]
+
+# Manejadores de solo lectura, que pueden ir a una réplica
+DE_LECTURA = {ver_pelicula, mejor_valoradas, busqueda, peliculas_usuario, ver_informe}
+
+# Servidor en marcha, para las estadísticas de las réplicas
+servidor_activo = None
+
+
+## ------------------------------------------------------------
+class Servidor:
+    """
+    Servidor HTTP/1.1 mínimo que enruta las peticiones a los manejadores.
+    """
+
+    def __init__(self, pool, hilos, lecturas=None):
+        self.pool = pool
+        self.lecturas = lecturas
+        self.ejecutor = ThreadPoolExecutor(max_workers=hilos, thread_name_prefix='bda')
+
+    def _ejecutar(self, manejador, nivel, args, lsn):
+        """
+        Ejecuta un manejador en un hilo del ejecutor con una conexión del pool, o de una
+        réplica si es de solo lectura.
+        :param lsn: posición del WAL que debe tener aplicada la réplica (cabecera X-BDA-LSN)
+        :return: tupla (estado, datos, cabeceras adicionales)
+        """
+        with metricas.operacion(manejador.__name__):
+            if self.lecturas is not None and manejador in DE_LECTURA:
+                with self.lecturas.lectura(lambda: self.pool.conexion(nivel), nivel, lsn) as conn:
+                    return manejador(conn, *args) + ({}, )
+            with self.pool.conexion(nivel) as conn:
+                estado, datos = manejador(conn, *args)
+                cabeceras = {}
+                if self.lecturas is not None:
+                    cabeceras['X-BDA-LSN'] = EnrutadorLecturas.posicion_escritura(conn)
+                return estado, datos, cabeceras
+
+    async def _despachar(self, metodo, ruta, cuerpo, lsn=None):
+        ruta, _, query = ruta.partition('?')
+        if query:
+            cuerpo = dict(parse_qsl(query), **cuerpo)
+        encontrada = False
+        for metodo_ruta, patron, conversion, manejador, nivel in RUTAS:
+            m = patron.match(ruta)
+            if not m:
+                continue
+            encontrada = True
+            if metodo_ruta != metodo:
+                continue
+            args = [conversion(m.group(1))] if conversion else []
+            args.append(cuerpo)
+            if nivel is None:
+                return manejador(None, *args) + ({}, )
+            bucle = asyncio.get_running_loop()
+            return await bucle.run_in_executor(self.ejecutor, self._ejecutar, manejador, nivel, args, lsn)
+        if encontrada:
+            raise ErrorHTTP(HTTPStatus.METHOD_NOT_ALLOWED, "Método no permitido.")
+        raise ErrorHTTP(HTTPStatus.NOT_FOUND, "Ruta desconocida.")
+
+    async def _responder(self, escritor, estado, datos, mantener, cabeceras=None):
+        # Las respuestas de texto (métricas de Prometheus) se envían tal cual
+        if isinstance(datos, str):
+            cuerpo, tipo = datos.encode('utf-8'), 'text/plain; version=0.0.4'
+        else:
+            cuerpo = b'' if datos is None else json.dumps(datos, default=_a_json, ensure_ascii=False).encode('utf-8')
+            tipo = 'application/json'
+        cabecera = (f"HTTP/1.1 {estado.value} {estado.phrase}\r\n"
+                    f"Content-Type: {tipo}; charset=utf-8\r\n"
+                    f"Content-Length: {len(cuerpo)}\r\n"
+                    + ''.join(f"{nombre}: {valor}\r\n" for nombre, valor in (cabeceras or {}).items())
+                    + f"Connection: {'keep-alive' if mantener else 'close'}\r\n\r\n")
+        escritor.write(cabecera.encode('latin-1') + cuerpo)
+        await escritor.drain()
+
+    async def atender(self, lector, escritor):
+        """
+        Atiende las peticiones de una conexión TCP hasta que el cliente la cierre.
+        """
+        try:
+            while True:
+                linea = await lector.readline()
+                if not linea:
+                    break
+                try:
+                    metodo, ruta, version = linea.decode('latin-1').split()
+                except ValueError:
+                    await self._responder(escritor, HTTPStatus.BAD_REQUEST, {'error': 'Petición mal formada.'}, False)
+                    break
+
+                cabeceras = {}
+                while True:
+                    linea = await lector.readline()
+                    if linea in (b'\r\n', b'\n', b''):
+                        break
+                    nombre, _, valor = linea.decode('latin-1').partition(':')
+                    cabeceras[nombre.strip().lower()] = valor.strip()
+
+                conexion = cabeceras.get('connection', '').lower()
+                mantener = conexion != 'close' if version == 'HTTP/1.1' else conexion == 'keep-alive'
+
+                try:
+                    longitud = int(cabeceras.get('content-length', 0))
+                    cuerpo = json.loads(await lector.readexactly(longitud)) if longitud else {}
+                    if not isinstance(cuerpo, dict):
+                        raise ValueError
+                except ValueError:
+                    await self._responder(escritor, HTTPStatus.BAD_REQUEST, {'error': 'El cuerpo debe ser un objeto JSON.'}, False)
+                    break
+
+                extra = {}
+                lsn = cabeceras.get('x-bda-lsn') or None
+                try:
+                    if lsn is not None and not LSN.fullmatch(lsn):
+                        raise ErrorHTTP(HTTPStatus.BAD_REQUEST, "La cabecera X-BDA-LSN no es una posición del WAL.")
+                    estado, datos, extra = await self._despachar(metodo.upper(), ruta, cuerpo, lsn)
+                except ErrorHTTP as e:
+                    estado, datos = e.estado, {'error': e.mensaje}
+                except psycopg2.Error as e:
+                    estado = ESTADOS_PGCODE.get(e.pgcode, HTTPStatus.INTERNAL_SERVER_ERROR)
+                    datos = {'error': (e.pgerror or str(e)).strip(), 'pgcode': e.pgcode}
+                except Exception:
+                    # Un fallo no previsto no debe cerrar la conexión sin respuesta
+                    traceback.print_exc()
+                    estado, datos = HTTPStatus.INTERNAL_SERVER_ERROR, {'error': 'Error interno del servidor.'}
+                await self._responder(escritor, estado, datos, mantener, extra)
+                if not mantener:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            escritor.close()
+
+    async def servir(self, host, puerto):
+        servidor = await asyncio.start_server(self.atender, host, puerto)
+        print(f"Escuchando en http://{host}:{puerto}")
+        async with servidor:
+            await servidor.serve_forever()
+
+    def cerrar(self):
+        self.ejecutor.shutdown(wait=True)
+        app.cerrar_cola_escritura()
+        if self.lecturas is not None:
+            self.lecturas.cerrar()
+        self.pool.cerrar()
+
+
+## ------------------------------------------------------------
+def invalidar_cambiadas(lote):
+    """
+    Invalida en la caché de películas las que aparecen en un lote de cambios.
+    """
+    for cambio in lote:
+        if cambio['tabla'] in ('pelicula', 'valoracion_resumen'):
+            app.cache_peliculas.invalidar(int(cambio['clave']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Servidor HTTP/JSON del catálogo de películas.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--puerto', type=int, default=8080)
+    parser.add_argument('--hilos', type=int, default=None,
+                        help="Hilos para las operaciones de base de datos (por defecto, el máximo del pool)")
+    args = parser.parse_args()
+
+    extra = {'connection_factory': metricas.ConexionMedida} if os.environ.get('BDA_METRICAS', '1') != '0' else {}
+    global servidor_activo
+    pool = PoolConexiones.desde_config(**extra)
+    app.iniciar_cola_escritura()
+    servidor = servidor_activo = Servidor(pool, args.hilos or pool.maxconn, EnrutadorLecturas.desde_config(**extra))
+    parar_cambios = None
+    if os.environ.get('BDA_CAMBIOS', '0') != '0':
+        params, _ = leer_config()
+        suscriptor = cambios.Suscriptor(lambda: psycopg2.connect(**params), intervalo=1.0)
+        parar_cambios = cambios.seguir_en_hilo(suscriptor, invalidar_cambiadas)
+    try:
+        asyncio.run(servidor.servir(args.host, args.puerto))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if parar_cambios is not None:
+            parar_cambios.set()
+        servidor.cerrar()
+
+
+if __name__ == '__main__':
+    main()